@@ -0,0 +1,184 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import contextlib
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from archive_source import ROOT_FILENAME, is_archive, open_archive_source, strip_archive_suffix
+from config_diff import MerkleTree
+from config_parser import ConfigParser
+
+SUMMARY_FILENAME = 'audit_summary.json'
+
+# Every worker process keeps one token cache for all archives it audits. The cache is keyed by content digests, so
+# the files that successive backups of a printer have in common are only tokenized once per worker.
+WORKER_TOKEN_CACHE = {}
+
+
+def find_archives(paths):
+    """
+    Expands the given paths into a sorted list of archives. Files are taken as they are, directories are scanned
+    recursively for zip and tar archives.
+    """
+
+    archives = set()
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            for directory, _, filenames in os.walk(path):
+                archives.update(os.path.join(directory, name) for name in filenames if is_archive(name))
+        elif os.path.isfile(path):
+            archives.add(path)
+        else:
+            print(f"Warning: {path} is neither a file nor a directory, skipping it.")
+    return sorted(archives)
+
+
+def output_paths(archives, output_dir=None):
+    """
+    Maps every archive to the output file of its merged configuration, or to None without output_dir. Outputs are
+    named after the archive's path relative to the common parent of all archives, without the archive suffix, e.g.
+    'trident__backup-2024-05-01.cfg' for 'trident/backup-2024-05-01.tar.gz'. Archives that only differ in their
+    suffix, like backup.zip and backup.tar.gz, keep it.
+    """
+
+    if output_dir is None:
+        return dict.fromkeys(archives)
+
+    common_dir = os.path.commonpath(archives) if len(archives) > 1 else os.path.dirname(archives[0])
+    names = {}
+    for archive in archives:
+        name = os.path.relpath(archive, common_dir).replace(os.sep, '__')
+        names[archive] = name, strip_archive_suffix(name)
+    stem_counts = collections.Counter(stem for _, stem in names.values())
+    return {archive: os.path.join(output_dir, f"{stem if stem_counts[stem] == 1 else name}.cfg")
+            for archive, (name, stem) in names.items()}
+
+
+def audit_archive(archive_path, output_filepath=None, hide_unmodified=True, root_name=ROOT_FILENAME,
+                  share_tokens=True):
+    """
+    Merges the configuration inside a single archive without extracting it and reports on it. Runs inside a worker
+    process, so everything it needs is passed as plain arguments and everything it reports is returned as a plain
+    dictionary. Messages the parser prints are captured as warnings. The merged output is only written when
+    output_filepath is given.
+    """
+
+    result = {'archive': archive_path, 'output': output_filepath, 'status': 'ok', 'error': None, 'warnings': []}
+    token_cache = WORKER_TOKEN_CACHE if share_tokens else {}
+    messages = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(messages), open_archive_source(archive_path, token_cache) as source:
+            root = source.find_root(root_name)
+            parser = ConfigParser(os.path.dirname(root), file_source=source)
+            parser.parse_file(root)
+            parsed = time.perf_counter()
+            if output_filepath:
+                os.makedirs(os.path.dirname(os.path.abspath(output_filepath)), exist_ok=True)
+                parser.write_output(output_filepath, hide_unmodified)
+
+            result['root'] = source.relative_path(root)
+            result['parse_seconds'] = parsed - start
+            result['members'] = len(source.members)
+            result['files'] = len(parser.parsed_files)
+            result['tokenized_files'] = source.tokenized_files
+            result['sections'] = len(parser.sections)
+            result['keys'] = sum(len(section.key_value_pairs) for section in parser.sections.values())
+            result['missing_files'] = sorted(filter(None, map(source.relative_path, parser.missing_files)))
+            result['cycles'] = len(parser.include_graph.cycles)
+            result['save_config'] = parser.save_config is not None
+            result['digest'] = MerkleTree(parser).digest.hex()
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = time.perf_counter() - start
+    result['warnings'] = messages.getvalue().splitlines()
+    return result
+
+
+def run_audit(archives, output_dir=None, jobs=None, hide_unmodified=True, root_name=ROOT_FILENAME, progress=print,
+              share_tokens=True):
+    """
+    Audits many archives in a process pool and returns one result dictionary per archive, in the order of archives.
+    A failure, or even a crashed worker, only affects the archive it happened on.
+    """
+
+    outputs = output_paths(archives, output_dir)
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(audit_archive, archive, outputs[archive], hide_unmodified, root_name,
+                                   share_tokens): archive for archive in archives}
+        for future in as_completed(futures):
+            archive = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'archive': archive, 'output': outputs[archive], 'status': 'failed', 'seconds': 0.0,
+                          'error': f"Worker failed: {type(e).__name__}: {e}", 'warnings': []}
+            results[archive] = result
+            if progress:
+                progress(f"[{len(results)}/{len(archives)}] {result['status']:>6}  {result['seconds'] * 1000:8.1f} ms  "
+                         f"{archive}")
+    return [results[archive] for archive in archives]
+
+
+def group_by_digest(results):
+    """
+    Groups the archives of successful audits by the digest of their merged configuration, so backups holding the
+    same effective configuration show up together. Returns the groups ordered by their first archive.
+    """
+
+    groups = {}
+    for result in results:
+        if result['status'] == 'ok':
+            groups.setdefault(result['digest'], []).append(result['archive'])
+    return list(groups.values())
+
+
+def write_audit_summary(results, summary_filepath, wall_seconds, jobs):
+    """
+    Writes the per-archive results and totals of an audit as JSON and returns the totals.
+    """
+
+    groups = group_by_digest(results)
+    totals = {
+        'archives': len(results),
+        'ok': sum(1 for result in results if result['status'] == 'ok'),
+        'failed': sum(1 for result in results if result['status'] == 'failed'),
+        'with_missing_files': sum(1 for result in results if result.get('missing_files')),
+        'with_cycles': sum(1 for result in results if result.get('cycles')),
+        'distinct_configurations': len(groups),
+        'files': sum(result.get('files', 0) for result in results),
+        'tokenized_files': sum(result.get('tokenized_files', 0) for result in results),
+        'jobs': jobs,
+        'wall_seconds': wall_seconds,
+        'worker_seconds': sum(result['seconds'] for result in results),
+    }
+    with open(summary_filepath, 'w') as file:
+        json.dump({'totals': totals, 'groups': groups, 'archives': results}, file, indent=2)
+    return totals
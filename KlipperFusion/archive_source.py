@@ -0,0 +1,297 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import os
+import stat
+import tarfile
+import threading
+import zipfile
+
+from file_source import FileSource
+
+ROOT_FILENAME = 'printer.cfg'
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+MAX_SYMLINK_DEPTH = 8
+
+# Tar members up to this size are read into memory while the member index is built, in the single sequential pass
+# that compressed tar streams allow. Larger members are only read when they are included.
+MAX_PRELOAD_BYTES = 4 * 1024 * 1024
+
+
+def is_archive(path):
+    """
+    Checks whether path names a zip or tar archive, judging by its suffix.
+    """
+
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def strip_archive_suffix(name):
+    """
+    Returns name without its archive suffix, e.g. 'backup' for 'backup.tar.gz'.
+    """
+
+    lowered = name.lower()
+    for suffix in ARCHIVE_SUFFIXES:
+        if lowered.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def split_archive_path(path):
+    """
+    Splits a path that leads into an archive, such as 'backup.zip/printer_data/config/printer.cfg', into the path of
+    the archive and the path inside of it ('' when path is the archive itself). Returns (None, None) when no part of
+    path is an existing archive.
+    """
+
+    path = os.path.abspath(path)
+    candidate = path
+    while True:
+        if is_archive(candidate) and os.path.isfile(candidate):
+            return candidate, '' if candidate == path else os.path.relpath(path, candidate)
+        parent = os.path.dirname(candidate)
+        if parent == candidate:
+            return None, None
+        candidate = parent
+
+
+def member_path(name):
+    """
+    Returns the relative path of an archive member name, or None when it would lead out of the archive.
+    """
+
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if os.pardir in parts:
+        return None
+    return os.sep.join(parts)
+
+
+def link_path(target):
+    """
+    Returns the relative path of a link target given relative to the archive root, or None when it is absolute or
+    leads out of the archive. Like in GitTreeSource.entry, the target is normalized first, so a link may go up with
+    '..' as long as it stays inside the archive, like config/printer.cfg -> ../shared/printer.cfg.
+    """
+
+    path = os.path.normpath(target.replace('\\', '/'))
+    if os.path.isabs(path) or path == os.pardir or path.startswith(os.pardir + os.sep):
+        return None
+    return '' if path == os.curdir else path
+
+
+def symlink_target(name, target):
+    """
+    Returns the target of the symbolic link member name relative to the archive root. The target stored in the link
+    is relative to the directory of the link, unless it is absolute.
+    """
+
+    return os.path.join(os.path.dirname(member_path(name) or ''), target.replace('\\', '/'))
+
+
+class ArchiveSource(FileSource):
+    """The files of a backup archive, presented below a directory named like the archive, so the root file of a
+    backup is found at a path like 'backup.zip/printer_data/config/printer.cfg'.
+
+    Subclasses fill the member index when they are opened: file members, directories (including those that only
+    appear as part of member names) and symbolic links. Includes and glob patterns are resolved against this index
+    and members are read into memory when they are first needed. Content keys are digests of the member contents, so
+    identical files tokenize once across all archives sharing a token cache."""
+
+    def __init__(self, archive_path, token_cache=None):
+        """
+        Initializes an empty member index for archive_path.
+        """
+
+        super().__init__(archive_path, token_cache)
+        self.members = {}  # Relative path -> backend member
+        self.links = {}  # Relative path -> relative link target, or None when it leads out of the archive
+        self.directories = {'': set()}  # Relative path -> entry names
+        self.contents = {}  # Relative path -> member contents
+        self.digests = {}  # Relative path -> content digest
+        self.lock = threading.Lock()
+
+    def add_directory(self, relative):
+        """
+        Adds a directory and its parents to the index.
+        """
+
+        while relative not in self.directories:
+            self.directories[relative] = set()
+            parent, name = os.path.split(relative)
+            self.directories.setdefault(parent, set()).add(name)
+            relative = parent
+
+    def add_member(self, name, member, link_target=None):
+        """
+        Adds a file member, or a symbolic link when link_target is given relative to the archive root.
+        """
+
+        relative = member_path(name)
+        if not relative:
+            return
+        parent, base_name = os.path.split(relative)
+        self.add_directory(parent)
+        self.directories[parent].add(base_name)
+        if link_target is not None:
+            self.links[relative] = link_path(link_target)
+        else:
+            self.members[relative] = member
+
+    def resolve(self, relative):
+        """
+        Follows symbolic links and returns the relative path of the file member a path names, or None.
+        """
+
+        for _ in range(MAX_SYMLINK_DEPTH):
+            if relative in self.members:
+                return relative
+            if relative not in self.links:
+                return None
+            relative = self.links[relative]
+            if relative is None:
+                return None
+        return None
+
+    def read_member(self, member):
+        """
+        Returns the contents of a backend member.
+        """
+
+        raise NotImplementedError
+
+    def content_key(self, relative):
+        relative = self.resolve(relative)
+        if relative is None:
+            return None
+        digest = self.digests.get(relative)
+        if digest is None:
+            digest = self.digests[relative] = hashlib.blake2b(self.read_bytes(relative), digest_size=16).digest()
+        return digest
+
+    def read_bytes(self, relative):
+        relative = self.resolve(relative)
+        data = self.contents.get(relative)
+        if data is None:
+            with self.lock:
+                data = self.contents[relative] = self.read_member(self.members[relative])
+        return data
+
+    def listdir(self, relative):
+        names = self.directories.get(relative)
+        return list(names) if names is not None else None
+
+    def find_root(self, name=ROOT_FILENAME):
+        """
+        Returns the path of the shallowest file called name in the archive. Raises FileNotFoundError when there is
+        none.
+        """
+
+        candidates = [relative for relative in list(self.members) + list(self.links)
+                      if os.path.basename(relative) == name and self.resolve(relative) is not None]
+        if not candidates:
+            raise FileNotFoundError(f"No {name} in {self.root_dir}.")
+        return os.path.join(self.root_dir, min(candidates, key=lambda relative: (relative.count(os.sep), relative)))
+
+    def close(self):
+        """
+        Closes the archive file.
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ZipSource(ArchiveSource):
+    """The files of a zip archive. Members are read on demand through the archive's central directory."""
+
+    def __init__(self, archive_path, token_cache=None):
+        """
+        Opens a zip archive and indexes its members.
+        """
+
+        super().__init__(archive_path, token_cache)
+        self.archive = zipfile.ZipFile(archive_path)
+        for info in self.archive.infolist():
+            if info.is_dir():
+                relative = member_path(info.filename)
+                if relative is not None:
+                    self.add_directory(relative)
+            elif stat.S_ISLNK(info.external_attr >> 16):
+                target = self.archive.read(info).decode('utf-8', 'surrogateescape')
+                self.add_member(info.filename, info, symlink_target(info.filename, target))
+            else:
+                self.add_member(info.filename, info)
+
+    def read_member(self, member):
+        return self.archive.read(member)
+
+    def close(self):
+        self.archive.close()
+
+
+class TarSource(ArchiveSource):
+    """The files of a tar archive, optionally gzip, bzip2 or xz compressed. The archive is read in one sequential
+    pass that also loads every member of up to MAX_PRELOAD_BYTES into memory, so compressed archives are decompressed
+    only once."""
+
+    def __init__(self, archive_path, token_cache=None):
+        """
+        Opens a tar archive, indexes its members and preloads the small ones.
+        """
+
+        super().__init__(archive_path, token_cache)
+        self.archive = tarfile.open(archive_path, 'r:*')
+        for member in self.archive:
+            if member.isdir():
+                relative = member_path(member.name)
+                if relative is not None:
+                    self.add_directory(relative)
+            elif member.issym():
+                self.add_member(member.name, member, symlink_target(member.name, member.linkname))
+            elif member.islnk():
+                self.add_member(member.name, member, member.linkname)
+            elif member.isfile():
+                self.add_member(member.name, member)
+                relative = member_path(member.name)
+                if relative and member.size <= MAX_PRELOAD_BYTES:
+                    self.contents[relative] = self.archive.extractfile(member).read()
+
+    def read_member(self, member):
+        return self.archive.extractfile(member).read()
+
+    def close(self):
+        self.archive.close()
+
+
+def open_archive_source(archive_path, token_cache=None):
+    """
+    Opens a zip or tar archive as an ArchiveSource, choosing the backend by the archive's suffix.
+    """
+
+    if archive_path.lower().endswith('.zip'):
+        return ZipSource(archive_path, token_cache)
+    return TarSource(archive_path, token_cache)
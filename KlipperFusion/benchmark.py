@@ -0,0 +1,1316 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import builtins
+import contextlib
+import difflib
+import glob
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+import click
+
+from archive_audit import audit_archive, find_archives, run_audit
+from config_index import ConfigIndex, query_selector
+from config_diff import MerkleTree, count_differences, diff_trees
+from config_generator import (generate_config_tree, generate_glob_tree, generate_include_tree, generate_override_tree,
+                              write_save_config)
+from config_lexer import tokenize_text
+from config_overlay import OverlayParser
+from config_parser import ConfigParser
+from configuration_section import ConfigurationSection
+from content_store import ContentStore, format_dedup_stats
+from fleet import find_printer_roots, run_fleet
+from gcode_block import GCodeBlock
+from git_history import ConfigHistory
+from include_graph import IncludeGraph
+from include_prefetcher import prefetch_includes
+from macro_index import MacroIndex
+from parse_cache import ParseCache
+from save_config import (SAVE_CONFIG_MARKER, SAVE_CONFIG_PREFIX, SaveConfig, save_config_intact,
+                         warn_modified_save_config)
+from snapshot import write_json_export
+from text_index import TextIndex
+
+# Benchmarks for KlipperFusion. Each command builds its own synthetic configuration tree in a temporary directory, so
+# the results do not depend on the configurations that happen to be on disk.
+
+# The bundled Klipper configurations, which some benchmarks load or check in addition to their synthetic trees
+BUNDLED_CONFIGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'klippain_configs')
+
+
+@contextlib.contextmanager
+def simulated_latency(root_dir, latency):
+    """
+    Adds a fixed delay to every open() and existence check below root_dir, emulating network or SD-card storage.
+    The delay uses time.sleep, which releases the GIL exactly like a blocking read does.
+    """
+
+    original_open = builtins.open
+    original_exists = os.path.exists
+
+    def slow_open(file, *args, **kwargs):
+        if isinstance(file, str) and file.startswith(root_dir):
+            time.sleep(latency)
+        return original_open(file, *args, **kwargs)
+
+    def slow_exists(path):
+        if isinstance(path, str) and path.startswith(root_dir):
+            time.sleep(latency)
+        return original_exists(path)
+
+    builtins.open = slow_open
+    os.path.exists = slow_exists
+    try:
+        yield
+    finally:
+        builtins.open = original_open
+        os.path.exists = original_exists
+
+
+def render(parser):
+    """
+    Returns the full merged output of a parser, used to check that optimized modes produce identical results.
+    """
+
+    return ''.join(section.write_output(parser.base_path, False) for section in parser.sections.values())
+
+
+def build_merged_parser(key_count, override_files=3, keys_per_section=50):
+    """
+    Builds a parser holding a merged configuration with key_count keys, each overridden in override_files files.
+    """
+
+    parser = ConfigParser('/printer')
+    for file_index in range(override_files + 1):
+        filename = f'/printer/config/override_{file_index}.cfg'
+        for key_index in range(key_count):
+            if key_index % keys_per_section == 0:
+                parser.parse_line(f"[section_{key_index // keys_per_section}]\n", filename, '/printer/config')
+            parser.parse_line(f"# Comment for key {key_index}\n", filename, '/printer/config')
+            parser.parse_line(f"key_{key_index}: {file_index * 0.1:.3f} # from {file_index}\n", filename,
+                              '/printer/config')
+            if key_index % keys_per_section == keys_per_section - 1 or key_index == key_count - 1:
+                parser.parse_line("gcode:\n", filename, '/printer/config')
+                parser.parse_line("    G28 ; home all axes\n", filename, '/printer/config')
+                parser.parse_line("    G1 X10 Y10 F3000\n", filename, '/printer/config')
+    return parser
+
+
+def legacy_write_output(parser, output_filepath, hide_unmodified):
+    """
+    The emit path as it was before streaming: every section, key and gcode block is built by repeated string
+    concatenation and the complete section text is handed to file.write. Kept for comparison only.
+    """
+
+    def format_key_value_pair(kvp):
+        output = ""
+        for comment in kvp.preceding_comments:
+            output += f"# {comment}\n"
+        for occ in kvp.get_occurrence_details()[:-1]:
+            relative_filename = os.path.relpath(occ['filename'], parser.base_path)
+            prev_val_line = f"# {kvp.key}: {occ['value']} <- {relative_filename}:"
+            if occ['inline_comment']:
+                prev_val_line += f" # {occ['inline_comment']}"
+            output += prev_val_line + "\n"
+        current_val_line = f"{kvp.key}: {kvp.value}"
+        if kvp.inline_comment:
+            current_val_line += f" # {kvp.inline_comment}"
+        return output + current_val_line
+
+    def write_block(block):
+        if hide_unmodified and not block.has_modifications():
+            return f"{block.name}: # UNMODIFIED\n\n"
+        output = "{}:\n".format(block.name)
+        for line in block.lines:
+            output += "{}\n".format(line.rstrip('\n'))
+        return output
+
+    with open(output_filepath, 'w') as file:
+        for section in parser.sections.values():
+            output = "\n"
+            for filename in [os.path.relpath(filename, parser.base_path) for filename in section.filenames]:
+                output += f"# {filename}\n"
+            output += f"[{section.name}]\n"
+            for kvp in section.key_value_pairs.values():
+                output += format_key_value_pair(kvp) + "\n"
+            if section.bed_mesh is not None:
+                output += ''.join(section.bed_mesh.iter_output())
+            for blocks in section.gcode_blocks.values():
+                for block in blocks:
+                    output += write_block(block)
+            file.write(output)
+
+
+class LineByLineParser(ConfigParser):
+    """ConfigParser that reads files through a text file object and feeds them to parse_line one line at a time, the
+    way files were parsed before the bulk-read I/O layer."""
+
+    def parse_file(self, filepath, parent_dir=''):
+        """
+        Parses a single file line by line, expanding glob patterns and applying the SAVE_CONFIG block of the root
+        file like ConfigParser.parse_file.
+        """
+
+        normalized_path = self.normalize_path(filepath, parent_dir)
+        if '*' in normalized_path:
+            for matching_file in self.expand_glob(normalized_path):
+                self.parse_file(matching_file, os.path.dirname(matching_file))
+        elif os.path.exists(normalized_path):
+            current_dir = os.path.dirname(normalized_path)
+            save_config_lines = None
+            with open(normalized_path, 'r') as file:
+                for line in file:
+                    if save_config_lines is not None:
+                        save_config_lines.append(line)
+                    elif not parent_dir and line.startswith(SAVE_CONFIG_PREFIX) and SAVE_CONFIG_MARKER in line:
+                        save_config_lines = [line]
+                    else:
+                        self.parse_line(line, normalized_path, current_dir)
+            if save_config_lines is None:
+                return
+            if save_config_intact(save_config_lines[1:]):
+                self.apply_save_config(SaveConfig.from_lines(save_config_lines, normalized_path))
+                return
+            warn_modified_save_config(normalized_path)
+            for line in save_config_lines:
+                self.parse_line(line, normalized_path, current_dir)
+
+
+class SortedGlobParser(ConfigParser):
+    """ConfigParser that includes the matches of glob patterns in sorted order, like Klipper and the file sources
+    do, instead of in directory order."""
+
+    def match_glob(self, pattern):
+        return sorted(super().match_glob(pattern))
+
+
+class UntrackedIncludeGraph(IncludeGraph):
+    """IncludeGraph that never reports a cycle, so a circular include recurses until Python's stack overflows."""
+
+    def enter(self, path):
+        self.stack.append(path)
+        return None
+
+
+class UncachedIncludeParser(ConfigParser):
+    """ConfigParser that calls glob.glob for every glob include and only stops circular includes through
+    RecursionError, the way includes were handled before the include graph."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.include_graph = UntrackedIncludeGraph()
+
+    def expand_glob(self, pattern):
+        """
+        Expands pattern with glob.glob on every call.
+        """
+
+        self.glob_results[pattern] = glob.glob(pattern)
+        return self.glob_results[pattern]
+
+
+class FullHistorySection(ConfigurationSection):
+    """ConfigurationSection that keeps every version of an overridden gcode block as a full copy of its lines, the
+    way block history was stored before it was delta-encoded."""
+
+    __slots__ = ()
+
+    def add_gcode_block(self, block_name, gcode_lines, preceding_comments=None, filename=''):
+        new_block = GCodeBlock(block_name, filename)
+        new_block.lines = list(gcode_lines)
+        new_block.set_preceding_comments(preceding_comments or ())
+        self.gcode_blocks.setdefault(block_name, []).append(new_block)
+
+
+class FullHistoryParser(ConfigParser):
+    """ConfigParser whose sections keep full copies of gcode block history."""
+
+    def start_new_section(self, name, filename):
+        created = name not in self.sections
+        super().start_new_section(name, filename)
+        if created:
+            self.current_section.__class__ = FullHistorySection
+
+
+def measure(function, *args):
+    """
+    Runs function twice: once for wall time and once under tracemalloc for its peak memory allocation.
+    """
+
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+# Scale presets of the benchmark suite. 'medium' is the size baselines are usually recorded at.
+SUITE_SIZES = {
+    'small': {'include_depth': 10, 'glob_files': 20, 'macro_count': 300, 'macro_lines': 30, 'override_files': 4,
+              'overrides_per_file': 50, 'mesh_size': (10, 10), 'include_files': 100},
+    'medium': {'include_depth': 20, 'glob_files': 50, 'macro_count': 2000, 'macro_lines': 40, 'override_files': 10,
+               'overrides_per_file': 200, 'mesh_size': (20, 20), 'include_files': 500},
+    'large': {'include_depth': 50, 'glob_files': 200, 'macro_count': 10000, 'macro_lines': 50, 'override_files': 40,
+              'overrides_per_file': 500, 'mesh_size': (50, 50), 'include_files': 2000},
+}
+
+# Metrics of the suite and whether a higher value is better.
+SUITE_METRICS = {
+    'parse_line_lines_per_sec': True,
+    'parse_tree_lines_per_sec': True,
+    'include_files_per_sec': True,
+    'emit_bytes_per_sec': True,
+    'peak_memory_bytes': False,
+}
+
+
+def best_time(repeat, function, *args):
+    """
+    Returns the best wall time of repeat calls to function, which is the least noisy estimate of its cost.
+    """
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def parse_tree(root):
+    """
+    Parses a tree from scratch with warnings suppressed and returns the parser.
+    """
+
+    with contextlib.redirect_stdout(None):
+        parser = ConfigParser(os.path.dirname(root))
+        parser.parse_file(root)
+    return parser
+
+
+def parse_lines(lines, filename):
+    """
+    Feeds lines straight into ConfigParser.parse_line, measuring the tokenizer and state machine without any I/O.
+    """
+
+    parser = ConfigParser(os.path.dirname(filename))
+    current_dir = os.path.dirname(filename)
+    for line in lines:
+        parser.parse_line(line, filename, current_dir)
+    return parser
+
+
+def run_suite(size, repeat):
+    """
+    Runs the benchmark suite at the given size and returns its results as a JSON-serializable dictionary.
+    """
+
+    params = dict(SUITE_SIZES[size])
+    include_files = params.pop('include_files')
+    metrics = {}
+    with tempfile.TemporaryDirectory() as root_dir:
+        tree_dir = os.path.join(root_dir, 'tree')
+        corpus = generate_config_tree(tree_dir, **params)
+        include_dir = os.path.join(root_dir, 'includes')
+        os.makedirs(include_dir)
+        include_corpus = generate_include_tree(include_dir, include_files)
+
+        macro_file = os.path.join(tree_dir, 'macros', 'macros_000.cfg')
+        with open(macro_file) as file:
+            macro_lines = file.readlines()
+        metrics['parse_line_lines_per_sec'] = len(macro_lines) / best_time(repeat, parse_lines, macro_lines, macro_file)
+        metrics['parse_tree_lines_per_sec'] = corpus['lines'] / best_time(repeat, parse_tree, corpus['root'])
+        include_time = best_time(repeat, parse_tree, include_corpus['root'])
+        metrics['include_files_per_sec'] = include_corpus['files'] / include_time
+
+        parser = parse_tree(corpus['root'])
+        output_path = os.path.join(root_dir, 'output.cfg')
+        emit_time = best_time(repeat, parser.write_output, output_path, False)
+        metrics['emit_bytes_per_sec'] = os.path.getsize(output_path) / emit_time
+        del parser
+
+        tracemalloc.start()
+        parse_tree(corpus['root']).write_output(output_path, False)
+        metrics['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    corpus.pop('root')
+    return {
+        'version': 1,
+        'size': size,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'corpus': corpus,
+        'metrics': metrics,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Prints every metric next to its baseline value and returns the names of the metrics that regressed by more than
+    tolerance (a fraction, e.g. 0.1 for 10%).
+    """
+
+    regressions = []
+    print(f"  {'metric':<26} {'current':>14} {'baseline':>14} {'change':>8}")
+    for metric, higher_is_better in SUITE_METRICS.items():
+        current = results['metrics'][metric]
+        previous = baseline.get('metrics', {}).get(metric)
+        if not previous:
+            print(f"  {metric:<26} {current:14,.0f} {'-':>14}")
+            continue
+        change = current / previous - 1
+        regressed = -change > tolerance if higher_is_better else change > tolerance
+        if regressed:
+            regressions.append(metric)
+        print(f"  {metric:<26} {current:14,.0f} {previous:14,.0f} {change:+7.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+@click.group()
+def cli():
+    """
+    Performance benchmarks for KlipperFusion.
+    """
+
+
+@cli.command('include-latency')
+@click.option('--files', default=200, show_default=True, help='Number of files in the include tree.')
+@click.option('--latency-ms', default=5.0, show_default=True, help='Simulated latency of each file system access.')
+@click.option('--jobs', '-j', default=8, show_default=True, help='Worker threads for the prefetching parser.')
+def include_latency(files, latency_ms, jobs):
+    """
+    Compares serial include parsing against thread-pool prefetching on a simulated high-latency file system.
+    """
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        root = generate_include_tree(root_dir, files)['root']
+        results = {}
+        outputs = {}
+        for label, job_count in (('serial', 1), (f'--jobs {jobs}', jobs)):
+            with simulated_latency(root_dir, latency_ms / 1000):
+                start = time.perf_counter()
+                parser = ConfigParser(root_dir)
+                if job_count > 1:
+                    prefetch_includes(parser, root, job_count)
+                parser.parse_file(root)
+                results[label] = time.perf_counter() - start
+            outputs[label] = render(parser)
+
+    print(f"{files} files, {latency_ms} ms simulated latency per access")
+    for label, elapsed in results.items():
+        print(f"  {label:>10}: {elapsed * 1000:9.1f} ms")
+    serial, parallel = results.values()
+    print(f"  speedup: {serial / parallel:.2f}x")
+    print(f"  identical output: {len(set(outputs.values())) == 1}")
+
+
+@cli.command('emit')
+@click.option('--keys', default=50000, show_default=True, help='Number of distinct keys in the merged configuration.')
+@click.option('--overrides', default=3, show_default=True, help='Number of times every key is overridden.')
+@click.option('--keys-per-section', default=5000, show_default=True, help='Number of keys in every section.')
+def emit(keys, overrides, keys_per_section):
+    """
+    Compares the streaming output writer against the former string-concatenation emitter.
+    """
+
+    parser = build_merged_parser(keys, overrides, keys_per_section)
+    with tempfile.TemporaryDirectory() as output_dir:
+        legacy_path = os.path.join(output_dir, 'legacy.cfg')
+        streaming_path = os.path.join(output_dir, 'streaming.cfg')
+        legacy_time, legacy_peak = measure(legacy_write_output, parser, legacy_path, False)
+        streaming_time, streaming_peak = measure(parser.write_output, streaming_path, False)
+        output_size = os.path.getsize(streaming_path)
+        with open(legacy_path) as legacy_file, open(streaming_path) as streaming_file:
+            identical = legacy_file.read() == streaming_file.read()
+
+    print(f"{keys} keys x {overrides + 1} definitions, {output_size / 1024 / 1024:.1f} MiB of output")
+    print(f"  {'':>10}  {'time':>10}  {'MiB/s':>8}  {'peak memory':>12}")
+    for label, elapsed, peak in (('legacy', legacy_time, legacy_peak), ('streaming', streaming_time, streaming_peak)):
+        print(f"  {label:>10}  {elapsed * 1000:8.1f}ms  {output_size / elapsed / 1024 / 1024:8.1f}  "
+              f"{peak / 1024:9.1f} KiB")
+    print(f"  identical output: {identical}")
+
+
+@cli.command('memory')
+@click.option('--copies', default=100, show_default=True, help='How many times every bundled tree is loaded.')
+@click.option('--configs-dir', default=BUNDLED_CONFIGS_DIR,
+              help='Directory holding one printer configuration tree per subdirectory.')
+@click.option('--shared-store', is_flag=True, help='Share token streams of identical files through a ContentStore.')
+def memory(copies, configs_dir, shared_store):
+    """
+    Measures the memory held by merged configurations when many printers are loaded into one process.
+    """
+
+    roots = sorted(os.path.join(configs_dir, name, 'config', 'printer.cfg') for name in os.listdir(configs_dir)
+                   if os.path.isfile(os.path.join(configs_dir, name, 'config', 'printer.cfg')))
+    parsers = []
+    content_store = ContentStore() if shared_store else None
+    with contextlib.redirect_stdout(None):
+        tracemalloc.start()
+        start = time.perf_counter()
+        for _ in range(copies):
+            for root in roots:
+                parser = ConfigParser(os.path.dirname(root), content_store=content_store)
+                parser.parse_file(root)
+                parsers.append(parser)
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    keys = sum(len(section.key_value_pairs) for parser in parsers for section in parser.sections.values())
+    print(f"{len(parsers)} merged printers ({len(roots)} trees x {copies}), {keys} keys, parsed in {elapsed:.2f} s")
+    print(f"  retained: {current / 1024 / 1024:8.2f} MiB ({current / len(parsers) / 1024:.1f} KiB per printer)")
+    print(f"  peak:     {peak / 1024 / 1024:8.2f} MiB")
+    if content_store is not None:
+        print(f"  shared:   {format_dedup_stats(content_store.stats())}")
+
+
+@cli.command('fleet-scaling')
+@click.option('--copies', default=50, show_default=True, help='How many times every bundled tree is copied.')
+@click.option('--configs-dir', default=BUNDLED_CONFIGS_DIR,
+              help='Directory holding one printer configuration tree per subdirectory.')
+def fleet_scaling(copies, configs_dir):
+    """
+    Measures how fleet merges scale with the number of worker processes.
+    """
+
+    with tempfile.TemporaryDirectory() as fleet_dir:
+        for copy in range(copies):
+            for name in os.listdir(configs_dir):
+                if os.path.isdir(os.path.join(configs_dir, name)):
+                    shutil.copytree(os.path.join(configs_dir, name), os.path.join(fleet_dir, f"{name} #{copy}"))
+        roots = find_printer_roots([fleet_dir])
+
+        job_counts = sorted({1, 2, 4, os.cpu_count() or 1})
+        baseline = None
+        print(f"{len(roots)} printers, {os.cpu_count()} CPUs")
+        for jobs in job_counts:
+            start = time.perf_counter()
+            run_fleet(roots, os.path.join(fleet_dir, 'out'), jobs, use_cache=False, progress=None)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(f"  {jobs:>3} workers: {elapsed:7.2f} s  speedup {baseline / elapsed:5.2f}x")
+
+
+@cli.command('suite')
+@click.option('--size', type=click.Choice(sorted(SUITE_SIZES)), default='medium', show_default=True,
+              help='Scale of the generated configuration trees.')
+@click.option('--repeat', default=3, show_default=True, help='Repetitions per measurement; the best time is used.')
+@click.option('--output', default=None, help='Write the results as JSON to this file.')
+@click.option('--baseline', default=None, help='Compare against results previously saved with --output.')
+@click.option('--tolerance', default=0.1, show_default=True,
+              help='Relative slowdown (or memory growth) against the baseline reported as a regression.')
+def suite(size, repeat, output, baseline, tolerance):
+    """
+    Measures parse_line, whole-tree parsing, include handling and output throughput plus peak memory on a
+    deterministic synthetic configuration tree. Exits with status 1 when a metric regressed against the baseline.
+    """
+
+    results = run_suite(size, repeat)
+    corpus = results['corpus']
+    print(f"{size} corpus: {corpus['files']} files, {corpus['lines']:,} lines, {corpus['bytes'] / 1024 / 1024:.1f} MiB")
+
+    regressions = []
+    if baseline:
+        with open(baseline) as file:
+            baseline_results = json.load(file)
+        if baseline_results.get('size') != size:
+            print(f"Warning: baseline was recorded at size {baseline_results.get('size')}, not {size}.")
+        regressions = compare_to_baseline(results, baseline_results, tolerance)
+    else:
+        for metric, value in results['metrics'].items():
+            print(f"  {metric:<26} {value:14,.0f}")
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Results written to {output}.")
+    if regressions:
+        sys.exit(f"Regressions: {', '.join(regressions)}")
+
+
+@cli.command('lexer')
+@click.option('--size', type=click.Choice(sorted(SUITE_SIZES)), default='large', show_default=True,
+              help='Scale of the generated corpus.')
+@click.option('--repeat', default=3, show_default=True, help='Repetitions per measurement; the best time is used.')
+@click.option('--configs-dir', default=BUNDLED_CONFIGS_DIR,
+              help='Directory with real configurations the lexer is checked against as well.')
+def lexer(size, repeat, configs_dir):
+    """
+    Compares the single-pass lexer against line-by-line tokenizing and checks that both produce identical tokens.
+    """
+
+    params = dict(SUITE_SIZES[size])
+    params.pop('include_files')
+    texts = []
+    with tempfile.TemporaryDirectory() as root_dir:
+        generate_config_tree(root_dir, **params)
+        for directory, _, filenames in os.walk(root_dir):
+            for filename in sorted(filenames):
+                with open(os.path.join(directory, filename)) as file:
+                    texts.append(file.read())
+    corpus = ''.join(texts)
+    line_count = corpus.count('\n')
+
+    identical = True
+    for directory, _, filenames in os.walk(configs_dir):
+        for filename in filenames:
+            if filename.endswith('.cfg'):
+                with open(os.path.join(directory, filename)) as file:
+                    text = file.read()
+                identical = identical and tokenize_text(text) == ConfigParser.tokenize_text_by_line(text)
+    identical = identical and tokenize_text(corpus) == ConfigParser.tokenize_text_by_line(corpus)
+
+    by_line = best_time(repeat, ConfigParser.tokenize_text_by_line, corpus)
+    single_pass = best_time(repeat, tokenize_text, corpus)
+    print(f"{size} corpus: {line_count:,} lines, {len(corpus) / 1024 / 1024:.1f} MiB")
+    print(f"  line by line: {line_count / by_line:12,.0f} lines/s")
+    print(f"  single pass:  {line_count / single_pass:12,.0f} lines/s  ({by_line / single_pass:.2f}x)")
+    print(f"  identical tokens (corpus and bundled configs): {identical}")
+
+
+@cli.command('bulk-read')
+@click.option('--macro-lines', default=400, show_default=True, help='Number of lines in every macro body.')
+@click.option('--mesh-points', default=200, show_default=True, help='Points per axis of the SAVE_CONFIG bed mesh.')
+@click.option('--repeat', default=3, show_default=True, help='Repetitions per measurement; the best time is used.')
+def bulk_read(macro_lines, mesh_points, repeat):
+    """
+    Compares line-by-line reading and parsing against bulk reads (mmap for large files) feeding the lexer.
+    """
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        tree = generate_config_tree(root_dir, macro_count=600, macro_lines=macro_lines, glob_files=4,
+                                    include_depth=5, mesh_size=(mesh_points, mesh_points))
+        largest = max(os.path.getsize(os.path.join(directory, filename))
+                      for directory, _, filenames in os.walk(root_dir) for filename in filenames)
+        print(f"Tree: {tree['files']} files, {tree['lines']:,} lines, {tree['bytes'] / 1024 / 1024:.1f} MiB "
+              f"(largest file {largest / 1024 / 1024:.1f} MiB)")
+
+        def parse_with(parser_class):
+            parser = parser_class(root_dir)
+            parser.parse_file(tree['root'])
+            return parser
+
+        line_by_line = best_time(repeat, parse_with, LineByLineParser)
+        bulk = best_time(repeat, parse_with, ConfigParser)
+        identical = render(parse_with(LineByLineParser)) == render(parse_with(ConfigParser))
+
+    print(f"  line by line: {line_by_line:7.3f} s  {tree['lines'] / line_by_line:12,.0f} lines/s")
+    print(f"  bulk read:    {bulk:7.3f} s  {tree['lines'] / bulk:12,.0f} lines/s  ({line_by_line / bulk:.2f}x)")
+    print(f"  identical output: {identical}")
+
+
+@cli.command('query')
+@click.option('--size', type=click.Choice(sorted(SUITE_SIZES)), default='medium', show_default=True,
+              help='Scale of the generated tree.')
+@click.option('--repeat', default=3, show_default=True, help='Repetitions per measurement; the best time is used.')
+def query(size, repeat):
+    """
+    Compares answering a single SECTION.KEY lookup through the index against a full merge that writes the output.
+    """
+
+    params = dict(SUITE_SIZES[size])
+    params.pop('include_files')
+    selectors = ('stepper_z.rotation_distance', 'gcode_macro MACRO_1.gcode')
+    with tempfile.TemporaryDirectory() as root_dir:
+        tree = generate_config_tree(os.path.join(root_dir, 'tree'), **params)
+        output_file = os.path.join(root_dir, 'output.cfg')
+
+        def full_merge(cache=None):
+            with contextlib.redirect_stdout(None):
+                parser = ConfigParser(os.path.dirname(tree['root']), cache)
+                parser.parse_file(tree['root'])
+            parser.write_output(output_file, hide_unmodified=False)
+
+        def lookup(cache=None):
+            index = ConfigIndex()
+            with contextlib.redirect_stdout(None):
+                parser = ConfigParser(os.path.dirname(tree['root']), cache, index=index,
+                                      section_filter={selector.rsplit('.', 1)[0] for selector in selectors})
+                parser.parse_file(tree['root'])
+            return [query_selector(index, selector) for selector in selectors]
+
+        cache = ParseCache(os.path.join(root_dir, 'cache'))
+        lookup(cache)
+        timings = [(label, best_time(repeat, full_merge, cache), best_time(repeat, lookup, cache))
+                   for label, cache in (('cold', None), ('cached', cache))]
+        answers = lookup()
+        reference = parse_tree(tree['root'])
+        macro_lines = reference.sections['gcode_macro MACRO_1'].gcode_blocks['gcode'][-1].lines
+        correct = (answers[0]['value'] == reference.sections['stepper_z'].key_value_pairs['rotation_distance'].value
+                   and answers[1]['gcode'] == [line.rstrip('\n') for line in macro_lines])
+
+    print(f"{size} tree: {tree['files']} files, {tree['lines']:,} lines")
+    for label, merge_time, lookup_time in timings:
+        print(f"  {label + ':':8}full merge {merge_time * 1000:8.1f} ms   index lookup {lookup_time * 1000:8.1f} ms  "
+              f"({merge_time / lookup_time:.2f}x)")
+    print(f"  answers match the full merge: {correct}")
+
+
+@cli.command('include-graph')
+@click.option('--files', default=5000, show_default=True, help='Number of files included through glob patterns.')
+@click.option('--repeat', default=3, show_default=True, help='Repetitions per measurement; the best time is used.')
+def include_graph(files, repeat):
+    """
+    Measures include handling on a pathological glob tree and on a circular include, with and without the include graph.
+    """
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        tree = generate_glob_tree(root_dir, files)
+
+        def parse_with(parser_class, root):
+            with contextlib.redirect_stdout(None):
+                parser = parser_class(root_dir)
+                parser.parse_file(root)
+            return parser
+
+        uncached = best_time(repeat, parse_with, UncachedIncludeParser, tree['root'])
+        cached = best_time(repeat, parse_with, ConfigParser, tree['root'])
+        parser = parse_with(ConfigParser, tree['root'])
+        identical = render(parser) == render(parse_with(UncachedIncludeParser, tree['root']))
+
+        cycle_root = os.path.join(root_dir, 'cycle.cfg')
+        with open(cycle_root, 'w') as file:
+            file.write("[include cycle_b.cfg]\n[cycle_a]\nkey: 1\n")
+        with open(os.path.join(root_dir, 'cycle_b.cfg'), 'w') as file:
+            file.write("[include cycle.cfg]\n[cycle_b]\nkey: 2\n")
+        overflow = best_time(repeat, parse_with, UncachedIncludeParser, cycle_root)
+        detected = best_time(repeat, parse_with, ConfigParser, cycle_root)
+
+    glob_count = sum(1 for _, _, pattern in parser.include_graph.edges if pattern)
+    print(f"Glob tree: {tree['files']} files, {len(parser.glob_cache.patterns)} distinct patterns, "
+          f"{glob_count:,} glob includes")
+    print(f"  glob.glob every time: {uncached * 1000:8.1f} ms")
+    print(f"  memoized globs:       {cached * 1000:8.1f} ms  ({uncached / cached:.2f}x, "
+          f"{parser.glob_cache.listing_reads} directory listings)")
+    print(f"  identical output: {identical}")
+    print("Circular include:")
+    print(f"  until RecursionError: {overflow * 1000:8.1f} ms")
+    print(f"  include graph:        {detected * 1000:8.1f} ms  ({overflow / detected:.0f}x)")
+
+
+@cli.command('diff')
+@click.option('--size', type=click.Choice(sorted(SUITE_SIZES)), default='small', show_default=True,
+              help='Scale of the generated trees.')
+@click.option('--printers', default=4, show_default=True, help='Number of slightly different copies of the tree.')
+def diff(size, printers):
+    """
+    Compares pairwise diffs of merged output files with difflib against diffs of section hash trees.
+    """
+
+    params = dict(SUITE_SIZES[size])
+    params.pop('include_files')
+    with tempfile.TemporaryDirectory() as root_dir:
+        base_dir = os.path.join(root_dir, 'printer_0')
+        tree = generate_config_tree(base_dir, **params)
+        roots = [tree['root']]
+        for index in range(1, printers):
+            printer_dir = os.path.join(root_dir, f'printer_{index}')
+            shutil.copytree(base_dir, printer_dir)
+            root = os.path.join(printer_dir, 'printer.cfg')
+            with open(root) as file:
+                lines = file.readlines()
+            # The edits go before the SAVE_CONFIG block, which is not read when anything else follows its header
+            end = next((position for position, line in enumerate(lines)
+                        if line.startswith(SAVE_CONFIG_PREFIX) and SAVE_CONFIG_MARKER in line), len(lines))
+            lines.insert(end, f"[stepper_z]\nrun_current: 0.{index}\n[printer_{index}]\nkey: {index}\n\n")
+            with open(root, 'w') as file:
+                file.writelines(lines)
+            roots.append(root)
+        parsers = [parse_tree(root) for root in roots]
+        outputs = []
+        for parser, root in zip(parsers, roots):
+            output_file = os.path.join(os.path.dirname(root), 'output.cfg')
+            parser.write_output(output_file, hide_unmodified=False)
+            with open(output_file) as file:
+                outputs.append(file.readlines())
+
+    pairs = [(left, right) for left in range(printers) for right in range(left + 1, printers)]
+    start = time.perf_counter()
+    text_changes = [sum(1 for _ in difflib.unified_diff(outputs[left], outputs[right])) for left, right in pairs]
+    text_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    trees = [MerkleTree(parser) for parser in parsers]
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    reports = [diff_trees(trees[left], trees[right]) for left, right in pairs]
+    compare_time = time.perf_counter() - start
+    start = time.perf_counter()
+    counts = [count_differences(trees[left], trees[right]) for left, right in pairs]
+    count_time = time.perf_counter() - start
+    statuses = [{change['status'] for change in report['sections']} for report in reports]
+    if not all({'changed', 'added'} <= status for status in statuses) or not all(counts):
+        sys.exit("The printers do not differ: the edits of the copies are missing from their merged output.")
+
+    print(f"{printers} printers of {tree['lines']:,} lines, {len(pairs)} pairs")
+    print(f"  difflib on output files: {text_time * 1000:9.1f} ms  ({sum(text_changes):,} diff lines)")
+    print(f"  hash trees:              {(build_time + compare_time) * 1000:9.1f} ms  "
+          f"({build_time * 1000:.1f} ms building, {compare_time * 1000:.1f} ms comparing, "
+          f"{sum(len(report['sections']) for report in reports)} changed sections)  "
+          f"({text_time / (build_time + compare_time):.0f}x)")
+    print(f"  digest-only matrix:      {count_time * 1000:9.3f} ms  ({sum(counts)} differing sections)")
+
+
+@cli.command('snapshot')
+@click.option('--size', type=click.Choice(sorted(SUITE_SIZES)), default='medium', show_default=True,
+              help='Scale of the generated tree.')
+@click.option('--repeat', default=3, show_default=True, help='Repetitions per measurement; the best time is used.')
+def snapshot(size, repeat):
+    """
+    Compares getting the merged state by parsing (cold and with a warm parse cache) against loading a snapshot.
+    """
+
+    params = dict(SUITE_SIZES[size])
+    params.pop('include_files')
+    with tempfile.TemporaryDirectory() as root_dir:
+        tree = generate_config_tree(os.path.join(root_dir, 'tree'), **params)
+        snapshot_file = os.path.join(root_dir, 'merged.kfsnap')
+        json_file = os.path.join(root_dir, 'merged.json')
+        cache = ParseCache(os.path.join(root_dir, 'cache'))
+
+        def parse(cache=None):
+            with contextlib.redirect_stdout(None):
+                parser = ConfigParser(os.path.dirname(tree['root']), cache)
+                parser.parse_file(tree['root'])
+            return parser
+
+        parser = parse(cache)
+        write_time = best_time(repeat, parser.write_snapshot, snapshot_file)
+        write_json_export(parser, json_file)
+        cold = best_time(repeat, parse)
+        cached = best_time(repeat, parse, cache)
+        load = best_time(repeat, ConfigParser.from_snapshot, snapshot_file)
+        compressed_file = os.path.join(root_dir, 'compressed.kfsnap')
+        parser.write_snapshot(compressed_file, compress=True)
+        compressed_load = best_time(repeat, ConfigParser.from_snapshot, compressed_file)
+        compressed_size = os.path.getsize(compressed_file)
+        selective = best_time(repeat, ConfigParser.from_snapshot, snapshot_file, ['stepper_z', 'printer'])
+        identical = render(ConfigParser.from_snapshot(snapshot_file)) == render(parser)
+        snapshot_size = os.path.getsize(snapshot_file)
+        json_size = os.path.getsize(json_file)
+
+    print(f"{size} tree: {tree['files']} files, {tree['lines']:,} lines, {len(parser.sections)} sections")
+    print(f"  snapshot: {snapshot_size / 1024:8.1f} KiB written in {write_time * 1000:.1f} ms "
+          f"(JSON export {json_size / 1024:.1f} KiB)")
+    print(f"  parse, cold:           {cold * 1000:8.1f} ms")
+    print(f"  parse, warm cache:     {cached * 1000:8.1f} ms")
+    print(f"  load snapshot:         {load * 1000:8.1f} ms  ({cached / load:.1f}x faster than a cached parse)")
+    print(f"  load compressed:       {compressed_load * 1000:8.1f} ms  ({compressed_size / 1024:.1f} KiB)")
+    print(f"  load 2 sections:       {selective * 1000:8.1f} ms")
+    print(f"  identical state: {identical}")
+
+
+@cli.command('macros')
+@click.option('--macro-count', default=2000, show_default=True, help='Number of macros in the generated tree.')
+@click.option('--repeat', default=5, show_default=True, help='Repetitions per measurement; the best time is used.')
+@click.option('--configs-dir', default=BUNDLED_CONFIGS_DIR,
+              help='Directory with real configurations that are indexed as well.')
+def macros(macro_count, repeat, configs_dir):
+    """
+    Measures building the macro call graph, and updating it after a single macro changed.
+    """
+
+    for root in find_printer_roots([configs_dir]):
+        parser = parse_tree(root)
+        build = best_time(repeat, MacroIndex.build, parser.sections)
+        index = MacroIndex.build(parser.sections)
+        print(f"{os.path.relpath(root, configs_dir)}: {len(index.macros)} macros, "
+              f"{len(index.lines)} sections with gcode, built in {build * 1000:.2f} ms")
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        tree = generate_config_tree(root_dir, macro_count=macro_count)
+        parser = parse_tree(tree['root'])
+        build = best_time(repeat, MacroIndex.build, parser.sections)
+        index = MacroIndex.build(parser.sections)
+        edges = sum(len(index.calls(name)) for name in index.lines)
+
+        # Redefine one macro at the end of the root file, merge again and update the existing index. The section
+        # after it closes the gcode block, which the parser only finalizes when the next section starts.
+        with open(os.path.join(root_dir, 'printer.cfg'), 'a') as file:
+            file.write("\n[gcode_macro MACRO_1]\ngcode:\n    MACRO_2\n    M400\n[benchmark_marker]\n")
+        changed = parse_tree(tree['root'])
+        start = time.perf_counter()
+        index.update(changed.sections)
+        update = time.perf_counter() - start
+        correct = index.calls('MACRO_1') == ['gcode_macro MACRO_2'] and \
+            index.callers_of('MACRO_2') == MacroIndex.build(changed.sections).callers_of('MACRO_2')
+
+    print(f"Generated tree: {len(index.macros)} macros, {edges:,} call edges")
+    print(f"  full build:           {build * 1000:8.2f} ms")
+    print(f"  update after 1 edit:  {update * 1000:8.2f} ms  ({index.scanned} sections scanned)")
+    print(f"  update matches a full build: {correct}")
+
+
+@cli.command('gcode-history')
+@click.option('--macro-count', default=200, show_default=True, help='Number of macros in the generated tree.')
+@click.option('--macro-lines', default=60, show_default=True, help='Number of lines in every macro body.')
+@click.option('--versions', default=20, show_default=True, help='Number of times every macro is overridden.')
+def gcode_history(macro_count, macro_lines, versions):
+    """
+    Measures the memory held by gcode block history and the output size of the full and diff history modes, on a tree
+    where every macro is overridden many times with small edits.
+    """
+
+    def load(parser_class, root):
+        # Timed once without tracemalloc, which slows allocation-heavy code down, and measured once under it
+        with contextlib.redirect_stdout(None):
+            start = time.perf_counter()
+            parser_class(os.path.dirname(root)).parse_file(root)
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            parser = parser_class(os.path.dirname(root))
+            parser.parse_file(root)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        return parser, elapsed, current, peak
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        tree = generate_override_tree(root_dir, macro_count=macro_count, macro_lines=macro_lines,
+                                      version_count=versions)
+        print(f"Generated tree: {macro_count} macros of {macro_lines} lines, each overridden {versions} times, "
+              f"{tree['lines']:,} lines")
+        results = {}
+        for label, parser_class in (('full copies', FullHistoryParser), ('deltas', ConfigParser)):
+            results[label] = load(parser_class, tree['root'])
+            _, elapsed, current, peak = results[label]
+            print(f"  {label:12} parse {elapsed * 1000:8.1f} ms, retained {current / 1024 / 1024:7.2f} MiB, "
+                  f"peak {peak / 1024 / 1024:7.2f} MiB")
+
+        reference, delta_parser = results['full copies'][0], results['deltas'][0]
+        correct = all(
+            [block.lines for block in blocks] == [block.lines for block in
+                                                  delta_parser.sections[name].gcode_blocks[block_name]]
+            for name, section in reference.sections.items() for block_name, blocks in section.gcode_blocks.items())
+
+        for mode in ('full', 'diff'):
+            output_filepath = os.path.join(root_dir, f'output_{mode}.cfg')
+            elapsed, peak = measure(delta_parser.write_output, output_filepath, False, mode)
+            size = os.path.getsize(output_filepath)
+            print(f"  output {mode:4}  {size / 1024:10,.1f} KiB in {elapsed * 1000:7.1f} ms, "
+                  f"peak {peak / 1024 / 1024:6.2f} MiB")
+    print(f"  decoded history matches the full copies: {correct}")
+
+
+@cli.command('effective')
+@click.option('--size', type=click.Choice(sorted(SUITE_SIZES)), default='medium', show_default=True,
+              help='Scale of the generated configuration tree.')
+@click.option('--repeat', default=3, show_default=True, help='Repetitions per measurement; the best time is used.')
+def effective(size, repeat):
+    """
+    Compares the full-history merge with the effective-only merge: parse time, memory held by the merged state and
+    output size.
+    """
+
+    def load(effective_only, root):
+        with contextlib.redirect_stdout(None):
+            parser = ConfigParser(os.path.dirname(root), effective_only=effective_only)
+            parser.parse_file(root)
+        return parser
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        parameters = {key: value for key, value in SUITE_SIZES[size].items() if key != 'include_files'}
+        tree = generate_config_tree(root_dir, **parameters)
+        print(f"Generated tree ({size}): {tree['files']} files, {tree['lines']:,} lines")
+        parsers = {}
+        for label, effective_only in (('full history', False), ('effective', True)):
+            elapsed = best_time(repeat, load, effective_only, tree['root'])
+            tracemalloc.start()
+            parser = parsers[label] = load(effective_only, tree['root'])
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            output_filepath = os.path.join(root_dir, f'output_{effective_only}.cfg')
+            if effective_only:
+                parser.write_effective_output(output_filepath)
+            else:
+                parser.write_output(output_filepath, hide_unmodified=False)
+            print(f"  {label:12} parse {elapsed * 1000:8.1f} ms ({tree['lines'] / elapsed:12,.0f} lines/s), "
+                  f"retained {retained / 1024 / 1024:7.2f} MiB, peak {peak / 1024 / 1024:7.2f} MiB, "
+                  f"output {os.path.getsize(output_filepath) / 1024:8,.1f} KiB")
+
+        full, effective_parser = parsers['full history'], parsers['effective']
+        correct = all(
+            {key: kvp.value for key, kvp in section.key_value_pairs.items()} ==
+            {key: kvp.value for key, kvp in effective_parser.sections[name].key_value_pairs.items()} and
+            {block_name: blocks[-1].lines for block_name, blocks in section.gcode_blocks.items()} ==
+            {block_name: blocks[-1].lines
+             for block_name, blocks in effective_parser.sections[name].gcode_blocks.items()}
+            for name, section in full.sections.items())
+    print(f"  effective values match the full merge: {correct}")
+
+
+@cli.command('save-config')
+@click.option('--mesh-points', default=100, show_default=True, help='Points per axis of the saved bed mesh.')
+@click.option('--repeat', default=3, show_default=True, help='Repetitions per measurement; the best time is used.')
+def save_config(mesh_points, repeat):
+    """
+    Measures the SAVE_CONFIG model: reading a saved bed mesh into a float array, the memory it holds compared to
+    row strings and lists of floats, and mesh statistics and comparisons against the statistics module and plain
+    Python loops.
+    """
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        paths = []
+        for seed in range(2):
+            paths.append(os.path.join(root_dir, f'printer-{seed}.cfg'))
+            with open(paths[-1], 'w') as file:
+                file.write("[printer]\nkinematics: corexy\n")
+                write_save_config(file, random.Random(seed), mesh_points, mesh_points)
+        elapsed = best_time(repeat, SaveConfig.from_file, paths[0])
+        older, newer = (SaveConfig.from_file(path).meshes['bed_mesh default'] for path in paths)
+        print(f"Mesh: {mesh_points}x{mesh_points} points, read in {elapsed * 1000:.1f} ms")
+
+        def retained(build):
+            tracemalloc.start()
+            value = build()
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del value
+            return size
+
+        sizes = {'points string': retained(lambda: '\n  '.join(older.iter_row_text())),
+                 'lists of floats': retained(older.rows),
+                 'float array': retained(lambda: older.points[:])}
+        for label, size in sizes.items():
+            print(f"  {label:16} {size / 1024:10,.1f} KiB  ({size / len(older.points):5.1f} bytes per point)")
+
+        values = older.points.tolist()
+        newer_values = newer.points.tolist()
+
+        def python_stats():
+            return min(values), max(values), statistics.fmean(values), statistics.pstdev(values)
+
+        def python_compare():
+            deltas = [right - left for left, right in zip(values, newer_values)]
+            return max(abs(delta) for delta in deltas), statistics.fmean(deltas), statistics.pstdev(deltas)
+
+        for label, baseline, optimized in (('stats', python_stats, older.stats),
+                                           ('compare', python_compare, lambda: older.compare(newer))):
+            slow = best_time(repeat, baseline)
+            fast = best_time(repeat, optimized)
+            print(f"  {label:8} python {slow * 1000:8.2f} ms, array {fast * 1000:8.2f} ms  ({slow / fast:.1f}x)")
+        stats = older.stats()
+        correct = abs(stats['stdev'] - statistics.pstdev(values)) < 1e-9 and \
+            abs(older.compare(newer)['max_abs'] - python_compare()[0]) < 1e-12
+    print(f"  results match: {correct}")
+
+
+@cli.command('git-history')
+@click.option('--commits', default=100, show_default=True, help='Number of commits after the initial one.')
+@click.option('--unrelated', default=0.2, show_default=True,
+              help='Share of commits that only change a file outside of the include tree.')
+def git_history(commits, unrelated):
+    """
+    Compares the history walk, which reads git objects over one cat-file pipe and tokenizes every blob once, against
+    checking out every commit and merging it from scratch. Both must produce the same key timelines; glob matches are
+    sorted in both.
+    """
+
+    def git(repo_dir, *args):
+        subprocess.run(['git', '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@example.com', *args],
+                       cwd=repo_dir, check=True, capture_output=True)
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        tree = generate_config_tree(root_dir, include_depth=10, glob_files=20, macro_count=400, override_files=10,
+                                    overrides_per_file=50)
+        git(root_dir, 'init', '-q')
+        git(root_dir, 'add', '-A')
+        git(root_dir, 'commit', '-q', '-m', 'Initial configuration')
+        rng = random.Random(0)
+        override_dir = os.path.join(root_dir, 'overrides')
+        for index in range(commits):
+            if rng.random() < unrelated:
+                with open(os.path.join(root_dir, 'NOTES.md'), 'a') as file:
+                    file.write(f"Note {index}\n")
+                git(root_dir, 'add', 'NOTES.md')
+            else:
+                path = os.path.join(override_dir, rng.choice(sorted(os.listdir(override_dir))))
+                with open(path, 'a') as file:
+                    file.write(f"\n[extruder]\nrotation_distance: {rng.uniform(20, 25):.3f}\n")
+            git(root_dir, 'commit', '-q', '-a', '-m', f'Change {index}')
+        print(f"Repository: {commits + 1} commits of a tree with {tree['files']} files, {tree['lines']:,} lines")
+
+        start = time.perf_counter()
+        config_history = ConfigHistory(tree['root']).walk()
+        walk = time.perf_counter() - start
+        stats = config_history.stats
+        print(f"  history walk:      {walk:7.2f} s  ({stats['merged']} merges, {stats['distinct_blobs']} blobs "
+              f"tokenized, {stats['objects_read']} objects read)")
+
+        start = time.perf_counter()
+        naive_values = []
+        for commit in config_history.commits:
+            git(root_dir, 'checkout', '-q', commit['commit'])
+            parser = SortedGlobParser(root_dir, section_filter=())
+            with contextlib.redirect_stdout(None):
+                parser.parse_file(tree['root'])
+            naive_values.append({(name, key): (kvp.value, os.path.relpath(kvp.filename, root_dir))
+                                 for name, section in parser.sections.items()
+                                 for key, kvp in section.key_value_pairs.items()})
+        checkout = time.perf_counter() - start
+        print(f"  checkout + merge:  {checkout:7.2f} s  ({len(config_history.commits)} merges)  "
+              f"({checkout / walk:.1f}x slower)")
+
+        events = {(event['commit'], entry): (event.get('value'), event.get('file'))
+                  for entry, timeline in config_history.timelines.items() for event in timeline}
+        previous = {}
+        expected = {}
+        for commit, values in zip(config_history.commits, naive_values):
+            for entry in set(previous) | set(values):
+                if previous.get(entry) != values.get(entry):
+                    expected[(commit['commit'], entry)] = values.get(entry, (None, None))
+            previous = values
+    print(f"  identical timelines: {events == expected}")
+
+
+@cli.command('archives')
+@click.option('--backups', default=40, show_default=True, help='Number of backup archives, half zip and half tar.gz.')
+@click.option('--macro-count', default=400, show_default=True, help='Number of macros in every backup.')
+def archives(backups, macro_count):
+    """
+    Compares merging backups straight from their archives against extracting every archive to a temporary directory
+    and merging it from there, and measures how the audit scales with the number of worker processes. Every backup
+    changes one override file of the previous one; all approaches must agree on the merged digests.
+    """
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        tree_dir = os.path.join(work_dir, 'tree')
+        tree = generate_config_tree(tree_dir, include_depth=10, glob_files=20, macro_count=macro_count,
+                                    override_files=10, overrides_per_file=50)
+        archive_dir = os.path.join(work_dir, 'archives')
+        os.makedirs(archive_dir)
+        rng = random.Random(0)
+        override_dir = os.path.join(tree_dir, 'overrides')
+        for index in range(backups):
+            path = os.path.join(override_dir, rng.choice(sorted(os.listdir(override_dir))))
+            with open(path, 'a') as file:
+                file.write(f"\n[extruder]\nrotation_distance: {rng.uniform(20, 25):.3f}\n")
+            if index % 2:
+                with tarfile.open(os.path.join(archive_dir, f'backup_{index:03d}.tar.gz'), 'w:gz') as archive:
+                    archive.add(tree_dir, 'config')
+            else:
+                with zipfile.ZipFile(os.path.join(archive_dir, f'backup_{index:03d}.zip'), 'w',
+                                     zipfile.ZIP_DEFLATED) as archive:
+                    for directory, _, filenames in os.walk(tree_dir):
+                        for name in filenames:
+                            path = os.path.join(directory, name)
+                            archive.write(path, os.path.join('config', os.path.relpath(path, tree_dir)))
+        paths = find_archives([archive_dir])
+        size = sum(os.path.getsize(path) for path in paths)
+        print(f"{len(paths)} backups of a tree with {tree['files']} files, {tree['lines']:,} lines "
+              f"({size / 1024 / 1024:.1f} MiB of archives), {os.cpu_count()} CPUs")
+
+        start = time.perf_counter()
+        extracted_digests = []
+        for path in paths:
+            extract_dir = os.path.join(work_dir, 'extracted')
+            shutil.unpack_archive(path, extract_dir)
+            parser = SortedGlobParser(os.path.join(extract_dir, 'config'))
+            with contextlib.redirect_stdout(None):
+                parser.parse_file(os.path.join(extract_dir, 'config', 'printer.cfg'))
+            extracted_digests.append(MerkleTree(parser).digest.hex())
+            shutil.rmtree(extract_dir)
+        extract = time.perf_counter() - start
+        print(f"  extract + merge:          {extract:7.2f} s")
+
+        for share_tokens in (False, True):
+            start = time.perf_counter()
+            results = [audit_archive(path, share_tokens=share_tokens) for path in paths]
+            elapsed = time.perf_counter() - start
+            label = 'archive, shared tokens:' if share_tokens else 'archive merge:'
+            print(f"  {label:25} {elapsed:7.2f} s  ({extract / elapsed:.1f}x faster, "
+                  f"{sum(result['tokenized_files'] for result in results)} of "
+                  f"{sum(result['files'] for result in results)} files tokenized)")
+        print(f"  identical digests: {[result['digest'] for result in results] == extracted_digests}")
+
+        baseline = None
+        for jobs in sorted({1, 2, 4, os.cpu_count() or 1}):
+            start = time.perf_counter()
+            run_audit(paths, jobs=jobs, progress=None)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(f"  audit, {jobs:>3} workers: {elapsed:7.2f} s  speedup {baseline / elapsed:5.2f}x")
+
+
+@cli.command('overlay')
+@click.option('--size', type=click.Choice(sorted(SUITE_SIZES)), default='medium', show_default=True,
+              help='Size of the generated base configuration.')
+@click.option('--candidates', default=200, show_default=True, help='Number of candidate override files.')
+def overlay(size, candidates):
+    """
+    Compares evaluating candidate override files as copy-on-write overlays on one merged base against merging the
+    whole tree again with each candidate included. Both must agree on the merged digests, and the base must come out
+    of all overlays unchanged.
+    """
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        parameters = {key: value for key, value in SUITE_SIZES[size].items() if key != 'include_files'}
+        tree = generate_config_tree(root_dir, **parameters)
+        base = SortedGlobParser(root_dir)
+        with contextlib.redirect_stdout(None):
+            base.parse_file(tree['root'])
+        base_output = ''.join(base.iter_output(False))
+        print(f"Base: {tree['files']} files, {tree['lines']:,} lines, {len(base.sections)} sections; "
+              f"{candidates} candidates")
+
+        rng = random.Random(0)
+        section_names = sorted(base.sections)
+        macro_names = [name for name in section_names if base.sections[name].gcode_blocks]
+        with open(tree['root']) as file:
+            root_text = file.read()
+        marker = root_text.index(SAVE_CONFIG_PREFIX)
+        paths = []
+        for index in range(candidates):
+            path = os.path.join(root_dir, f'candidate_{index:03d}.cfg')
+            with open(path, 'w') as file:
+                for name in rng.sample(section_names, 3):
+                    file.write(f"[{name}]\n")
+                    keys = sorted(base.sections[name].key_value_pairs)
+                    for key in rng.sample(keys, min(3, len(keys))):
+                        file.write(f"{key}: {rng.uniform(0, 100):.3f}\n")
+                    file.write(f"candidate_{index}: {index}\n\n")
+                file.write(f"[{rng.choice(macro_names)}]\ngcode:\n  M117 candidate {index}\n  G28\n\n[probe]\n")
+                file.write(f"z_offset: {rng.uniform(-2, 0):.3f}\n")
+            paths.append(path)
+
+        start = time.perf_counter()
+        overlay_parsers = []
+        for path in paths:
+            overlay_parser = OverlayParser(base)
+            with contextlib.redirect_stdout(None):
+                overlay_parser.add_file(path)
+            overlay_parser.change_report()
+            overlay_parsers.append(overlay_parser)
+        overlays = time.perf_counter() - start
+        overlay_digests = [MerkleTree(overlay_parser).digest for overlay_parser in overlay_parsers]
+
+        start = time.perf_counter()
+        reference_digests = []
+        included_root = os.path.join(root_dir, 'printer_candidate.cfg')
+        for path in paths:
+            with open(included_root, 'w') as file:
+                file.write(f"{root_text[:marker]}[include {os.path.basename(path)}]\n{root_text[marker:]}")
+            parser = SortedGlobParser(root_dir)
+            with contextlib.redirect_stdout(None):
+                parser.parse_file(included_root)
+            reference_digests.append(MerkleTree(parser).digest)
+        reference = time.perf_counter() - start
+
+        print(f"  full merge per candidate: {reference:7.2f} s  ({candidates / reference:8.1f} candidates/s)")
+        print(f"  overlay + change report:  {overlays:7.2f} s  ({candidates / overlays:8.1f} candidates/s, "
+              f"{reference / overlays:.1f}x faster)")
+        print(f"  identical digests: {overlay_digests == reference_digests}")
+        print(f"  base unchanged: {''.join(base.iter_output(False)) == base_output}")
+
+
+@cli.command('text-index')
+@click.option('--printers', default=200, show_default=True, help='Number of generated printer configurations.')
+@click.option('--macro-count', default=60, show_default=True, help='Number of macros in every printer.')
+def text_index(printers, macro_count):
+    """
+    Compares searching a fleet through the text index against scanning every merged output with a regular
+    expression, and measures building the index, updating it when nothing changed and after editing one file. Regex
+    searches are checked against a scan of every indexed entry, which must give the same matches as the prefilter.
+    """
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        lines = 0
+        for printer in range(printers):
+            tree = generate_config_tree(os.path.join(work_dir, f'printer_{printer:03d}'), seed=printer, include_depth=5,
+                                        glob_files=10, macro_count=macro_count, macro_lines=20, override_files=4,
+                                        overrides_per_file=25, mesh_size=(5, 5))
+            lines += tree['lines']
+        roots = find_printer_roots([work_dir])
+        run_fleet(roots, os.path.join(work_dir, 'out'), hide_unmodified=False, use_cache=False, progress=None)
+        outputs = sorted(glob.glob(os.path.join(work_dir, 'out', '*.cfg')))
+        print(f"{len(roots)} printers, {lines:,} configuration lines, {os.cpu_count()} CPUs")
+
+        index_dir = os.path.join(work_dir, 'index')
+        start = time.perf_counter()
+        results = TextIndex(index_dir).update(roots, os.cpu_count() or 1, use_cache=False, progress=None)
+        build = time.perf_counter() - start
+        size = sum(os.path.getsize(path) for path in TextIndex(index_dir).segment_paths())
+        print(f"  build:                  {build:7.2f} s  ({sum(result['entries'] for result in results):,} entries, "
+              f"{size / 1024 / 1024:.1f} MiB)")
+        start = time.perf_counter()
+        TextIndex(index_dir).update(roots, use_cache=False, progress=None)
+        print(f"  update, nothing changed:{time.perf_counter() - start:7.2f} s")
+        override = sorted(glob.glob(os.path.join(os.path.dirname(roots[0]), 'overrides', '*.cfg')))[0]
+        with open(override, 'a') as file:
+            file.write("\n[extruder]\nrotation_distance: 22.452  # calibrated\n")
+        start = time.perf_counter()
+        results = TextIndex(index_dir).update(roots, use_cache=False, progress=None)
+        print(f"  update, one file edited:{time.perf_counter() - start:7.2f} s  "
+              f"({sum(result['status'] == 'indexed' for result in results)} printer(s) indexed again)")
+
+        queries = [('rotation_distance', None), ('probe point', None), ('stepper*', None),
+                   ('', r'MACRO_1\d VALUE=1'), ('', r'G1 X\{3\d\d')]
+        warm = TextIndex(index_dir)
+        for query, regex in queries:
+            patterns = [re.compile(r'\b' + re.escape(word.rstrip('*')) + ('' if word.endswith('*') else r'\b'),
+                                   re.IGNORECASE) for word in query.split()]
+            if regex:
+                patterns.append(re.compile(regex))
+            start = time.perf_counter()
+            scanned = 0
+            for output in outputs:
+                with open(output) as file:
+                    scanned += sum(1 for line in file if all(pattern.search(line) for pattern in patterns))
+            scan = time.perf_counter() - start
+
+            start = time.perf_counter()
+            hits = TextIndex(index_dir).search(query, regex)
+            cold = time.perf_counter() - start
+            warm.search(query, regex)
+            warm_seconds = best_time(3, warm.search, query, regex)
+            label = f"{query or regex!r}:"
+            print(f"  {label:24} scan {scan * 1000:8.1f} ms ({scanned} lines), index cold {cold * 1000:7.1f} ms, "
+                  f"warm {warm_seconds * 1000:6.2f} ms ({len(hits)} entries, {scan / warm_seconds:.0f}x faster)")
+            if regex:
+                pattern = re.compile(regex)
+                expected = [segment.hit(entry_id) for segment in map(warm.segment, warm.segment_paths())
+                            for entry_id in range(len(segment.entry_texts))
+                            if pattern.search(segment.strings[segment.entry_texts[entry_id]])]
+                print(f"    prefilter matches full scan: {hits == expected}")
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,258 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import difflib
+import hashlib
+
+from configuration_section import cached_relpath
+
+DIGEST_SIZE = 16
+
+
+def subtree_digest(entries):
+    """
+    Returns the digest of a list of (name, content) string pairs, independent of their order.
+    """
+
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for name, content in sorted(entries):
+        hasher.update(name.encode())
+        hasher.update(b'\0')
+        hasher.update(content.encode())
+        hasher.update(b'\0')
+    return hasher.digest()
+
+
+class SectionNode:
+    """A section of a MerkleTree: the digests of its key-value pairs and of its gcode blocks, and of both together."""
+
+    __slots__ = ('section', 'keys_digest', 'gcode_digest', 'digest')
+
+    def __init__(self, section):
+        """
+        Hashes the final values of a section's keys, its saved bed mesh and the last definition of each of its gcode
+        blocks.
+        """
+
+        self.section = section
+        entries = [(key, kvp.value) for key, kvp in section.key_value_pairs.items()]
+        if section.bed_mesh is not None:
+            entries.append(('points', section.bed_mesh.digest()))
+        self.keys_digest = subtree_digest(entries)
+        self.gcode_digest = subtree_digest((name, ''.join(blocks[-1].lines))
+                                           for name, blocks in section.gcode_blocks.items() if blocks)
+        self.digest = hashlib.blake2b(self.keys_digest + self.gcode_digest, digest_size=DIGEST_SIZE).digest()
+
+
+class MerkleTree:
+    """Hashes of a merged configuration arranged like the configuration itself.
+
+    The root digest covers all sections; each section digest covers a keys subtree and a gcode subtree. Two trees
+    whose root digests match are identical, and within differing trees only the sections, and within those only the
+    subtrees, whose digests differ are looked at. Only effective content is hashed (final values and last gcode
+    definitions), so moving a value to another file does not count as a change. A tree is built once per parser and
+    can be compared against any number of other trees."""
+
+    def __init__(self, parser):
+        """
+        Builds the tree for a parsed configuration.
+        """
+
+        self.base_path = parser.base_path
+        self.sections = {name: SectionNode(section) for name, section in parser.sections.items()}
+        hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        for name in sorted(self.sections):
+            hasher.update(name.encode())
+            hasher.update(b'\0')
+            hasher.update(self.sections[name].digest)
+        self.digest = hasher.digest()
+
+
+def value_record(kvp, relpath):
+    """
+    Returns the final value of a key together with the file that set it.
+    """
+
+    return {'value': kvp.value, 'file': relpath(kvp.filename)}
+
+
+def diff_keys(left_section, right_section, left_relpath, right_relpath, keys=None):
+    """
+    Returns the added, removed and changed keys between two versions of a section, optionally only among the given
+    keys.
+    """
+
+    changes = []
+    left_pairs = left_section.key_value_pairs
+    right_pairs = right_section.key_value_pairs
+    for key in left_pairs if keys is None else [key for key in keys if key in left_pairs]:
+        left_kvp = left_pairs[key]
+        right_kvp = right_pairs.get(key)
+        if right_kvp is None:
+            changes.append({'key': key, 'status': 'removed', 'left': value_record(left_kvp, left_relpath)})
+        elif right_kvp.value != left_kvp.value:
+            changes.append({'key': key, 'status': 'changed', 'left': value_record(left_kvp, left_relpath),
+                            'right': value_record(right_kvp, right_relpath)})
+    for key in right_pairs if keys is None else [key for key in keys if key in right_pairs]:
+        if key not in left_pairs:
+            changes.append({'key': key, 'status': 'added', 'right': value_record(right_pairs[key], right_relpath)})
+    change = diff_bed_mesh(left_section.bed_mesh, right_section.bed_mesh, left_relpath, right_relpath)
+    if change is not None:
+        changes.append(change)
+    return changes
+
+
+def diff_bed_mesh(left_mesh, right_mesh, left_relpath, right_relpath):
+    """
+    Returns the change of the saved bed mesh points between two versions of a section, or None when they are equal.
+    Meshes of the same shape are compared point by point.
+    """
+
+    if left_mesh is None and right_mesh is None:
+        return None
+    change = {'key': 'points'}
+    if left_mesh is not None:
+        change['left'] = {'value': left_mesh.summary(), 'file': left_relpath(left_mesh.filename)}
+    if right_mesh is not None:
+        change['right'] = {'value': right_mesh.summary(), 'file': right_relpath(right_mesh.filename)}
+    if left_mesh is None or right_mesh is None:
+        change['status'] = 'added' if left_mesh is None else 'removed'
+        return change
+    if left_mesh.digest() == right_mesh.digest():
+        return None
+    change['status'] = 'changed'
+    try:
+        change['mesh'] = left_mesh.compare(right_mesh)
+    except ValueError:
+        pass
+    return change
+
+
+def diff_gcode(left_section, right_section, left_relpath, right_relpath, names=None):
+    """
+    Returns the added, removed and changed gcode blocks between two versions of a section, optionally only among the
+    given block names, with a unified diff of the lines of each changed block.
+    """
+
+    changes = []
+    left_blocks = left_section.gcode_blocks
+    right_blocks = right_section.gcode_blocks
+    if names is None:
+        names = list(left_blocks) + [name for name in right_blocks if name not in left_blocks]
+    for name in names:
+        left = left_blocks.get(name)
+        right = right_blocks.get(name)
+        left = left[-1] if left else None
+        right = right[-1] if right else None
+        if left is not None and right is not None and left.lines == right.lines:
+            continue
+        change = {'name': name, 'status': 'changed' if left and right else 'removed' if left else 'added'}
+        if left is not None:
+            change['left_file'] = left_relpath(left.filename) if left.filename else None
+        if right is not None:
+            change['right_file'] = right_relpath(right.filename) if right.filename else None
+        change['diff'] = [line.rstrip('\n') for line in difflib.unified_diff(
+            left.lines if left else [], right.lines if right else [], lineterm='', n=1)][2:]
+        changes.append(change)
+    return changes
+
+
+def diff_trees(left, right):
+    """
+    Compares two MerkleTrees and returns a JSON-serializable report of the sections that differ, with their changed
+    keys and gcode blocks and where each value came from.
+    """
+
+    report = {'identical': left.digest == right.digest, 'sections': [], 'identical_sections': 0}
+    if report['identical']:
+        report['identical_sections'] = len(left.sections)
+        return report
+
+    left_relpath = cached_relpath(left.base_path)
+    right_relpath = cached_relpath(right.base_path)
+    for name, left_node in left.sections.items():
+        right_node = right.sections.get(name)
+        if right_node is None:
+            report['sections'].append({'section': name, 'status': 'removed',
+                                       'left_files': sorted(map(left_relpath, left_node.section.filenames))})
+            continue
+        if right_node.digest == left_node.digest:
+            report['identical_sections'] += 1
+            continue
+        change = {'section': name, 'status': 'changed', 'keys': [], 'gcode': []}
+        if right_node.keys_digest != left_node.keys_digest:
+            change['keys'] = diff_keys(left_node.section, right_node.section, left_relpath, right_relpath)
+        if right_node.gcode_digest != left_node.gcode_digest:
+            change['gcode'] = diff_gcode(left_node.section, right_node.section, left_relpath, right_relpath)
+        report['sections'].append(change)
+    for name, right_node in right.sections.items():
+        if name not in left.sections:
+            report['sections'].append({'section': name, 'status': 'added',
+                                       'right_files': sorted(map(right_relpath, right_node.section.filenames))})
+    return report
+
+
+def count_differences(left, right):
+    """
+    Returns the number of sections that differ between two MerkleTrees, comparing digests only.
+    """
+
+    if left.digest == right.digest:
+        return 0
+    differing = sum(1 for name, node in left.sections.items()
+                    if name not in right.sections or right.sections[name].digest != node.digest)
+    return differing + sum(1 for name in right.sections if name not in left.sections)
+
+
+def format_diff(report, left_label, right_label):
+    """
+    Formats a diff report for the terminal.
+    """
+
+    lines = [f"--- {left_label}", f"+++ {right_label}"]
+    markers = {'added': '+', 'removed': '-', 'changed': '~'}
+    counts = {'added': 0, 'removed': 0, 'changed': 0}
+    for change in report['sections']:
+        counts[change['status']] += 1
+        files = change.get('left_files') or change.get('right_files')
+        lines.append(f"{markers[change['status']]} [{change['section']}]"
+                     + (f"  ({', '.join(files)})" if files else ''))
+        for key_change in change.get('keys', ()):
+            marker = markers[key_change['status']]
+            left = key_change.get('left')
+            right = key_change.get('right')
+            if left and right:
+                lines.append(f"    {marker} {key_change['key']}: {left['value']} ({left['file']}) -> "
+                             f"{right['value']} ({right['file']})")
+                if 'mesh' in key_change:
+                    lines.append(f"        max difference {key_change['mesh']['max_abs']:.6f}, "
+                                 f"rms {key_change['mesh']['rms']:.6f}")
+            else:
+                record = left or right
+                lines.append(f"    {marker} {key_change['key']}: {record['value']} ({record['file']})")
+        for gcode_change in change.get('gcode', ()):
+            files = ' -> '.join(str(gcode_change[side]) for side in ('left_file', 'right_file') if side in gcode_change)
+            lines.append(f"    {markers[gcode_change['status']]} {gcode_change['name']}:  ({files})")
+            lines.extend(f"        {line}" for line in gcode_change['diff'])
+    lines.append(f"{counts['changed']} sections changed, {counts['added']} added, {counts['removed']} removed, "
+                 f"{report['identical_sections']} identical sections skipped.")
+    return '\n'.join(lines)
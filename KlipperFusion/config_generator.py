@@ -0,0 +1,391 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import random
+
+# Deterministic generators of synthetic Klipper configuration trees, used by the benchmarks and the fuzz harness. The
+# same seed and parameters always produce byte-identical trees, so results can be compared across runs and machines.
+
+HARDWARE_SECTIONS = ['stepper_x', 'stepper_y', 'stepper_z', 'stepper_z1', 'stepper_z2', 'stepper_z3', 'extruder',
+                     'heater_bed', 'printer', 'probe', 'bed_mesh', 'input_shaper', 'fan', 'heater_fan hotend_fan',
+                     'controller_fan electronics_fan', 'tmc2209 stepper_x', 'tmc2209 stepper_y', 'firmware_retraction',
+                     'z_tilt', 'quad_gantry_level', 'idle_timeout', 'safe_z_home', 'temperature_sensor chamber']
+KEY_NAMES = ['step_pin', 'dir_pin', 'enable_pin', 'microsteps', 'rotation_distance', 'endstop_pin', 'position_min',
+             'position_max', 'position_endstop', 'homing_speed', 'max_velocity', 'max_accel', 'run_current',
+             'sense_resistor', 'stealthchop_threshold', 'sensor_type', 'control', 'pid_kp', 'pid_ki', 'pid_kd',
+             'min_temp', 'max_temp', 'pwm_cycle_time', 'speed', 'horizontal_move_z', 'mesh_min', 'mesh_max']
+COMMENTS = ['Adjust for your machine', 'Measured with a caliper', 'Do not change unless you know why',
+            'Set by the calibration macro', 'TMC2209 on the Octopus board', 'Default from Klippain', 'PA8 on MCU']
+GCODE_COMMANDS = ['G28', 'G90', 'G91', 'M400', 'M83', 'G92 E0', 'M106 S255', 'M107', 'SET_VELOCITY_LIMIT ACCEL=3000',
+                  'BED_MESH_CALIBRATE', 'QUAD_GANTRY_LEVEL', 'Z_TILT_ADJUST', 'SAVE_GCODE_STATE NAME=state',
+                  'RESTORE_GCODE_STATE NAME=state MOVE=1']
+
+# Building blocks of the edge-case trees: few section and key names, so sections and keys are redefined often, and
+# values, gcode lines and odd lines that exercise comment splitting, key detection and gcode block boundaries.
+EDGE_CASE_SECTIONS = ['printer', 'extruder', 'stepper_x', 'tmc2209 stepper_x', 'heater_bed', 'probe', 'bed_mesh',
+                      'gcode_macro START_PRINT', 'gcode_macro _HOME', 'delayed_gcode LOOP', 'homing_override',
+                      'idle_timeout', 'fan']
+EDGE_CASE_KEYS = ['step_pin', 'rotation_distance', 'run_current', 'max_temp', 'description', 'color', 'pins',
+                  'variable_speed', 'z_offset']
+EDGE_CASE_GCODE_KEYS = ['gcode', 'on_error_gcode', 'release_gcode', 'variable_gcode', 'gcode_template']
+EDGE_CASE_VALUES = ['#ff0000', 'PA8 # pin', '100 ; semicolon', 'a:b:c', 'value\twith\ttabs', '', '  padded  ',
+                    '{1 + 2}', 'caf\u00e9 25\u00b0C', '[not a section]', '"quoted # hash"', '1.5', '!PB3, ^PC4']
+EDGE_CASE_GCODE = ['G28', 'M117 a: b', 'RESPOND MSG="#{x}"', '{% if params.X %}', '{% endif %}', 'G1 X10 ; move',
+                   'SET_FAN_SPEED FAN=fan SPEED=0.5 # half', '{action_respond_info("done: %s" % x)}', 'M400']
+EDGE_CASE_ODD_LINES = ['key = value', ':', 'key :value', '[section', '[include ]', ' [stepper_x]', 'gcode_macro:',
+                       '#*# not a save config line', '\t# indented comment', '; semicolon comment', 'no_separator',
+                       '[gcode_macro NO_GCODE]', '  gcode: # inline comment', 'x:y:']
+
+
+def random_value(rng):
+    """
+    Returns a plausible configuration value.
+    """
+
+    choice = rng.randrange(5)
+    if choice == 0:
+        return f"{rng.uniform(-50, 400):.3f}"
+    if choice == 1:
+        return str(rng.choice([16, 32, 64, 128, 256]))
+    if choice == 2:
+        return f"{'!' if rng.random() < 0.3 else ''}PA{rng.randrange(16)}"
+    if choice == 3:
+        return rng.choice(['True', 'False', 'pid', 'watermark', 'EPCOS 100K B57560G104F',
+                           'ATC Semitec 104NT-4-R025H42G'])
+    return f"{rng.randrange(1, 400)}, {rng.randrange(1, 400)}"
+
+
+def write_macro(file, rng, index, body_lines, macro_count):
+    """
+    Writes a [gcode_macro] section with parameters, variables and a Jinja body of roughly body_lines lines.
+    """
+
+    file.write(f"\n# Macro number {index}\n[gcode_macro MACRO_{index}]\n")
+    file.write(f"description: Synthetic macro {index}\n")
+    for variable in range(rng.randrange(1, 4)):
+        file.write(f"variable_value_{variable}: {random_value(rng)}\n")
+    file.write("gcode:\n")
+    file.write("    {% set verbose = printer[\"gcode_macro _USER_VARIABLES\"].verbose %}\n")
+    file.write("    {% set speed = params.SPEED|default(printer.toolhead.max_velocity)|float * 60 %}\n")
+    for line in range(body_lines):
+        kind = rng.randrange(10)
+        if kind == 0:
+            file.write(f"    {{% if params.STEP|default({line})|int > {rng.randrange(100)} %}}\n")
+            file.write(f"        RESPOND MSG=\"step {line} # of macro {index}\"\n")
+            file.write("    {% endif %}\n")
+        elif kind == 1:
+            file.write(f"    MACRO_{rng.randrange(macro_count)} VALUE={line}\n")
+        elif kind == 2:
+            file.write("\n")
+        elif kind == 3:
+            file.write(f"    # step {line}: move to the next probe point\n")
+        elif kind < 7:
+            file.write(f"    G1 X{{{rng.randrange(350)} + params.X|default(0)|float}} Y{rng.randrange(350)} "
+                       f"F{{speed}}\n")
+        else:
+            file.write(f"    {rng.choice(GCODE_COMMANDS)}\n")
+
+
+def write_section(file, rng, section_name, key_count, source):
+    """
+    Writes a hardware section with key_count keys, inline comments and preceding comment blocks.
+    """
+
+    file.write(f"\n## {source}: {section_name}\n[{section_name}]\n")
+    for key in rng.sample(KEY_NAMES, min(key_count, len(KEY_NAMES))):
+        if rng.random() < 0.2:
+            file.write(f"# {rng.choice(COMMENTS)}\n")
+        comment = f" # {rng.choice(COMMENTS)}" if rng.random() < 0.3 else ''
+        file.write(f"{key}: {random_value(rng)}{comment}\n")
+
+
+def write_save_config(file, rng, mesh_x, mesh_y):
+    """
+    Writes a SAVE_CONFIG tail with saved offsets, input shaper results and a mesh_x by mesh_y bed mesh.
+    """
+
+    file.write("\n#*# <---------------------- SAVE_CONFIG ---------------------->\n")
+    file.write("#*# DO NOT EDIT THIS BLOCK OR BELOW. The contents are auto-generated.\n#*#\n")
+    file.write(f"#*# [stepper_z]\n#*# position_endstop = {rng.uniform(0, 2):.3f}\n#*#\n")
+    file.write(f"#*# [input_shaper]\n#*# shaper_type_x = mzv\n#*# shaper_freq_x = {rng.uniform(30, 90):.1f}\n")
+    file.write(f"#*# shaper_type_y = ei\n#*# shaper_freq_y = {rng.uniform(30, 90):.1f}\n#*#\n")
+    file.write(f"#*# [probe]\n#*# z_offset = {rng.uniform(-2, 2):.3f}\n#*#\n")
+    file.write("#*# [bed_mesh default]\n#*# version = 1\n#*# points =\n")
+    for _ in range(mesh_y):
+        file.write("#*# \t" + ", ".join(f"{rng.gauss(0, 0.05):.6f}" for _ in range(mesh_x)) + "\n")
+    file.write(f"#*# x_count = {mesh_x}\n#*# y_count = {mesh_y}\n#*# mesh_x_pps = 2\n#*# mesh_y_pps = 2\n")
+    file.write("#*# algo = bicubic\n#*# tension = 0.2\n#*# min_x = 10.0\n#*# max_x = 340.0\n")
+    file.write("#*# min_y = 10.0\n#*# max_y = 340.0\n")
+
+
+def generate_config_tree(root_dir, seed=0, include_depth=20, glob_files=50, macro_count=2000, macro_lines=40,
+                         override_files=10, overrides_per_file=200, mesh_size=(20, 20)):
+    """
+    Writes a realistic synthetic Klipper configuration tree into root_dir and returns a dictionary describing it,
+    including the path of its root printer.cfg and its total number of files, lines and bytes.
+
+    The tree contains a chain of include_depth nested includes, a glob include over glob_files macro files holding
+    macro_count [gcode_macro] sections with Jinja bodies of about macro_lines lines, override_files override files
+    reached through a second glob include that each redefine overrides_per_file keys, and a SAVE_CONFIG tail with a
+    bed mesh of mesh_size points.
+    """
+
+    rng = random.Random(seed)
+    for directory in ('chain', 'macros', 'overrides'):
+        os.makedirs(os.path.join(root_dir, directory), exist_ok=True)
+
+    for level in range(include_depth):
+        with open(os.path.join(root_dir, 'chain', f'level_{level}.cfg'), 'w') as file:
+            if level + 1 < include_depth:
+                file.write(f"[include level_{level + 1}.cfg]\n")
+            for section in rng.sample(HARDWARE_SECTIONS, 3):
+                write_section(file, rng, section, rng.randrange(4, 12), f'chain level {level}')
+
+    for index in range(glob_files):
+        with open(os.path.join(root_dir, 'macros', f'macros_{index:03d}.cfg'), 'w') as file:
+            for macro in range(index, macro_count, glob_files):
+                write_macro(file, rng, macro, macro_lines, macro_count)
+
+    for index in range(override_files):
+        with open(os.path.join(root_dir, 'overrides', f'override_{index:02d}.cfg'), 'w') as file:
+            for _ in range(overrides_per_file // 5):
+                write_section(file, rng, rng.choice(HARDWARE_SECTIONS), 5, f'override {index}')
+            # Redefine a few macro bodies, producing gcode block history
+            for _ in range(max(1, macro_count // 100)):
+                write_macro(file, rng, rng.randrange(macro_count), macro_lines // 2, macro_count)
+
+    root = os.path.join(root_dir, 'printer.cfg')
+    with open(root, 'w') as file:
+        file.write("# Synthetic printer configuration\n[include chain/level_0.cfg]\n[include macros/*.cfg]\n")
+        for section in HARDWARE_SECTIONS:
+            write_section(file, rng, section, 8, 'printer.cfg')
+        file.write("[include overrides/*.cfg]\n")
+        write_save_config(file, rng, *mesh_size)
+
+    return describe_tree(root_dir, root)
+
+
+def generate_override_tree(root_dir, seed=0, macro_count=200, macro_lines=60, version_count=20, edits_per_version=2):
+    """
+    Writes a tree where printer.cfg includes a file of macro_count macros followed by version_count override files
+    that each redefine every macro with a copy of its previous body in which edits_per_version lines changed, the way
+    users override the macros of a configuration bundle. Returns a dictionary describing the tree. Used to measure
+    the cost of gcode block history.
+    """
+
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(root_dir, 'overrides'), exist_ok=True)
+    bodies = [[f"    {rng.choice(GCODE_COMMANDS)}" for _ in range(macro_lines)] for _ in range(macro_count)]
+
+    def write_macros(path):
+        with open(path, 'w') as file:
+            for index, body in enumerate(bodies):
+                file.write(f"\n[gcode_macro MACRO_{index}]\ngcode:\n")
+                file.write("\n".join(body) + "\n")
+
+    write_macros(os.path.join(root_dir, 'macros.cfg'))
+    for version in range(version_count):
+        for body in bodies:
+            for _ in range(edits_per_version):
+                text = f"    G1 X{rng.randrange(350)} Y{rng.randrange(350)} ; v{version + 1}"
+                body[rng.randrange(macro_lines)] = text
+        write_macros(os.path.join(root_dir, 'overrides', f'override_{version:03d}.cfg'))
+
+    root = os.path.join(root_dir, 'printer.cfg')
+    with open(root, 'w') as file:
+        file.write("[include macros.cfg]\n")
+        for version in range(version_count):
+            file.write(f"[include overrides/override_{version:03d}.cfg]\n")
+        # The parser only finalizes a gcode block when the next section starts
+        file.write("[printer]\nkinematics: corexy\n")
+    return describe_tree(root_dir, root)
+
+
+def generate_include_tree(root_dir, file_count, fan_out=4, sections_per_file=5, keys_per_section=8):
+    """
+    Writes a tree of file_count small configuration files where every file includes up to fan_out children, and
+    returns a dictionary describing it. Used to measure the cost of include handling itself.
+    """
+
+    for index in range(file_count):
+        name = 'printer.cfg' if index == 0 else f'part_{index}.cfg'
+        with open(os.path.join(root_dir, name), 'w') as file:
+            for child in range(index * fan_out + 1, min(index * fan_out + fan_out + 1, file_count)):
+                file.write(f"[include part_{child}.cfg]\n")
+            for section in range(sections_per_file):
+                file.write(f"\n# Section {section} of file {index}\n[section_{section % 7}_{index % 3}]\n")
+                for key in range(keys_per_section):
+                    file.write(f"key_{key}: {index}.{section}.{key}  # set in {name}\n")
+            file.write("\n[gcode_macro MACRO_%d]\ngcode:\n    G28\n    M400\n" % (index % 11))
+    return describe_tree(root_dir, os.path.join(root_dir, 'printer.cfg'))
+
+
+def generate_glob_tree(root_dir, file_count, prefix_digits=2):
+    """
+    Writes a tree of file_count small files in a single directory that printer.cfg includes through many glob patterns
+    (one per prefix of prefix_digits digits), while every file includes the same 'common/*.cfg' pattern again.
+    Returns a dictionary describing the tree. Used to measure glob expansion on pathological include trees.
+    """
+
+    parts_dir = os.path.join(root_dir, 'parts')
+    common_dir = os.path.join(root_dir, 'common')
+    os.makedirs(parts_dir, exist_ok=True)
+    os.makedirs(common_dir, exist_ok=True)
+    width = len(str(file_count - 1))
+    with open(os.path.join(common_dir, 'common.cfg'), 'w') as file:
+        file.write("[common]\nshared: 1\n")
+    for index in range(file_count):
+        with open(os.path.join(parts_dir, f'part_{index:0{width}d}.cfg'), 'w') as file:
+            file.write(f"[include ../common/*.cfg]\n[part_{index % 97}]\nkey_{index}: {index}\n")
+    with open(os.path.join(root_dir, 'printer.cfg'), 'w') as file:
+        for prefix in range(10 ** min(prefix_digits, width)):
+            file.write(f"[include parts/part_{prefix:0{min(prefix_digits, width)}d}*.cfg]\n")
+        file.write("[printer]\nkinematics: corexy\n")
+    return describe_tree(root_dir, os.path.join(root_dir, 'printer.cfg'))
+
+
+def edge_case_lines(rng, line_count):
+    """
+    Returns up to line_count random lines, without line endings, of section headers, keys, multi-line values,
+    comments, blank lines, gcode blocks and odd lines.
+    """
+
+    lines = []
+    while len(lines) < line_count:
+        choice = rng.randrange(12)
+        if choice < 2:
+            comment = f"  # {rng.choice(COMMENTS)}" if rng.random() < 0.2 else ''
+            lines.append(f"[{rng.choice(EDGE_CASE_SECTIONS)}]{comment}")
+        elif choice < 5:
+            separator = rng.choice([': ', ':', ':\t', ' : ', ': '])
+            comment = rng.choice(['', '', ' # ' + rng.choice(COMMENTS), '\t#tab comment', '#'])
+            lines.append(f"{rng.choice(EDGE_CASE_KEYS)}{separator}{rng.choice(EDGE_CASE_VALUES)}{comment}")
+        elif choice == 5:
+            lines.append(f"{rng.choice(EDGE_CASE_KEYS)}:")
+            lines.extend(rng.choice(['  ', '\t']) + random_value(rng) for _ in range(rng.randrange(1, 4)))
+        elif choice == 6:
+            lines.append(f"{rng.choice(['# ', '#', '; ', '  # '])}{rng.choice(COMMENTS)}")
+        elif choice == 7:
+            lines.append(rng.choice(['', '', '   ', '\t', ' \t ']))
+        elif choice < 10:
+            lines.append(f"{rng.choice(EDGE_CASE_GCODE_KEYS)}:{rng.choice(['', '', ' # body', '  '])}")
+            for _ in range(rng.randrange(0, 7)):
+                kind = rng.randrange(6)
+                if kind == 0:
+                    lines.append(rng.choice(['', '  ', '\t']))
+                elif kind == 1:
+                    lines.append(f"{rng.choice(['  ', '    '])}# step {rng.randrange(10)}")
+                elif kind == 2:
+                    lines.append(rng.choice(EDGE_CASE_GCODE))
+                else:
+                    lines.append(rng.choice(['  ', '    ', '\t', '\t  ']) + rng.choice(EDGE_CASE_GCODE))
+        else:
+            lines.append(rng.choice(EDGE_CASE_ODD_LINES))
+    return lines
+
+
+def generate_edge_case_files(seed=0, max_files=6, max_lines=30):
+    """
+    Returns the files of a small random configuration tree full of edge cases as a dictionary of relative path to
+    text, with 'printer.cfg' as the root. Files include each other through nested relative includes and glob
+    patterns, including missing files, patterns without matches, files included twice and circular includes. Files
+    use LF, CRLF or mixed line endings and may lack a final newline; the root may end with a SAVE_CONFIG block,
+    sometimes followed by lines that were added after it.
+    """
+
+    rng = random.Random(seed)
+    directories = ['', 'sub/', 'sub/deep/', 'glob/']
+    parts = [f"{rng.choice(directories)}part_{index}.cfg" for index in range(rng.randrange(max_files))]
+    paths = ['printer.cfg'] + parts
+    lines = {path: edge_case_lines(rng, rng.randrange(1, max_lines)) for path in paths}
+
+    def include(parent, target):
+        relative = os.path.relpath(target, os.path.dirname(parent) or '.').replace(os.sep, '/')
+        position = rng.randrange(len(lines[parent]) + 1)
+        lines[parent].insert(position, f"[include {relative}]{rng.choice(['', '', '  # include', ' '])}")
+
+    globbed = False
+    for position, path in enumerate(paths[1:], 1):
+        parent = rng.choice(paths[:position])
+        if path.startswith('glob/') and not parent.startswith('glob/'):
+            if not globbed or rng.random() < 0.3:
+                include(parent, 'glob/*.cfg')
+                globbed = True
+        else:
+            include(parent, path)
+    for _ in range(rng.randrange(3)):
+        parent = rng.choice(paths)
+        include(parent, rng.choice(paths + ['missing.cfg', 'sub/missing_*.cfg', 'sub/*.cfg', 'sub/deep/*.cfg']))
+
+    if rng.random() < 0.3:
+        lines['printer.cfg'].extend([
+            '#*# <---------------------- SAVE_CONFIG ---------------------->',
+            '#*# DO NOT EDIT THIS BLOCK OR BELOW. The contents are auto-generated.', '#*#',
+            f'#*# [{rng.choice(EDGE_CASE_SECTIONS)}]', f'#*# {rng.choice(EDGE_CASE_KEYS)} = {random_value(rng)}'])
+        if rng.random() < 0.5:
+            lines['printer.cfg'].extend([
+                '#*#', '#*# [bed_mesh default]', '#*# version = 1', '#*# points =', '#*# \t0.1, 0.2', '#*# \t0.0, -0.1',
+                '#*# x_count = 2', '#*# y_count = 2', '#*# min_x = 10.0', '#*# max_x = 300.0', '#*# min_y = 10.0',
+                '#*# max_y = 300.0'])
+        if rng.random() < 0.2:
+            lines['printer.cfg'].extend(edge_case_lines(rng, rng.randrange(1, 4)))
+
+    files = {}
+    for path, file_lines in lines.items():
+        crlf_share = rng.choice([0.0, 0.0, 0.0, 1.0, 0.5])  # LF, CRLF or mixed line endings
+        endings = ['\r\n' if rng.random() < crlf_share else '\n' for _ in file_lines]
+        text = ''.join(line + ending for line, ending in zip(file_lines, endings))
+        if text and rng.random() < 0.2:
+            text = text[:-len(endings[-1])]
+        files[path] = text
+    return files
+
+
+def write_config_files(root_dir, files):
+    """
+    Writes a dictionary of relative path to text, as returned by generate_edge_case_files, below root_dir. Line
+    endings are written as they are.
+    """
+
+    for path, text in files.items():
+        filepath = os.path.join(root_dir, *path.split('/'))
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'w', encoding='utf-8', newline='') as file:
+            file.write(text)
+
+
+def describe_tree(root_dir, root):
+    """
+    Counts the files, lines and bytes of a generated tree.
+    """
+
+    files = lines = size = 0
+    for directory, _, filenames in os.walk(root_dir):
+        for filename in filenames:
+            if filename.endswith('.cfg'):
+                with open(os.path.join(directory, filename), 'rb') as file:
+                    data = file.read()
+                files += 1
+                lines += data.count(b'\n')
+                size += len(data)
+    return {'root': root, 'files': files, 'lines': lines, 'bytes': size}
@@ -0,0 +1,226 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+
+from configuration_section import cached_relpath
+from file_table import FILE_TABLE, filename_of
+
+
+def parse_selector(selector):
+    """
+    Splits a 'SECTION.KEY' selector into (section, key). Section names may contain dots, keys do not, so the selector
+    is split at its last dot; a selector without a dot names a whole section and yields (section, None).
+    """
+
+    section_name, separator, key = selector.rpartition('.')
+    if not separator:
+        return selector.strip(), None
+    return section_name.strip(), key.strip()
+
+
+class ConfigIndex:
+    """Lookup tables that are filled while a configuration is parsed, so questions about single keys can be answered
+    without generating the merged output.
+
+    Pass an instance to ConfigParser as index. It records every section as it is created and every key-value pair as
+    it is set: which keys a section has, which sections define a key and which entries each file sets. The value
+    provenance chain of a key is its occurrence history, kept by KeyValuePair itself."""
+
+    def __init__(self):
+        """
+        Initializes empty lookup tables.
+        """
+
+        self.sections = {}  # Section name -> ConfigurationSection
+        self.key_sections = {}  # Key -> names of the sections defining it, in the order they were first set
+        self.file_entries = {}  # File ID -> (section name, key) of every value the file sets, in file order
+
+    def add_section(self, section):
+        """
+        Records a newly created section.
+        """
+
+        self.sections[section.name] = section
+
+    def add_entry(self, section_name, key, file_id, is_new_key):
+        """
+        Records that the file with file_id set key in section_name. is_new_key tells whether the section did not
+        define the key before.
+        """
+
+        if is_new_key:
+            section_names = self.key_sections.get(key)
+            if section_names is None:
+                self.key_sections[key] = [section_name]
+            else:
+                section_names.append(section_name)
+        entries = self.file_entries.get(file_id)
+        if entries is None:
+            self.file_entries[file_id] = [(section_name, key)]
+        else:
+            entries.append((section_name, key))
+
+    def section(self, section_name):
+        """
+        Returns the named ConfigurationSection, or None if no file defines it.
+        """
+
+        return self.sections.get(section_name)
+
+    def keys(self, section_name):
+        """
+        Returns the keys of a section in the order they were first set, or an empty list for unknown sections.
+        """
+
+        section = self.sections.get(section_name)
+        return list(section.key_value_pairs) if section is not None else []
+
+    def get(self, section_name, key):
+        """
+        Returns the KeyValuePair of key in section_name, or None if it is not set.
+        """
+
+        section = self.sections.get(section_name)
+        return section.key_value_pairs.get(key) if section is not None else None
+
+    def value(self, section_name, key, default=None):
+        """
+        Returns the final value of key in section_name, or default if it is not set.
+        """
+
+        kvp = self.get(section_name, key)
+        return kvp.value if kvp is not None else default
+
+    def gcode(self, section_name, block_name):
+        """
+        Returns the lines of the last definition of a gcode block, or None if it is not defined or was skipped by the
+        parser's section filter.
+        """
+
+        section = self.sections.get(section_name)
+        blocks = section.gcode_blocks.get(block_name) if section is not None else None
+        return blocks[-1].lines if blocks else None
+
+    def provenance(self, section_name, key):
+        """
+        Returns the value chain of key in section_name, oldest first, as (filename, value) tuples. The last tuple is
+        the final value. Unknown keys yield an empty list.
+        """
+
+        kvp = self.get(section_name, key)
+        if kvp is None:
+            return []
+        chain = [(filename_of(occurrence[0]), occurrence[1]) for occurrence in kvp.occurrences]
+        chain.append((kvp.filename, kvp.value))
+        return chain
+
+    def last_set_by(self, section_name, key):
+        """
+        Returns the file that set the final value of key in section_name, or None if it is not set.
+        """
+
+        kvp = self.get(section_name, key)
+        return kvp.filename if kvp is not None else None
+
+    def sections_with_key(self, key):
+        """
+        Returns the names of all sections that define key.
+        """
+
+        return list(self.key_sections.get(key, ()))
+
+    def entries_from_file(self, filename):
+        """
+        Returns the (section name, key) of every value filename sets, in file order. A key the file sets more than
+        once, or sets again because the file is included twice, is returned once.
+        """
+
+        file_id = FILE_TABLE.ids.get(filename)
+        return list(dict.fromkeys(self.file_entries.get(file_id, ()))) if file_id is not None else []
+
+
+def query_selector(index, selector, base_path=None):
+    """
+    Answers a 'SECTION.KEY' or 'SECTION' selector from an index and returns a JSON-serializable dictionary, or None
+    when nothing matches. File names are made relative to base_path when it is given.
+
+    A key-value pair yields its final value, the file that set it and its value history. A gcode block (for example
+    'gcode_macro PRINT_START.gcode') yields the lines of its last definition, the points of a saved bed mesh (for
+    example 'bed_mesh default.points') yield their statistics and rows, and a section yields all of its keys.
+    """
+
+    relpath = cached_relpath(base_path) if base_path else str
+    section_name, key = parse_selector(selector)
+    section = index.section(section_name)
+    if section is None:
+        return None
+    if key is None:
+        return {'selector': selector, 'section': section_name,
+                'files': sorted(relpath(filename) for filename in section.filenames),
+                'keys': {key: kvp.value for key, kvp in section.key_value_pairs.items()}}
+
+    kvp = index.get(section_name, key)
+    if kvp is not None:
+        return {'selector': selector, 'section': section_name, 'key': key, 'value': kvp.value,
+                'file': relpath(kvp.filename),
+                'history': [{'file': relpath(filename), 'value': value}
+                            for filename, value in index.provenance(section_name, key)]}
+
+    if key == 'points' and section.bed_mesh is not None:
+        mesh = section.bed_mesh
+        return {'selector': selector, 'section': section_name, 'key': key, 'value': mesh.summary(),
+                'file': relpath(mesh.filename), 'history': [{'file': relpath(mesh.filename), 'value': mesh.summary()}],
+                'mesh': mesh.stats(), 'points': mesh.rows()}
+
+    lines = index.gcode(section_name, key)
+    if lines is not None:
+        return {'selector': selector, 'section': section_name, 'key': key,
+                'gcode': [line.rstrip('\n') for line in lines]}
+    return None
+
+
+def answer_queries(index, selectors=(), keys=(), files=(), base_path=None):
+    """
+    Answers selectors, keys to look up in every section and files whose entries are listed. Returns the list of
+    answers and the list of questions nothing was found for. Files are resolved relative to base_path.
+    """
+
+    answers = []
+    missing = []
+    for selector in selectors:
+        result = query_selector(index, selector, base_path)
+        if result is None:
+            missing.append(selector)
+        else:
+            answers.append(result)
+    for key in keys:
+        section_names = index.sections_with_key(key)
+        if not section_names:
+            missing.append(f"--key {key}")
+        answers.extend(query_selector(index, f"{section_name}.{key}", base_path) for section_name in section_names)
+    for file in files:
+        entries = index.entries_from_file(os.path.normpath(os.path.join(base_path or '', file)))
+        if not entries:
+            missing.append(f"--file {file}")
+        answers.extend(query_selector(index, f"{section_name}.{key}", base_path) for section_name, key in entries)
+    return answers, missing
@@ -0,0 +1,76 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from source_reader import split_lines
+
+# Token kinds produced by the lexer. Tokens are plain tuples whose first element is the kind, which keeps them cheap
+# to build, compare and pickle into the parse cache.
+TOKEN_SECTION = 0  # (TOKEN_SECTION, trimmed_command)
+TOKEN_INCLUDE = 1  # (TOKEN_INCLUDE, trimmed_command)
+TOKEN_GCODE_START = 2  # (TOKEN_GCODE_START, trimmed_command)
+TOKEN_LINE = 3  # (TOKEN_LINE, raw_line, key_value_command or None, comment or None)
+
+# Bump whenever the token layout changes so that stale cache entries are ignored.
+TOKEN_FORMAT_VERSION = 1
+
+# Commands ending with ':' that nevertheless do not open a gcode block.
+NON_GCODE_BLOCK_PREFIXES = ('[include ', '[gcode_macro ')
+
+
+def tokenize_text(text):
+    """
+    Classifies every line of a configuration file in a single pass and returns the list of tokens.
+
+    This produces exactly the tokens ConfigParser.tokenize_line produces line by line, but strips each line only
+    once, looks for the comment marker only once and branches on the first character instead of re-checking the
+    trimmed line with several startswith calls. Lines are split with split_lines, like iterating over a text file.
+    Only ':' separates keys from values, as in the line-by-line parser.
+    """
+
+    tokens = []
+    append = tokens.append
+    for line in split_lines(text):
+        stripped = line.strip()
+        if not stripped:
+            append((TOKEN_LINE, line, None, None))
+            continue
+
+        first_char = stripped[0]
+        if first_char == '#':
+            append((TOKEN_LINE, line, None, stripped[1:].strip()))
+            continue
+
+        comment_start = stripped.find('#')
+        if comment_start < 0:
+            command = stripped
+            comment = None
+        else:
+            command = stripped[:comment_start].rstrip()
+            comment = stripped[comment_start + 1:].strip()
+
+        if command[-1] == ':' and not command.startswith(NON_GCODE_BLOCK_PREFIXES):
+            append((TOKEN_GCODE_START, command))
+        elif first_char == '[':
+            append((TOKEN_INCLUDE if command.startswith('[include ') else TOKEN_SECTION, command))
+        else:
+            append((TOKEN_LINE, line, command if ':' in command else None, comment))
+    return tokens
@@ -0,0 +1,297 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+
+from config_diff import diff_gcode, diff_keys
+from config_parser import ConfigParser
+from configuration_section import ConfigurationSection, cached_relpath
+from gcode_block import GCodeBlock
+
+# "What-if" evaluation of candidate override files. An overlay layers extra files on top of an already merged base
+# configuration without parsing the base again and without changing it: the overlay starts out sharing every section
+# of the base, and a section, key-value pair or gcode block list is only copied when an overlay file writes to it.
+# Evaluating a candidate therefore costs about as much as parsing the candidate itself.
+
+
+class OverlaySection(ConfigurationSection):
+    """Copy-on-write copy of a section of a base configuration. The key-value pairs and gcode block lists are shared
+    with the base section until they are written to; owned_keys and owned_blocks name the ones that were copied or
+    added, in the order the overlay first wrote to them."""
+
+    __slots__ = ('owned_keys', 'owned_blocks')
+
+    def __init__(self, base):
+        """
+        Initializes a copy of base that shares its key-value pairs, gcode blocks and bed mesh.
+        """
+
+        super().__init__(base.name, base.filename)
+        # Replaying the file inserts in their original order rebuilds a set that iterates like the base's
+        for filename in base.file_order[1:]:
+            self.add_file(filename)
+        self.key_value_pairs = dict(base.key_value_pairs)
+        self.gcode_blocks = dict(base.gcode_blocks)
+        self.bed_mesh = base.bed_mesh
+        self.owned_keys = {}
+        self.owned_blocks = {}
+
+    def own_key(self, key):
+        """
+        Copies the key-value pair of key before it is written to, unless the overlay already owns it.
+        """
+
+        if key not in self.owned_keys:
+            self.owned_keys[key] = None
+            kvp = self.key_value_pairs.get(key)
+            if kvp is not None:
+                self.key_value_pairs[key] = kvp.copy()
+
+    def own_block(self, block_name):
+        """
+        Copies the block list of block_name before a version is appended, unless the overlay already owns it. Adding
+        a version turns the latest one into a delta against the new one, so the base's latest version is replaced by
+        a copy that can be encoded; the older versions are shared and still decode through the base's version.
+        """
+
+        if block_name not in self.owned_blocks:
+            self.owned_blocks[block_name] = None
+            blocks = self.gcode_blocks.get(block_name)
+            if blocks:
+                latest = blocks[-1]
+                copy = GCodeBlock(latest.name, latest.filename)
+                copy.lines = list(latest.lines)
+                copy.preceding_comments = latest.preceding_comments
+                copy.older_versions = latest.older_versions
+                self.gcode_blocks[block_name] = blocks[:-1] + [copy]
+
+    def remove_save_config(self, filename, keys, file_added, added_keys, keep_values=False):
+        """
+        Takes the values a SAVE_CONFIG block of filename wrote to keys off this section, restoring the state the
+        section had before the block: keys the block added are removed, the others get their previous value back,
+        and filename is dropped from the section's files when the block added it. With keep_values the saved values
+        of existing keys are kept, for parsers that store no value history.
+        """
+
+        if file_added:
+            order = self.file_order[:-1]
+            self.filenames = set()
+            self.file_order = []
+            for name in order:
+                self.add_file(name)
+        for key in keys:
+            if key in added_keys:
+                self.owned_keys[key] = None
+                self.key_value_pairs.pop(key, None)
+            elif not keep_values and key in self.key_value_pairs:
+                self.own_key(key)
+                kvp = self.key_value_pairs[key]
+                if kvp.occurrences:
+                    kvp.file_id, kvp.value, kvp.inline_comment, kvp.preceding_comments = kvp.occurrences.pop()
+                    if not kvp.occurrences:
+                        kvp.occurrences = ()
+        self.bed_mesh = None
+
+    def add_gcode_block(self, block_name, gcode_lines, preceding_comments=None, filename=''):
+        self.own_block(block_name)
+        super().add_gcode_block(block_name, gcode_lines, preceding_comments, filename)
+
+    def set_gcode_block(self, block_name, gcode_lines, filename=''):
+        self.owned_blocks[block_name] = None
+        super().set_gcode_block(block_name, gcode_lines, filename)
+
+    def set_key_value(self, key, filename, value):
+        self.own_key(key)
+        super().set_key_value(key, filename, value)
+
+    def add_key_value_pair(self, key, filename, value, inline_comment, preceding_comments):
+        self.own_key(key)
+        super().add_key_value_pair(key, filename, value, inline_comment, preceding_comments)
+
+
+class OverlayParser(ConfigParser):
+    """Layers overlay files on top of the merged state of a base parser without changing it.
+
+    Overlay files are parsed as if the base's root file included them after everything else, before its SAVE_CONFIG
+    block. Their includes are followed, and the first overlay continues the section the root file ended in. An
+    overlay cannot start a SAVE_CONFIG block of its own. The SAVE_CONFIG block stays the last layer, as it is in
+    Klipper: its values still win, and the sections and keys it added come after those the overlays add. Like at the
+    end of a merge, a gcode block that is still open at the end of the last overlay is dropped. Sections the overlay
+    writes to are replaced by OverlaySections, all other sections are shared with the base."""
+
+    def __init__(self, base):
+        """
+        Initializes an overlay on top of the merged state of base, using its parse cache, content store, file source
+        and storage options.
+        """
+
+        super().__init__(base.base_path, base.cache, base.content_store, section_filter=base.section_filter,
+                         effective_only=base.effective_only, file_source=base.file_source)
+        self.base = base
+        self.sections = dict(base.sections)
+        self.save_config = base.save_config
+        # Sections the SAVE_CONFIG block created are taken out until finish puts them back after the overlays' ones
+        for name, (is_new_section, _, _) in base.save_config_layer.items():
+            if is_new_section:
+                self.sections.pop(name, None)
+        self.touched_sections = {}  # Names of the sections the overlay wrote to, in order
+        self.finished = False
+        # Overlays are parsed as includes of the base's root, which keeps them from being read as root files
+        self.parent = base.include_graph.root or os.path.join(base.base_path, 'printer.cfg')
+        self.include_graph.add_edge(self.parent)
+        self.include_graph.enter(self.parent)
+        # Continue where the root file stopped: keys before the first section header of an overlay belong to the
+        # section the root ended in and get the comments it ended with, and a gcode block that was still open there
+        # ends when the first overlay starts
+        self.preceding_comments = list(base.root_end_comments)
+        if base.root_end_section is not None and base.sections.get(base.root_end_section.name) is base.root_end_section:
+            self.current_section = self.own_section(base.root_end_section.name)
+            self.in_gcode_block = base.in_gcode_block
+            self.gcode_block_name = base.gcode_block_name
+            self.gcode_block_filename = base.gcode_block_filename
+            self.gcode_block_lines = list(base.gcode_block_lines)
+
+    def add_file(self, filepath):
+        """
+        Parses an overlay file, following its includes.
+        """
+
+        if self.finished:
+            raise ValueError("Overlay files cannot be added to a finished overlay.")
+        self.end_gcode_block()
+        self.parse_file(filepath, self.base_path)
+        return self
+
+    def add_text(self, text, filename=None):
+        """
+        Parses the text of an overlay that does not exist as a file. Includes are resolved relative to filename,
+        which defaults to 'overlay.cfg' in the base path.
+        """
+
+        if self.finished:
+            raise ValueError("Overlay files cannot be added to a finished overlay.")
+        filename = self.normalize_path(filename or 'overlay.cfg')
+        self.end_gcode_block()
+        self.include_graph.add_edge(filename)
+        self.include_graph.enter(filename)
+        try:
+            self.replay_tokens(self.tokenize_text(text), filename, os.path.dirname(filename))
+        finally:
+            self.include_graph.leave(filename)
+        return self
+
+    def end_gcode_block(self):
+        """
+        Ends a gcode block that is still open before the next overlay starts, like the include directive the overlay
+        stands for does.
+        """
+
+        if self.in_gcode_block:
+            self.finalize_gcode_block()
+
+    def own_section(self, name):
+        """
+        Returns the section called name, replacing a section shared with the base by an OverlaySection first. Returns
+        None when neither the base nor the overlay has the section.
+        """
+
+        if name not in self.touched_sections:
+            self.touched_sections[name] = None
+            base_section = self.sections.get(name)
+            if base_section is not None:
+                section = self.sections[name] = OverlaySection(base_section)
+                layer = self.base.save_config_layer.get(name)
+                if layer is not None:
+                    section.remove_save_config(self.save_config.filename, self.save_config.sections[name], *layer[1:],
+                                               keep_values=self.effective_only)
+        return self.sections.get(name)
+
+    def start_new_section(self, name, filename):
+        self.own_section(name)
+        super().start_new_section(name, filename)
+
+    def finish(self):
+        """
+        Completes the overlay once all overlay files are added: applies the base's SAVE_CONFIG block again on top of
+        the sections the overlay wrote to. The sections the block created and the overlay did not write to are put back
+        after the overlay's sections.
+        """
+
+        if self.finished:
+            return self
+        self.include_graph.leave(self.parent)
+        if self.save_config is not None:
+            filename = self.save_config.filename
+            for name, keys in self.save_config.sections.items():
+                if name not in self.sections:
+                    if name in self.base.sections:
+                        self.sections[name] = self.base.sections[name]
+                    continue
+                if name not in self.touched_sections:
+                    continue
+                self.start_new_section(name, filename)
+                self.preceding_comments = []
+                for key, value in keys.items():
+                    self.handle_key_value_pair(f"{key}: {value}", filename, '')
+                mesh = self.save_config.meshes.get(name)
+                if mesh is not None:
+                    self.current_section.bed_mesh = mesh
+        self.current_section = None
+        self.finished = True
+        return self
+
+    def change_report(self):
+        """
+        Returns what the overlay changed in the effective configuration of the base, in the format of diff_trees.
+        Only the sections, keys and gcode blocks the overlay wrote to are compared.
+        """
+
+        self.finish()
+        relpath = cached_relpath(self.base_path)
+        report = {'identical': True, 'sections': [], 'identical_sections': len(self.base.sections)}
+        for name in self.touched_sections:
+            section = self.sections[name]
+            base_section = self.base.sections.get(name)
+            if base_section is None:
+                report['sections'].append({'section': name, 'status': 'added',
+                                           'right_files': sorted(map(relpath, section.filenames))})
+                continue
+            # A section the SAVE_CONFIG block created is created again by the overlay and compared as a whole
+            keys = diff_keys(base_section, section, relpath, relpath, getattr(section, 'owned_keys', None))
+            gcode = diff_gcode(base_section, section, relpath, relpath, getattr(section, 'owned_blocks', None))
+            if keys or gcode:
+                report['sections'].append({'section': name, 'status': 'changed', 'keys': keys, 'gcode': gcode})
+                report['identical_sections'] -= 1
+        report['identical'] = not report['sections']
+        return report
+
+
+def apply_overlays(base, overlay_paths):
+    """
+    Layers the given overlay files on top of a merged base parser, in order, and returns the finished
+    OverlayParser. The base is not changed.
+    """
+
+    overlay = OverlayParser(base)
+    for path in overlay_paths:
+        overlay.add_file(path)
+    return overlay.finish()
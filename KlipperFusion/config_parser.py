@@ -20,10 +20,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import io
 import os
-from configuration_section import ConfigurationSection
+from config_lexer import (NON_GCODE_BLOCK_PREFIXES, TOKEN_GCODE_START, TOKEN_INCLUDE, TOKEN_LINE, TOKEN_SECTION,
+                          tokenize_text)
+from configuration_section import ConfigurationSection, cached_relpath
+from file_table import intern_filename
 from gcode_macro import GCodeMacro
-import glob
+from include_graph import GlobCache, IncludeGraph, format_cycle
+from save_config import SaveConfig, find_save_config
+from snapshot import load_snapshot_into, write_snapshot
+from source_reader import SourceFile, read_source_text
+
+OUTPUT_BUFFER_SIZE = 64 * 1024
 
 
 class ConfigParser:
@@ -33,11 +42,33 @@ class ConfigParser:
     parsing sections, and processing gcode macros. It is designed to be flexible and
     extendable for different configuration formats."""
 
-    def __init__(self, base_path=''):
+    def __init__(self, base_path='', cache=None, content_store=None, keep_sources=False, index=None,
+                 section_filter=None, effective_only=False, file_source=None):
         """
-        Initializes the parser with an optional base directory path.
+        Initializes the parser with an optional base directory path, an optional ParseCache used to reuse the
+        token streams of unchanged files and an optional ContentStore shared with other parsers. With keep_sources
+        the raw contents of every file that is read are retained as SourceFile objects. An optional ConfigIndex is
+        filled while parsing, and an optional collection of section names limits the sections whose gcode blocks are
+        stored; the gcode bodies of all other sections are skipped. With effective_only the parser keeps only what
+        Klipper loads: the winning value of every key and the last definition of every gcode block, without
+        comments or history. An optional FileSource replaces the local file system as the place files are read from.
         """
 
+        self.cache = cache
+        self.content_store = content_store
+        self.keep_sources = keep_sources
+        self.index = index
+        self.section_filter = frozenset(section_filter) if section_filter is not None else None
+        self.effective_only = effective_only
+        self.file_source = file_source
+        self.sources = {}  # Normalized path -> SourceFile
+        self.parsed_files = {}  # Normalized path -> fingerprint (None when no cache is used)
+        self.missing_files = set()
+        self.glob_results = {}  # Normalized glob pattern -> list of matching files
+        self.prefetched_tokens = {}  # Normalized path -> (tokens, fingerprint, source), filled by IncludePrefetcher
+        self.prefetched_globs = {}  # Normalized glob pattern -> list of matching files, filled by IncludePrefetcher
+        self.glob_cache = GlobCache()
+        self.include_graph = IncludeGraph()
         self.current_element = None
         self.sections = {}
         self.current_section = None
@@ -46,25 +77,52 @@ class ConfigParser:
         self.in_gcode_block = False
         self.gcode_block_lines = []
         self.gcode_block_name = ''  # Initialize gcode_block_name here
+        self.gcode_block_filename = ''
+        self.save_config = None  # SaveConfig of the root file, applied after all other files
+        self.save_config_layer = {}  # Section name -> (section is new, root file is new to it, keys it added)
+        self.root_end_section = None  # Section the root file ended in, before its SAVE_CONFIG block
+        self.root_end_comments = []  # Comments at the end of the root file, which belong to the next key
 
-    def parse_file(self, filepath, parent_dir=''):
+    def parse_file(self, filepath, parent_dir='', glob_pattern=None):
         """
-        Parses a single file or multiple files (using glob patterns) for configuration data.
+        Parses a single file or multiple files (using glob patterns) for configuration data. glob_pattern is the
+        pattern a file was matched by, which is recorded in the include graph. Like Klipper, only the SAVE_CONFIG
+        block of the root file is read; it is applied once everything the root file includes has been parsed.
         """
 
         try:
-            if not os.path.isabs(filepath):
-                filepath = os.path.join(parent_dir or self.base_path, filepath)
-            normalized_path = os.path.normpath(filepath)
+            normalized_path = self.normalize_path(filepath, parent_dir)
 
             if '*' in normalized_path:
-                for matching_file in glob.glob(normalized_path):
-                    self.parse_file(matching_file, os.path.dirname(matching_file))
-            elif os.path.exists(normalized_path):
-                with open(normalized_path, 'r') as file:
-                    for line in file:
-                        self.parse_line(line, normalized_path, os.path.dirname(normalized_path))
+                matching_files = self.expand_glob(normalized_path)
+                for matching_file in matching_files:
+                    self.parse_file(matching_file, os.path.dirname(matching_file), normalized_path)
+            elif normalized_path in self.prefetched_tokens or self.file_exists(normalized_path):
+                self.include_graph.add_edge(normalized_path, glob_pattern)
+                cycle = self.include_graph.enter(normalized_path)
+                if cycle is not None:
+                    print(f"Warning: Circular include skipped: {format_cycle(cycle)}")
+                    return
+                try:
+                    current_dir = os.path.dirname(normalized_path)
+                    tokens = self.load_tokens(normalized_path)
+                    is_root = len(self.include_graph.stack) == 1
+                    save_config_start = find_save_config(tokens, normalized_path) if is_root else None
+                    if save_config_start is None:
+                        self.replay_tokens(tokens, normalized_path, current_dir)
+                    else:
+                        self.replay_tokens(tokens[:save_config_start], normalized_path, current_dir)
+                    if is_root:
+                        self.root_end_section = self.current_section
+                        self.root_end_comments = list(self.preceding_comments)
+                    if save_config_start is not None:
+                        self.apply_save_config(SaveConfig.from_lines(
+                            [token[1] for token in tokens[save_config_start:]], normalized_path))
+                finally:
+                    self.include_graph.leave(normalized_path)
             else:
+                self.include_graph.add_missing(normalized_path, glob_pattern)
+                self.missing_files.add(normalized_path)
                 print(f"Warning: File {normalized_path} not found.")
         except FileNotFoundError as e:
             print(f"File not found error: {e}")
@@ -73,42 +131,239 @@ class ConfigParser:
         except Exception as e:
             print(f"Unexpected error while reading file {filepath}: {e}")
 
+    def normalize_path(self, filepath, parent_dir=''):
+        """
+        Resolves a path relative to parent_dir (or the base path) and normalizes it.
+        """
+
+        if not os.path.isabs(filepath):
+            filepath = os.path.join(parent_dir or self.base_path, filepath)
+        return os.path.normpath(filepath)
+
+    def expand_glob(self, pattern):
+        """
+        Returns the files matching a glob include pattern and records them as part of the include closure.
+        """
+
+        matching_files = self.prefetched_globs.get(pattern)
+        if matching_files is None:
+            matching_files = self.match_glob(pattern)
+        self.glob_results[pattern] = matching_files
+        return matching_files
+
+    def file_exists(self, path):
+        """
+        Checks whether a file exists in the file source, or on the local file system when there is none.
+        """
+
+        if self.file_source is not None:
+            return self.file_source.exists(path)
+        return os.path.exists(path)
+
+    def match_glob(self, pattern):
+        """
+        Returns the files matching a glob pattern in the file source, or on the local file system when there is none.
+        This has no effect on the parser state, so it is safe to call from worker threads.
+        """
+
+        if self.file_source is not None:
+            return self.file_source.expand_glob(pattern)
+        return self.glob_cache.expand(pattern)
+
+    @staticmethod
+    def include_path(command, current_dir):
+        """
+        Returns the path referenced by an include directive, relative to the directory of the including file.
+        """
+
+        include_filename = command.split('include ')[1].strip().strip('[]')
+        return os.path.join(current_dir, include_filename)
+
+    def read_tokens(self, filepath):
+        """
+        Reads and tokenizes a single file, returning (tokens, fingerprint, source). The source is the SourceFile of
+        the file when its contents are kept (keep_sources) and None otherwise; load_tokens records it. This has no
+        effect on the parser state, so it is safe to call from worker threads.
+        """
+
+        if self.file_source is not None:
+            tokens, fingerprint = self.file_source.read_tokens(filepath, self.tokenize_text)
+            return tokens, fingerprint, None
+
+        if self.cache is not None:
+            tokens, fingerprint = self.cache.get_tokens(filepath, self.tokenize_text)
+            if self.content_store is not None:
+                tokens = self.content_store.share(fingerprint[2], tokens, fingerprint[1])
+            return tokens, fingerprint, None
+
+        if self.keep_sources:
+            source = SourceFile.load(filepath)
+            return self.tokenize_content(source.text), None, source
+        return self.tokenize_content(read_source_text(filepath)), None, None
+
+    def source(self, filepath):
+        """
+        Returns the SourceFile of a parsed file, reading it only if its contents were not retained while parsing.
+        """
+
+        source = self.sources.get(filepath)
+        if source is None:
+            source = SourceFile.load(filepath)
+            self.sources[filepath] = source
+        return source
+
+    def tokenize_content(self, text):
+        """
+        Tokenizes the text of a file, going through the shared content store when one is configured.
+        """
+
+        if self.content_store is not None:
+            return self.content_store.tokenize(text, self.tokenize_text)
+        return self.tokenize_text(text)
+
+    def load_tokens(self, filepath):
+        """
+        Returns the token stream of a single file, reusing the prefetched or cached stream when available, and
+        records the file as parsed together with its retained source.
+        """
+
+        prefetched = self.prefetched_tokens.get(filepath)
+        tokens, fingerprint, source = prefetched if prefetched is not None else self.read_tokens(filepath)
+        self.parsed_files[filepath] = fingerprint
+        if source is not None:
+            self.sources[filepath] = source
+        return tokens
+
+    @staticmethod
+    def tokenize_text(text):
+        """
+        Tokenizes the text of a configuration file with the single-pass lexer.
+        """
+
+        return tokenize_text(text)
+
+    @classmethod
+    def tokenize_text_by_line(cls, text):
+        """
+        Tokenizes the text of a configuration file line by line with tokenize_line. This is the reference the lexer
+        is checked against.
+        """
+
+        return [cls.tokenize_line(line) for line in io.StringIO(text)]
+
+    @classmethod
+    def tokenize_line(cls, line):
+        """
+        Classifies a single line of a configuration file without looking at the parser state.
+
+        The resulting token carries everything apply_token needs, so a file's token stream can be stored and replayed
+        later with exactly the same effect as parsing the file again.
+        """
+
+        trimmed_line = line.strip()
+        command_part, *comment_part = trimmed_line.split('#', 1)
+        trimmed_command = command_part.strip()
+
+        if cls.is_gcode_block_start(trimmed_command):
+            return TOKEN_GCODE_START, trimmed_command
+        if trimmed_line.startswith('['):
+            if trimmed_command.startswith('[include '):
+                return TOKEN_INCLUDE, trimmed_command
+            return TOKEN_SECTION, trimmed_command
+
+        key_value_command = trimmed_command if ':' in command_part else None
+        comment = comment_part[0].strip() if comment_part else None
+        return TOKEN_LINE, line, key_value_command, comment
+
     def parse_line(self, line, filename, current_dir):
         """
         Processes each line of the configuration file.
         """
 
         try:
-            trimmed_line = line.strip()
-            command_part, *comment_part = trimmed_line.split('#', 1)
-            trimmed_command = command_part.strip()
-            inline_comment = comment_part[0].strip() if comment_part else ''
-
-            if self.in_gcode_block:
-                # Check if the current line indicates the end or continuation of a gcode block
-                if self.is_new_block_or_section_start(trimmed_command):
-                    # Finalize current gcode block if starting a new block or section
-                    self.finalize_gcode_block()
-                    self.in_gcode_block = False
+            self.apply_token(self.tokenize_line(line), filename, current_dir)
+        except ValueError as e:
+            print(f"Value error encountered in file {filename}, line '{line}': {e}")
+        except Exception as e:
+            print(f"Unexpected error while processing line in file {filename}: {e}")
+
+    def replay_tokens(self, tokens, filename, current_dir):
+        """
+        Feeds the token stream of a file into the parser state machine.
+
+        Plain lines, which make up most of a file, are handled inline; all other tokens go through apply_token.
+        """
+
+        if self.effective_only:
+            self.replay_effective_tokens(tokens, filename, current_dir)
+            return
+
+        apply_token = self.apply_token
+        preceding_comments = self.preceding_comments
+        for token in tokens:
+            if token[0] != TOKEN_LINE:
+                apply_token(token, filename, current_dir)
+                preceding_comments = self.preceding_comments
+            elif self.in_gcode_block:
+                self.gcode_block_lines.append(token[1])
+            elif token[2] is not None:
+                try:
+                    self.handle_key_value_pair(token[2], filename, token[3] or '')
+                except ValueError as e:
+                    print(f"Value error encountered in file {filename}, token {token}: {e}")
+                except Exception as e:
+                    print(f"Unexpected error while processing line in file {filename}: {e}")
+                preceding_comments = self.preceding_comments
+            elif token[3] is not None:
+                preceding_comments.append(token[3])
+
+    def replay_effective_tokens(self, tokens, filename, current_dir):
+        """
+        Feeds the token stream of a file into an effective_only parser. Comment lines are skipped instead of being
+        collected for the next key.
+        """
+
+        apply_token = self.apply_token
+        for token in tokens:
+            if token[0] != TOKEN_LINE:
+                apply_token(token, filename, current_dir)
+            elif self.in_gcode_block:
+                self.gcode_block_lines.append(token[1])
+            elif token[2] is not None:
+                try:
+                    self.handle_key_value_pair(token[2], filename, '')
+                except ValueError as e:
+                    print(f"Value error encountered in file {filename}, token {token}: {e}")
+                except Exception as e:
+                    print(f"Unexpected error while processing line in file {filename}: {e}")
+
+    def apply_token(self, token, filename, current_dir):
+        """
+        Feeds a single token into the parser state machine.
+        """
+
+        try:
+            kind = token[0]
+
+            if self.in_gcode_block and kind != TOKEN_LINE:
+                # Finalize current gcode block if starting a new block or section
+                self.finalize_gcode_block()
+                self.in_gcode_block = False
 
             # Handling gcode block start or continuation
-            if self.is_gcode_block_start(trimmed_command):
-                self.start_new_gcode_block(trimmed_command)
-            elif trimmed_line.startswith('['):
-                if self.in_gcode_block:
-                    # Finalize the gcode block if we're starting a new section
-                    self.finalize_gcode_block()
-                self.handle_section_or_include(trimmed_command, current_dir, filename)
+            if kind == TOKEN_GCODE_START:
+                self.start_new_gcode_block(token[1], filename)
+            elif kind != TOKEN_LINE:
+                self.handle_section_or_include(token[1], current_dir, filename)
             elif self.in_gcode_block:
                 # Continue accumulating lines within a gcode block
-                self.gcode_block_lines.append(line)
-            elif ':' in command_part:
-                self.handle_key_value_pair(trimmed_command, filename, inline_comment)
-            else:
-                if comment_part:
-                    self.preceding_comments.append(comment_part[0].strip())
+                self.gcode_block_lines.append(token[1])
+            elif token[2] is not None:
+                self.handle_key_value_pair(token[2], filename, token[3] or '')
+            elif token[3] is not None:
+                self.preceding_comments.append(token[3])
         except ValueError as e:
-            print(f"Value error encountered in file {filename}, line '{line}': {e}")
+            print(f"Value error encountered in file {filename}, token {token}: {e}")
         except Exception as e:
             print(f"Unexpected error while processing line in file {filename}: {e}")
 
@@ -137,11 +392,8 @@ class ConfigParser:
 
         full_include_path = ''
         try:
-            # Extract the filename from the include directive
-            include_filename = command.split('include ')[1].strip().strip('[]')
-
-            # Combine the current directory with the include filename
-            full_include_path = os.path.join(current_dir, include_filename)
+            # Extract the filename from the include directive and combine it with the current directory
+            full_include_path = self.include_path(command, current_dir)
 
             # Parse the included file. The parent directory of the included file
             # is passed as the second argument to correctly handle nested includes
@@ -178,15 +430,16 @@ class ConfigParser:
         Determines if a command marks the beginning of a gcode block.
         """
         
-        return command.endswith(':') and not any(command.startswith(x) for x in ['[include ', '[gcode_macro '])
+        return command.endswith(':') and not command.startswith(NON_GCODE_BLOCK_PREFIXES)
 
-    def start_new_gcode_block(self, command):
+    def start_new_gcode_block(self, command, filename=''):
         """
-        Begins processing a new gcode block.
+        Begins processing a new gcode block defined in filename.
         """
         
         self.in_gcode_block = True
         self.gcode_block_name = command.rstrip(':').strip()
+        self.gcode_block_filename = filename
         self.gcode_block_lines = []
 
     def handle_gcode_block_start(self):
@@ -216,8 +469,14 @@ class ConfigParser:
         and store the collected gcode lines, associating them with the current section.
         """
         try:
-            if self.current_section and self.in_gcode_block:
-                self.current_section.add_gcode_block(self.gcode_block_name, self.gcode_block_lines)
+            if self.current_section and self.in_gcode_block and (
+                    self.section_filter is None or self.current_section.name in self.section_filter):
+                if self.effective_only:
+                    self.current_section.set_gcode_block(self.gcode_block_name, self.gcode_block_lines,
+                                                         self.gcode_block_filename)
+                else:
+                    self.current_section.add_gcode_block(self.gcode_block_name, self.gcode_block_lines,
+                                                         filename=self.gcode_block_filename)
             self.in_gcode_block = False
             self.gcode_block_lines = []
             self.gcode_block_name = ''  # Reset gcode_block_name after finalizing the block
@@ -234,8 +493,16 @@ class ConfigParser:
         
         key, value = command_part.split(':', 1)
         if self.current_section:
-            self.current_section.add_key_value_pair(key.strip(), filename, value.strip(), inline_comment,
-                                                    self.preceding_comments)
+            key = key.strip()
+            if self.index is not None:
+                is_new_key = key not in self.current_section.key_value_pairs
+            if self.effective_only:
+                self.current_section.set_key_value(key, filename, value.strip())
+            else:
+                self.current_section.add_key_value_pair(key, filename, value.strip(), inline_comment,
+                                                        self.preceding_comments)
+            if self.index is not None:
+                self.index.add_entry(self.current_section.name, key, intern_filename(filename), is_new_key)
         self.preceding_comments = []
 
     def add_macro_key_value(self, line):
@@ -264,17 +531,96 @@ class ConfigParser:
             else:
                 self.current_section = ConfigurationSection(name, filename)
                 self.sections[name] = self.current_section
+                if self.index is not None:
+                    self.index.add_section(self.current_section)
         except Exception as e:
             print(f"Error starting new section '{name}' in file {filename}: {e}")
 
-    def write_output(self, output_filepath, hide_unmodified=True):
+    def apply_save_config(self, save_config):
+        """
+        Applies a SAVE_CONFIG block as the last layer of the configuration. Its values override the values of every
+        file and are recorded in the history of their keys, and the points of saved bed mesh profiles are attached
+        to their sections as BedMesh objects. What the block added to the sections is recorded in save_config_layer,
+        so that overlays can take the layer off and apply it again on top of their own files.
+        """
+
+        self.save_config = save_config
+        filename = save_config.filename
+        for section_name, keys in save_config.sections.items():
+            section = self.sections.get(section_name)
+            self.save_config_layer[section_name] = (
+                section is None, section is not None and filename not in section.filenames,
+                frozenset(key for key in keys if section is None or key not in section.key_value_pairs))
+            self.start_new_section(section_name, filename)
+            self.preceding_comments = []
+            for key, value in keys.items():
+                try:
+                    self.handle_key_value_pair(f"{key}: {value}", filename, '')
+                except Exception as e:
+                    print(f"Unexpected error while applying SAVE_CONFIG value '{key}' of [{section_name}]: {e}")
+            mesh = save_config.meshes.get(section_name)
+            if mesh is not None and self.current_section is not None:
+                is_new_key = self.current_section.bed_mesh is None
+                self.current_section.bed_mesh = mesh
+                if self.index is not None:
+                    self.index.add_entry(section_name, 'points', intern_filename(filename), is_new_key)
+
+    def write_snapshot(self, snapshot_filepath, compress=False):
+        """
+        Writes the merged state to a binary snapshot that from_snapshot can load without parsing again, optionally
+        compressed.
+        """
+
+        write_snapshot(self, snapshot_filepath, compress)
+
+    @classmethod
+    def from_snapshot(cls, snapshot_filepath, sections=None):
+        """
+        Returns a parser holding the merged state stored in a snapshot, optionally restricted to the named sections.
+        """
+
+        return load_snapshot_into(cls(), snapshot_filepath, sections)
+
+    def write_effective_output(self, output_filepath, provenance=False):
+        """
+        Writes only the effective configuration: every section with the winning value of each key and the last
+        definition of each gcode block, without comments or history. With provenance, every section is preceded by
+        a single comment listing the files that defined it.
+        """
+
+        with open(output_filepath, 'w', buffering=OUTPUT_BUFFER_SIZE) as file:
+            file.writelines(self.iter_effective_output(provenance))
+
+    def iter_effective_output(self, provenance=False):
+        """
+        Yields the effective configuration piece by piece, see write_effective_output.
+        """
+
+        relpath = cached_relpath(self.base_path) if provenance else None
+        for section in self.sections.values():
+            yield from section.iter_effective_output(relpath)
+
+    def write_output(self, output_filepath, hide_unmodified=True, gcode_history='full'):
         """
         Writes the parsed configuration to a file.
 
         After parsing is complete, this method generates the final output, writing the processed
-        configuration data to the specified file, optionally filtering out unmodified sections.
+        configuration data to the specified file, optionally filtering out unmodified sections. gcode_history selects
+        whether overridden gcode blocks are written in full ('full') or as diffs against their previous version
+        ('diff').
         """
         
-        with open(output_filepath, 'w') as file:
-            for section_name, section in self.sections.items():
-                file.write(section.write_output(self.base_path, hide_unmodified))
+        # Sections are streamed straight into a buffered file handle, so the merged output is never held in memory
+        relpath = cached_relpath(self.base_path)
+        with open(output_filepath, 'w', buffering=OUTPUT_BUFFER_SIZE) as file:
+            for section in self.sections.values():
+                file.writelines(section.iter_output(self.base_path, hide_unmodified, relpath, gcode_history))
+
+    def iter_output(self, hide_unmodified=True, gcode_history='full'):
+        """
+        Yields the merged output piece by piece, see write_output.
+        """
+
+        relpath = cached_relpath(self.base_path)
+        for section in self.sections.values():
+            yield from section.iter_output(self.base_path, hide_unmodified, relpath, gcode_history)
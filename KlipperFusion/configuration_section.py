@@ -20,13 +20,27 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import functools
 import os
 
-from gcode_block import GCodeBlock
+from gcode_block import GCodeBlock, expand_versions, iter_history_diff
 from key_value_pair import KeyValuePair
 
 
+def cached_relpath(base_path):
+    """
+    Returns a memoized os.path.relpath bound to base_path. A merged configuration references the same few dozen
+    files thousands of times, so caching the relative paths removes most of the path arithmetic from the emit path.
+    """
+
+    return functools.lru_cache(maxsize=None)(lambda filename: os.path.relpath(filename, base_path))
+
+
 class ConfigurationSection:
+    # file_order remembers the order in which files were first added. The output iterates the filenames set, whose
+    # order depends on that insertion history, so replaying the inserts in this order rebuilds an identical set.
+    __slots__ = ('name', 'filename', 'filenames', 'file_order', 'key_value_pairs', 'gcode_blocks', 'bed_mesh')
+
     def __init__(self, name, filename):
         """
         Initializes a new ConfigurationSection with the given name and filename.
@@ -35,40 +49,72 @@ class ConfigurationSection:
         self.name = name
         self.filename = filename
         self.filenames = {filename}
+        self.file_order = [filename]
         self.key_value_pairs = {}
         self.gcode_blocks = {}
+        self.bed_mesh = None  # BedMesh holding the saved points of a bed mesh profile
 
     def add_file(self, filename):
         """
         Adds a filename to the set of filenames associated with this configuration section.
         """
 
-        self.filenames.add(filename)
+        if filename not in self.filenames:
+            self.filenames.add(filename)
+            self.file_order.append(filename)
 
-    def add_gcode_block(self, block_name, gcode_lines, preceding_comments=None):
+    def add_gcode_block(self, block_name, gcode_lines, preceding_comments=None, filename=''):
         """
-        Adds a new GCodeBlock to this section. If a block with the same name exists,
-        appends the new lines to it. Optionally includes preceding comments.
+        Adds a new GCodeBlock to this section. If a block with the same name exists, the new version is appended
+        and the previous one is reduced to a delta against it. Optionally includes preceding comments and the file
+        defining the block.
         """
 
         try:
             # Check if a GCodeBlock with the same name already exists
             if preceding_comments is None:
-                preceding_comments = []
+                preceding_comments = ()
             if block_name not in self.gcode_blocks:
                 self.gcode_blocks[block_name] = []
 
             # Create a new GCodeBlock instance for the new lines
-            new_block = GCodeBlock(block_name)
-            for line in gcode_lines:
-                new_block.add_line(line)
+            new_block = GCodeBlock(block_name, filename)
+            new_block.lines = list(gcode_lines)
             new_block.set_preceding_comments(preceding_comments)
 
             # Append the new GCodeBlock instance to the list associated with block_name
-            self.gcode_blocks[block_name].append(new_block)
+            blocks = self.gcode_blocks[block_name]
+            if blocks:
+                blocks[-1].encode_against(new_block)
+            blocks.append(new_block)
         except Exception as e:
             print(f"Error adding GCodeBlock '{block_name}': {e}")
 
+    def set_gcode_block(self, block_name, gcode_lines, filename=''):
+        """
+        Replaces the gcode block with the given name by a new definition without keeping the previous one. The lines
+        are stored packed, see GCodeBlock.pack.
+        """
+
+        new_block = GCodeBlock(block_name, filename)
+        new_block.pack(gcode_lines)
+        self.gcode_blocks[block_name] = [new_block]
+
+    def set_key_value(self, key, filename, value):
+        """
+        Sets the value of a key without keeping its previous value or any comments.
+        """
+
+        try:
+            self.add_file(filename)
+            kvp = self.key_value_pairs.get(key)
+            if kvp is None:
+                self.key_value_pairs[key] = KeyValuePair(key, filename, value, '', ())
+            else:
+                kvp.set_value(filename, value)
+        except Exception as e:
+            print(f"Error setting KeyValuePair '{key}': {e}")
+
     def add_key_value_pair(self, key, filename, value, inline_comment, preceding_comments):
         """
         Adds a key-value pair to this section. If the key already exists, updates its
@@ -104,26 +150,63 @@ class ConfigurationSection:
 
         return self.key_value_pairs
 
-    def write_output(self, base_path, hide_unmodified=True):
+    def write_output(self, base_path, hide_unmodified=True, gcode_history='full'):
         """
         Generates and returns the textual representation of this configuration section,
         optionally hiding unmodified sections.
         """
 
+        return ''.join(self.iter_output(base_path, hide_unmodified, gcode_history=gcode_history))
+
+    def iter_output(self, base_path, hide_unmodified=True, relpath=None, gcode_history='full'):
+        """
+        Yields the textual representation of this configuration section piece by piece. An optional memoizing
+        relpath function (see cached_relpath) avoids recomputing the same relative paths for every section and key.
+        With gcode_history 'full' every version of an overridden gcode block is written out; with 'diff' only the
+        effective version is, preceded by commented diffs of the overrides.
+        """
+
         try:
-            output = "\n"
-            relative_filenames = [os.path.relpath(filename, base_path) for filename in self.filenames]
-            for filename in relative_filenames:
-                output += f"# {filename}\n"
-            output += f"[{self.name}]\n"
+            if relpath is None:
+                relpath = cached_relpath(base_path)
+            yield "\n"
+            for filename in self.filenames:
+                yield f"# {relpath(filename)}\n"
+            yield f"[{self.name}]\n"
             for key, kvp in self.key_value_pairs.items():
-                output += kvp.format_for_output(base_path) + "\n"
+                yield from kvp.iter_output(base_path, relpath)
+                yield "\n"
+            if self.bed_mesh is not None:
+                yield from self.bed_mesh.iter_output()
             # Handle gcode blocks output
             for block_name, blocks in self.gcode_blocks.items():
-                for block in blocks:
-                    output += block.write_block(hide_unmodified)
-
-            return output
+                if gcode_history == 'diff' and blocks:
+                    yield from iter_history_diff(blocks, relpath, hide_unmodified)
+                    continue
+                for block, lines in zip(blocks, expand_versions(blocks)):
+                    yield from block.iter_block(hide_unmodified, lines)
         except Exception as e:
             print(f"Error generating output for ConfigurationSection '{self.name}': {e}")
-            return ""
+
+    def iter_effective_output(self, relpath=None):
+        """
+        Yields the effective contents of this section: the value of every key and the last definition of every gcode
+        block. When a relpath function is given, the section is preceded by a comment listing its files.
+        """
+
+        try:
+            yield "\n"
+            if relpath is not None:
+                yield f"# {', '.join(relpath(filename) for filename in self.file_order)}\n"
+            yield f"[{self.name}]\n"
+            for key, kvp in self.key_value_pairs.items():
+                yield f"{key}: {kvp.value}\n"
+            if self.bed_mesh is not None:
+                yield from self.bed_mesh.iter_output()
+            for block_name, blocks in self.gcode_blocks.items():
+                if blocks:
+                    yield f"{block_name}:\n"
+                    for line in blocks[-1].lines:
+                        yield f"{line.rstrip()}\n"
+        except Exception as e:
+            print(f"Error generating effective output for ConfigurationSection '{self.name}': {e}")
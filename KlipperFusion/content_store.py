@@ -0,0 +1,113 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+
+from parse_cache import content_digest
+
+
+class ContentStore:
+    """Content-addressed store of token streams shared between ConfigParser instances.
+
+    Printers in a fleet mostly include byte-identical files (kinematics, axis, size and macro files of the shared
+    Klippain tree). The store hashes the text of every file it is given and tokenizes each distinct content only
+    once; every parser then replays the same immutable token stream under its own filename, so provenance is kept
+    per printer while the tokenizing work and the token memory are shared."""
+
+    def __init__(self):
+        """
+        Initializes an empty store.
+        """
+
+        self.entries = {}  # Content digest -> token stream
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.bytes_total = 0
+        self.bytes_saved = 0
+
+    def tokenize(self, text, tokenize_text):
+        """
+        Returns the token stream of text, tokenizing it with tokenize_text only when the same content has not been
+        seen before.
+        """
+
+        digest = content_digest(text)
+        tokens = self.entries.get(digest)
+        if tokens is not None:
+            self._count(len(text), True)
+            return tokens
+        return self.share(digest, tokenize_text(text), len(text))
+
+    def share(self, digest, tokens, size):
+        """
+        Registers a token stream obtained elsewhere (for example from the persistent parse cache) under its content
+        digest and returns the stream every parser should use for that content.
+        """
+
+        shared_tokens = self.entries.setdefault(digest, tokens)
+        self._count(size, shared_tokens is not tokens)
+        return shared_tokens
+
+    def _count(self, size, hit):
+        """
+        Updates the deduplication counters for one lookup of size bytes.
+        """
+
+        with self.lock:
+            self.lookups += 1
+            self.bytes_total += size
+            if hit:
+                self.hits += 1
+                self.bytes_saved += size
+
+    def stats(self):
+        """
+        Returns the deduplication counters as a dictionary.
+        """
+
+        return {
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'unique_contents': len(self.entries),
+            'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+            'bytes_total': self.bytes_total,
+            'bytes_saved': self.bytes_saved,
+        }
+
+    def clear(self):
+        """
+        Drops all stored token streams and resets the counters.
+        """
+
+        with self.lock:
+            self.entries.clear()
+            self.lookups = self.hits = self.bytes_total = self.bytes_saved = 0
+
+
+def format_dedup_stats(stats):
+    """
+    Formats deduplication counters for a one-line report.
+    """
+
+    return (f"{stats['hits']} of {stats['lookups']} files shared ({stats['hit_rate']:.0%} hit rate), "
+            f"{stats['bytes_saved'] / 1024:.1f} KiB of {stats['bytes_total'] / 1024:.1f} KiB not tokenized again")
@@ -0,0 +1,177 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import errno
+import fnmatch
+import glob
+import os
+import stat
+
+from source_reader import decode_source
+
+
+class FileSource:
+    """A tree of configuration files that a ConfigParser reads instead of the local file system, such as a commit of
+    a git repository.
+
+    The tree is presented below root_dir, so the parser keeps working with absolute paths and include resolution is
+    unchanged. Subclasses implement lookups of single entries and directory listings; existence checks, glob
+    expansion and tokenizing are built on top of them. Token streams are memoized by content key in token_cache,
+    which several sources can share: a file whose contents were tokenized once, under any path and in any source,
+    is not read or tokenized again."""
+
+    def __init__(self, root_dir, token_cache=None):
+        """
+        Initializes a source whose files appear below root_dir. An optional token_cache dictionary is shared with
+        other sources.
+        """
+
+        self.root_dir = os.path.normpath(os.path.abspath(root_dir))
+        self.root_prefix = self.root_dir.rstrip(os.sep) + os.sep
+        self.token_cache = token_cache if token_cache is not None else {}  # Content key -> tokens
+        self.tokenized_files = 0
+
+    def relative_path(self, path):
+        """
+        Returns path relative to root_dir, '' for root_dir itself, or None when path lies outside of the tree.
+        """
+
+        if path.startswith(self.root_prefix) and os.sep + os.curdir not in path and os.sep * 2 not in path:
+            # The normalized paths built by the parser take this shortcut around os.path.relpath
+            return path[len(self.root_prefix):].rstrip(os.sep)
+        relative = os.path.relpath(os.path.normpath(path), self.root_dir)
+        if relative == os.curdir:
+            return ''
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            return None
+        return relative
+
+    def content_key(self, relative):
+        """
+        Returns a hashable key identifying the contents of the file at a relative path, or None when there is no
+        such file. Files with equal keys must have equal contents.
+        """
+
+        raise NotImplementedError
+
+    def read_bytes(self, relative):
+        """
+        Returns the raw contents of the file at a relative path.
+        """
+
+        raise NotImplementedError
+
+    def listdir(self, relative):
+        """
+        Returns the entry names of the directory at a relative path, or None when there is no such directory.
+        """
+
+        raise NotImplementedError
+
+    def exists(self, path):
+        """
+        Checks whether path names a file or directory of the tree, like os.path.exists does for the local file system.
+        Including a directory then fails the same way for every source, when it is read.
+        """
+
+        relative = self.relative_path(path)
+        return relative is not None and (self.content_key(relative) is not None or self.listdir(relative) is not None)
+
+    def expand_glob(self, pattern):
+        """
+        Returns the files matching an absolute glob pattern, component by component like glob.glob: wildcards do not
+        match across directories and names starting with a dot only match patterns starting with a dot. Matches are
+        sorted, the order in which Klipper includes them.
+        """
+
+        relative = self.relative_path(pattern)
+        if relative is None:
+            return []
+        parts = relative.split(os.sep)
+        candidates = ['']
+        for position, part in enumerate(parts):
+            is_last = position == len(parts) - 1
+            matches = []
+            for directory in candidates:
+                if glob.has_magic(part):
+                    names = self.listdir(directory) or ()
+                    if not part.startswith('.'):
+                        names = [name for name in names if not name.startswith('.')]
+                    matches.extend(os.path.join(directory, name) for name in sorted(fnmatch.filter(names, part)))
+                else:
+                    matches.append(os.path.join(directory, part))
+            if is_last:
+                candidates = [match for match in matches if self.content_key(match) is not None]
+            else:
+                candidates = [match for match in matches if self.listdir(match) is not None]
+        return [os.path.join(self.root_dir, match) for match in candidates]
+
+    def read_tokens(self, path, tokenize):
+        """
+        Returns (tokens, content key) for a file, tokenizing its text with tokenize unless a file with the same
+        contents was tokenized before.
+        """
+
+        relative = self.relative_path(path)
+        key = self.content_key(relative) if relative is not None else None
+        if key is None:
+            if relative is not None and self.listdir(relative) is not None:
+                raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+            raise FileNotFoundError(f"No such file in {self.root_dir}: {path}")
+        tokens = self.token_cache.get(key)
+        if tokens is None:
+            tokens = self.token_cache[key] = tokenize(decode_source(self.read_bytes(relative)))
+            self.tokenized_files += 1
+        return tokens, key
+
+
+class FilesystemSource(FileSource):
+    """The files below a directory of the local file system. A ConfigParser without a file source reads the file
+    system directly; this source reads the same files through the FileSource interface, so directories can be
+    handled like archives. Content keys are built from the file's device, inode, modification time and size, so
+    token streams are reused as long as a file is not modified."""
+
+    def path(self, relative):
+        """
+        Returns the local path of a relative path.
+        """
+
+        return os.path.join(self.root_dir, relative)
+
+    def content_key(self, relative):
+        try:
+            status = os.stat(self.path(relative))
+        except OSError:
+            return None
+        if not stat.S_ISREG(status.st_mode):
+            return None
+        return status.st_dev, status.st_ino, status.st_mtime_ns, status.st_size
+
+    def read_bytes(self, relative):
+        with open(self.path(relative), 'rb') as file:
+            return file.read()
+
+    def listdir(self, relative):
+        try:
+            return os.listdir(self.path(relative))
+        except OSError:
+            return None
@@ -0,0 +1,82 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import threading
+
+
+class FileTable:
+    """Interns file paths and hands out small integer IDs for them.
+
+    Occurrence records store the integer ID of the file they came from instead of a reference to a path string, and
+    every path is stored exactly once per process no matter how many printers, sections and keys refer to it."""
+
+    def __init__(self):
+        """
+        Initializes an empty table.
+        """
+
+        self.ids = {}
+        self.filenames = []
+        self.lock = threading.Lock()
+
+    def intern(self, filename):
+        """
+        Returns the ID of filename, adding it to the table when it is not known yet.
+        """
+
+        file_id = self.ids.get(filename)
+        if file_id is None:
+            with self.lock:
+                file_id = self.ids.get(filename)
+                if file_id is None:
+                    file_id = len(self.filenames)
+                    self.filenames.append(sys.intern(filename))
+                    self.ids[self.filenames[file_id]] = file_id
+        return file_id
+
+    def filename(self, file_id):
+        """
+        Returns the path registered under file_id.
+        """
+
+        return self.filenames[file_id]
+
+
+# A single process-wide table lets all parsers share the same path strings.
+FILE_TABLE = FileTable()
+
+
+def intern_filename(filename):
+    """
+    Returns the ID of filename in the process-wide file table.
+    """
+
+    return FILE_TABLE.intern(filename)
+
+
+def filename_of(file_id):
+    """
+    Returns the path registered under file_id in the process-wide file table.
+    """
+
+    return FILE_TABLE.filenames[file_id]
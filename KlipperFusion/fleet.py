@@ -0,0 +1,200 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import contextlib
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from config_parser import ConfigParser
+from content_store import ContentStore
+from parse_cache import DEFAULT_MAX_CACHE_BYTES, ParseCache
+
+ROOT_FILENAME = 'printer.cfg'
+SUMMARY_FILENAME = 'fleet_summary.json'
+
+# Every worker process keeps one content store for all printers it merges, so identical include files are only
+# tokenized once per worker.
+WORKER_CONTENT_STORE = ContentStore()
+
+
+def find_printer_roots(paths):
+    """
+    Expands the given paths into a sorted list of root configuration files. Files are taken as they are, directories
+    are scanned recursively for printer.cfg files.
+    """
+
+    roots = set()
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            for directory, _, filenames in os.walk(path):
+                if ROOT_FILENAME in filenames:
+                    roots.add(os.path.join(directory, ROOT_FILENAME))
+        elif os.path.isfile(path):
+            roots.add(path)
+        else:
+            print(f"Warning: {path} is neither a file nor a directory, skipping it.")
+    return sorted(roots)
+
+
+def output_paths(roots, output_dir=None):
+    """
+    Maps every root file to its output file. Without output_dir, each printer gets an output.cfg next to its root
+    file. With output_dir, the outputs are named after the root's directory relative to the common parent of all
+    roots, e.g. 'Voron Trident 350mm__config.cfg'.
+    """
+
+    if output_dir is None:
+        return {root: os.path.join(os.path.dirname(root), 'output.cfg') for root in roots}
+
+    directories = [os.path.dirname(root) for root in roots]
+    common_dir = os.path.commonpath(directories) if len(directories) > 1 else os.path.dirname(directories[0])
+    outputs = {}
+    for root, directory in zip(roots, directories):
+        name = os.path.relpath(directory, common_dir)
+        name = os.path.basename(directory) if name == '.' else name.replace(os.sep, '__')
+        outputs[root] = os.path.join(output_dir, f"{name}.cfg")
+    return outputs
+
+
+def merge_printer(root, output_filepath, hide_unmodified=True, cache_dir=None, cache_max_bytes=DEFAULT_MAX_CACHE_BYTES,
+                  use_cache=True, share_contents=True):
+    """
+    Merges a single printer configuration and writes its output file. Runs inside a worker process, so everything it
+    needs is passed as plain arguments and everything it reports is returned as a plain dictionary. Messages the
+    parser prints are captured as warnings instead of interleaving with the other workers' output.
+    """
+
+    result = {'root': root, 'output': output_filepath, 'status': 'ok', 'error': None, 'warnings': []}
+    content_store = WORKER_CONTENT_STORE if share_contents else None
+    dedup_before = WORKER_CONTENT_STORE.stats()
+    messages = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(messages):
+            cache = ParseCache(cache_dir, cache_max_bytes) if use_cache else None
+            cache_options = {'hide_unmodified': hide_unmodified}
+            if cache is not None and cache.is_run_unchanged(root, output_filepath, cache_options):
+                result['status'] = 'up-to-date'
+            else:
+                parser = ConfigParser(os.path.dirname(root), cache, content_store)
+                parser.parse_file(root)
+                parsed = time.perf_counter()
+                os.makedirs(os.path.dirname(output_filepath), exist_ok=True)
+                parser.write_output(output_filepath, hide_unmodified)
+                if cache is not None:
+                    cache.record_run(root, output_filepath, cache_options, parser)
+
+                result['parse_seconds'] = parsed - start
+                result['write_seconds'] = time.perf_counter() - parsed
+                result['files'] = len(parser.parsed_files)
+                result['sections'] = len(parser.sections)
+                result['keys'] = sum(len(section.key_value_pairs) for section in parser.sections.values())
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = time.perf_counter() - start
+    result['warnings'] = messages.getvalue().splitlines()
+    dedup_after = WORKER_CONTENT_STORE.stats()
+    result['dedup'] = {counter: dedup_after[counter] - dedup_before[counter]
+                       for counter in ('lookups', 'hits', 'bytes_total', 'bytes_saved')}
+    return result
+
+
+def run_fleet(roots, output_dir=None, jobs=None, hide_unmodified=True, cache_dir=None,
+              cache_max_bytes=DEFAULT_MAX_CACHE_BYTES, use_cache=True, progress=print, share_contents=True):
+    """
+    Merges many printer configurations in a process pool and returns one result dictionary per printer, in the order
+    of roots. A failure, or even a crashed worker, only affects the printer it happened on: a worker that dies hard
+    breaks the whole pool, so the printers that had not finished then are merged again one by one, each in a process
+    of its own.
+    """
+
+    outputs = output_paths(roots, output_dir)
+    results = {}
+
+    def report(root, result):
+        results[root] = result
+        if progress:
+            progress(f"[{len(results)}/{len(roots)}] {result['status']:>10}  {result['seconds'] * 1000:8.1f} ms  "
+                     f"{root}")
+
+    def failed(root, error):
+        return {'root': root, 'output': outputs[root], 'status': 'failed', 'seconds': 0.0, 'error': error,
+                'warnings': []}
+
+    arguments = {root: (root, outputs[root], hide_unmodified, cache_dir, cache_max_bytes, use_cache, share_contents)
+                 for root in roots}
+    interrupted = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(merge_printer, *arguments[root]): root for root in roots}
+        for future in as_completed(futures):
+            root = futures[future]
+            try:
+                report(root, future.result())
+            except BrokenProcessPool:
+                interrupted.append(root)
+            except Exception as e:
+                report(root, failed(root, f"Worker failed: {type(e).__name__}: {e}"))
+
+    for root in interrupted:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                report(root, executor.submit(merge_printer, *arguments[root]).result())
+            except BrokenProcessPool:
+                report(root, failed(root, "Worker crashed while merging this printer."))
+            except Exception as e:
+                report(root, failed(root, f"Worker failed: {type(e).__name__}: {e}"))
+
+    if use_cache:
+        try:
+            ParseCache(cache_dir, cache_max_bytes).prune()
+        except OSError as e:
+            print(f"Warning: Could not prune the parse cache: {e}")
+    return [results[root] for root in roots]
+
+
+def write_summary(results, summary_filepath, wall_seconds, jobs):
+    """
+    Writes the per-printer results and totals of a fleet run as JSON and returns the totals.
+    """
+
+    totals = {
+        'printers': len(results),
+        'ok': sum(1 for result in results if result['status'] == 'ok'),
+        'up_to_date': sum(1 for result in results if result['status'] == 'up-to-date'),
+        'failed': sum(1 for result in results if result['status'] == 'failed'),
+        'jobs': jobs,
+        'wall_seconds': wall_seconds,
+        'worker_seconds': sum(result['seconds'] for result in results),
+    }
+    dedup = {counter: sum(result.get('dedup', {}).get(counter, 0) for result in results)
+             for counter in ('lookups', 'hits', 'bytes_total', 'bytes_saved')}
+    dedup['hit_rate'] = dedup['hits'] / dedup['lookups'] if dedup['lookups'] else 0.0
+    totals['dedup'] = dedup
+    with open(summary_filepath, 'w') as file:
+        json.dump({'totals': totals, 'printers': results}, file, indent=2)
+    return totals
@@ -0,0 +1,729 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import contextlib
+import io
+import itertools
+import os
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+import click
+
+from archive_source import open_archive_source
+from config_generator import generate_edge_case_files, write_config_files
+from config_lexer import TOKEN_LINE
+from config_overlay import OverlayParser
+from config_parser import ConfigParser
+from configuration_section import cached_relpath
+from content_store import ContentStore
+from file_source import FilesystemSource
+from file_table import filename_of
+from fleet import merge_printer
+from gcode_block import expand_versions
+from git_history import GitObjectReader, GitTreeSource, HistoryParser, run_git
+from include_prefetcher import prefetch_includes
+from parse_cache import ParseCache
+from save_config import SAVE_CONFIG_MARKER, SAVE_CONFIG_PREFIX, save_config_intact
+from serve_mode import MergedStateCache
+from watch_mode import WatchSession
+
+# Differential fuzz harness for the parsing paths. Random configuration trees full of edge cases are merged by the
+# reference parser, which feeds every line through parse_line like the original parser, and by every optimized mode:
+# the single-pass lexer, the parse cache, the shared content store, include prefetching, the file sources for
+# directories, archives and git trees, snapshots, effective-only parsing, fleet workers, the incremental merges of
+# watch mode and serve mode, overlays on merged and on snapshot bases, and the stripped token streams of the git
+# history. Their merged states are compared structurally. A failing case is shrunk to a minimal reproducer and
+# written to a directory that --replay checks again.
+
+ROOT_FILENAME = 'printer.cfg'
+DIFFERENCE_FILENAME = 'difference.txt'
+LINE_PATTERN = re.compile(r'[^\n]*\n|[^\n]+')
+SOURCE_LINE_PATTERN = re.compile(r'[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+')  # Lines as the parser splits them
+MAX_REPR_LENGTH = 200
+OVERLAY_FILENAME = 'fuzz_overlay.cfg'
+OVERLAY_INCLUDE = f"[include {OVERLAY_FILENAME}]\n"
+SERVE_CACHE_BYTES = 1 << 30
+
+# A root with a section added after its SAVE_CONFIG block. Klipper then ignores the block and reads the whole file as
+# regular configuration, so the section is merged and the saved kinematics are not applied.
+SAVE_CONFIG_TAIL_CASE = {ROOT_FILENAME: (
+    "[printer]\nkinematics: corexy\n\n"
+    "#*# <---------------------- SAVE_CONFIG ---------------------->\n"
+    "#*# DO NOT EDIT THIS BLOCK OR BELOW. The contents are auto-generated.\n#*#\n"
+    "#*# [printer]\n#*# kinematics = cartesian\n\n"
+    "[stepper_x]\nstep_pin: PA1\n")}
+
+
+class ReferenceParser(ConfigParser):
+    """ConfigParser that parses every file like the original parser did: each line goes through parse_line, which
+    classifies it with tokenize_line and feeds it to apply_token. Neither the single-pass lexer nor the inlined replay
+    loops are used. All modes are compared against it."""
+
+    @staticmethod
+    def tokenize_text(text):
+        # Lines stay unclassified until parse_line sees them; the SAVE_CONFIG header is still found by its prefix
+        return [(TOKEN_LINE, line) for line in io.StringIO(text)]
+
+    def replay_tokens(self, tokens, filename, current_dir):
+        for token in tokens:
+            self.parse_line(token[1], filename, current_dir)
+
+
+class SortedReferenceParser(ReferenceParser):
+    """ReferenceParser that includes the matches of glob patterns in sorted order, like the file sources do."""
+
+    def match_glob(self, pattern):
+        return sorted(super().match_glob(pattern))
+
+
+def merged_state(parser):
+    """
+    Returns the merged state of a parser as plain data that compares with ==: every section with its files, value
+    histories, gcode block versions and bed mesh, the parsed and missing files, the SAVE_CONFIG values, and the merged
+    and effective outputs. The final values and their files are also listed by themselves, for modes that keep no
+    history. Paths are relative to the base path, so trees read from other places compare equal.
+    """
+
+    relpath = cached_relpath(parser.base_path)
+
+    def name(filename):
+        return relpath(filename) if filename else filename
+
+    sections = []
+    values = []
+    for section_name, section in parser.sections.items():
+        keys = []
+        for key, kvp in section.key_value_pairs.items():
+            history = (*kvp.occurrences, (kvp.file_id, kvp.value, kvp.inline_comment, kvp.preceding_comments))
+            keys.append((key, [(name(filename_of(file_id)), value, inline_comment, tuple(preceding_comments))
+                               for file_id, value, inline_comment, preceding_comments in history]))
+        gcode = [(block_name, [(name(block.filename), tuple(lines), tuple(block.preceding_comments))
+                               for block, lines in zip(blocks, expand_versions(blocks))])
+                 for block_name, blocks in section.gcode_blocks.items()]
+        sections.append({'name': section_name, 'files': sorted(map(name, section.filenames)),
+                         'file_order': list(map(name, section.file_order)), 'keys': keys, 'gcode': gcode,
+                         'bed_mesh': ''.join(section.bed_mesh.iter_output()) if section.bed_mesh else None})
+        values.append((section_name, list(map(name, section.file_order)),
+                       [(key, name(filename_of(kvp.file_id)), kvp.value)
+                        for key, kvp in section.key_value_pairs.items()]))
+    return {
+        'sections': sections,
+        'values': values,
+        'files': {'parsed': sorted(map(name, parser.parsed_files)), 'missing': sorted(map(name, parser.missing_files))},
+        'save_config': parser.save_config.sections if parser.save_config is not None else None,
+        'output': ''.join(parser.iter_output(False)),
+        'effective': ''.join(parser.iter_effective_output()),
+    }
+
+
+def parse_quietly(parser, root):
+    """
+    Parses root with parser, discarding the warnings it prints, and returns the parser.
+    """
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        parser.parse_file(root)
+    return parser
+
+
+def check_incremental_output(tree_dir, output):
+    """
+    Raises RuntimeError when an incrementally updated output differs from a fresh merge of the tree as it is now.
+    The fresh merge uses the single-pass lexer, which the lexer mode checks against the reference.
+    """
+
+    parser = parse_quietly(ConfigParser(tree_dir), os.path.join(tree_dir, ROOT_FILENAME))
+    difference = first_difference(''.join(parser.iter_output(False)), output, 'output')
+    if difference is not None:
+        raise RuntimeError(f"after an edit, {difference}")
+
+
+def edit_each_file(tree_dir, step):
+    """
+    Appends a key to the section every file of a tree ends in, one file at a time, and calls step after each edit,
+    then restores all files and calls step once more. Every write moves the modification time forward, so checks
+    based on stat results notice it; the original times are put back at the end.
+    """
+
+    paths = sorted(os.path.join(directory, filename)
+                   for directory, _, filenames in os.walk(tree_dir) for filename in filenames)
+    originals = {}
+    for path in paths:
+        with open(path, 'rb') as file:
+            originals[path] = (file.read(), os.stat(path))
+
+    def write(path, data, seconds):
+        stat = originals[path][1]
+        with open(path, 'wb') as file:
+            file.write(data)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 1_000_000_000))
+
+    try:
+        for seconds, path in enumerate(paths, 1):
+            write(path, originals[path][0] + b'\nfuzz_key: %d\n' % seconds, seconds)
+            step()
+        for path in paths:
+            write(path, originals[path][0], len(paths) + 1)
+        step()
+    finally:
+        for path in paths:
+            write(path, originals[path][0], 0)
+
+
+def lexer_mode(tree_dir, work_dir):
+    return merged_state(parse_quietly(ConfigParser(tree_dir), os.path.join(tree_dir, ROOT_FILENAME)))
+
+
+def keep_sources_mode(tree_dir, work_dir):
+    return merged_state(parse_quietly(ConfigParser(tree_dir, keep_sources=True), os.path.join(tree_dir, ROOT_FILENAME)))
+
+
+def cache_cold_mode(tree_dir, work_dir):
+    cache = ParseCache(os.path.join(work_dir, 'cold_cache'))
+    return merged_state(parse_quietly(ConfigParser(tree_dir, cache), os.path.join(tree_dir, ROOT_FILENAME)))
+
+
+def cache_warm_mode(tree_dir, work_dir):
+    cache_dir = os.path.join(work_dir, 'warm_cache')
+    parse_quietly(ConfigParser(tree_dir, ParseCache(cache_dir)), os.path.join(tree_dir, ROOT_FILENAME))
+    return merged_state(parse_quietly(ConfigParser(tree_dir, ParseCache(cache_dir)),
+                                      os.path.join(tree_dir, ROOT_FILENAME)))
+
+
+def content_store_mode(tree_dir, work_dir):
+    # The second parser replays the token streams the first one stored
+    content_store = ContentStore()
+    parse_quietly(ConfigParser(tree_dir, content_store=content_store), os.path.join(tree_dir, ROOT_FILENAME))
+    return merged_state(parse_quietly(ConfigParser(tree_dir, content_store=content_store),
+                                      os.path.join(tree_dir, ROOT_FILENAME)))
+
+
+def prefetch_mode(tree_dir, work_dir):
+    parser = ConfigParser(tree_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        prefetch_includes(parser, os.path.join(tree_dir, ROOT_FILENAME), jobs=4)
+    return merged_state(parse_quietly(parser, os.path.join(tree_dir, ROOT_FILENAME)))
+
+
+def filesystem_source_mode(tree_dir, work_dir):
+    parser = ConfigParser(tree_dir, file_source=FilesystemSource(tree_dir))
+    return merged_state(parse_quietly(parser, os.path.join(tree_dir, ROOT_FILENAME)))
+
+
+def archive_state(archive_path):
+    """
+    Returns the merged state of the tree stored in an archive. The output is left out: sections list their files in
+    the order of a set of absolute paths, which differs for paths inside the archive.
+    """
+
+    with open_archive_source(archive_path) as source:
+        root = source.find_root(ROOT_FILENAME)
+        state = merged_state(parse_quietly(ConfigParser(os.path.dirname(root), file_source=source), root))
+    del state['output']
+    return state
+
+
+def zip_mode(tree_dir, work_dir):
+    archive_path = os.path.join(work_dir, 'tree.zip')
+    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for directory, _, filenames in os.walk(tree_dir):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                archive.write(path, os.path.join('config', os.path.relpath(path, tree_dir)))
+    return archive_state(archive_path)
+
+
+def tar_mode(tree_dir, work_dir):
+    archive_path = os.path.join(work_dir, 'tree.tar.gz')
+    with tarfile.open(archive_path, 'w:gz') as archive:
+        archive.add(tree_dir, 'config')
+    return archive_state(archive_path)
+
+
+def commit_tree(tree_dir, work_dir):
+    """
+    Commits a tree to a new bare repository in work_dir and returns (repository directory, root tree ID). The
+    repository lives outside of the tree, so the files keep their paths.
+    """
+
+    git_dir = os.path.join(work_dir, 'repo.git')
+    run_git(work_dir, 'init', '-q', '--bare', git_dir)
+    run_git(tree_dir, f'--git-dir={git_dir}', f'--work-tree={tree_dir}', 'add', '-A', '.')
+    run_git(tree_dir, f'--git-dir={git_dir}', f'--work-tree={tree_dir}', '-c', 'user.name=fuzz',
+            '-c', 'user.email=fuzz@localhost', '-c', 'core.autocrlf=false', 'commit', '-q', '-m', 'fuzz')
+    return git_dir, run_git(git_dir, 'rev-parse', 'HEAD^{tree}').strip()
+
+
+def git_mode(tree_dir, work_dir):
+    git_dir, tree_id = commit_tree(tree_dir, work_dir)
+    with GitObjectReader(git_dir) as reader:
+        parser = ConfigParser(tree_dir, file_source=GitTreeSource(reader, tree_dir, tree_id))
+        return merged_state(parse_quietly(parser, os.path.join(tree_dir, ROOT_FILENAME)))
+
+
+def history_mode(tree_dir, work_dir):
+    # History merges keep no gcode blocks and no comments, only the values of the keys
+    git_dir, tree_id = commit_tree(tree_dir, work_dir)
+    with GitObjectReader(git_dir) as reader:
+        parser = HistoryParser(tree_dir, GitTreeSource(reader, tree_dir, tree_id))
+        state = merged_state(parse_quietly(parser, os.path.join(tree_dir, ROOT_FILENAME)))
+    return {'values': state['values'], 'files': state['files'], 'save_config': state['save_config']}
+
+
+def snapshot_mode(tree_dir, work_dir):
+    snapshot_path = os.path.join(work_dir, 'merged.kfsnap')
+    parse_quietly(ConfigParser(tree_dir), os.path.join(tree_dir, ROOT_FILENAME)).write_snapshot(snapshot_path)
+    return merged_state(ConfigParser.from_snapshot(snapshot_path))
+
+
+def effective_mode(tree_dir, work_dir):
+    parser = parse_quietly(ConfigParser(tree_dir, effective_only=True), os.path.join(tree_dir, ROOT_FILENAME))
+    return {'effective': ''.join(parser.iter_effective_output())}
+
+
+def fleet_mode(tree_dir, work_dir):
+    output_filepath = os.path.join(work_dir, 'output.cfg')
+    result = merge_printer(os.path.join(tree_dir, ROOT_FILENAME), output_filepath, hide_unmodified=False,
+                           use_cache=False)
+    if result['status'] == 'failed':
+        raise RuntimeError(result['error'])
+    with open(output_filepath, encoding='utf-8') as file:
+        return {'output': file.read()}
+
+
+def watch_mode(tree_dir, work_dir):
+    # Every file is edited and restored again, each time followed by an incremental merge of the watch session
+    output_filepath = os.path.join(work_dir, 'output.cfg')
+    session = WatchSession(os.path.join(tree_dir, ROOT_FILENAME), tree_dir, output_filepath, hide_unmodified=False)
+
+    def merge():
+        with contextlib.redirect_stdout(io.StringIO()):
+            session.merge()
+        with open(output_filepath, encoding='utf-8', newline='') as file:
+            return file.read()
+
+    merge()
+    edit_each_file(tree_dir, lambda: check_incremental_output(tree_dir, merge()))
+    state = merged_state(session.parser)
+    state['output'] = merge()
+    return state
+
+
+def serve_mode(tree_dir, work_dir):
+    # Every file is edited and restored again, each time followed by a request that reloads the stale state
+    root = os.path.join(tree_dir, ROOT_FILENAME)
+    states = MergedStateCache(SERVE_CACHE_BYTES, ParseCache(os.path.join(work_dir, 'cache')))
+    states.render(root, hide_unmodified=False)
+    edit_each_file(tree_dir, lambda: check_incremental_output(tree_dir, states.render(root, hide_unmodified=False)))
+    state = merged_state(states.get(root).parser)
+    state['output'] = states.render(root, hide_unmodified=False)
+    state['effective'] = states.render(root, hide_unmodified=False, effective_only=True)
+    return state
+
+
+def overlay_case(files):
+    """
+    Returns the case as the overlay mode's reference merges it: the root includes an overlay file right before its
+    SAVE_CONFIG block. The overlay holds the text of the last other file of the case, or of the root when there is
+    none.
+    """
+
+    lines = SOURCE_LINE_PATTERN.findall(files[ROOT_FILENAME])
+    end = next((position for position, line in enumerate(lines)
+                if line.startswith(SAVE_CONFIG_PREFIX) and SAVE_CONFIG_MARKER in line), len(lines))
+    if not save_config_intact(lines[end + 1:]):
+        end = len(lines)
+    head = ''.join(lines[:end])
+    if head and not head.endswith(('\r', '\n')):
+        head += '\n'
+    others = sorted(path for path in files if path != ROOT_FILENAME)
+    case = dict(files)
+    case[ROOT_FILENAME] = head + OVERLAY_INCLUDE + ''.join(lines[end:])
+    case[OVERLAY_FILENAME] = files[others[-1]] if others else head
+    return case
+
+
+def overlay_state(tree_dir, work_dir, use_snapshot):
+    """
+    Returns the merged state of the overlay file of a case prepared by overlay_case, layered on a base merged from
+    the root without the include of the overlay, or on a snapshot of that base. The base is written to the path of
+    the root, so the file sets of the sections iterate alike.
+    """
+
+    root = os.path.join(tree_dir, ROOT_FILENAME)
+    with open(root, encoding='utf-8', newline='') as file:
+        text = file.read()
+    with open(root, 'w', encoding='utf-8', newline='') as file:
+        file.write(text.replace(OVERLAY_INCLUDE, '', 1))
+    try:
+        base = parse_quietly(ConfigParser(tree_dir), root)
+    finally:
+        with open(root, 'w', encoding='utf-8', newline='') as file:
+            file.write(text)
+    if use_snapshot:
+        snapshot_path = os.path.join(work_dir, 'base.kfsnap')
+        base.write_snapshot(snapshot_path)
+        base = ConfigParser.from_snapshot(snapshot_path)
+    base_output = ''.join(base.iter_output(False))
+    overlay = OverlayParser(base)
+    with contextlib.redirect_stdout(io.StringIO()):
+        overlay.add_file(os.path.join(tree_dir, OVERLAY_FILENAME))
+        overlay.finish()
+    overlay.change_report()
+    if ''.join(base.iter_output(False)) != base_output:
+        raise RuntimeError("The overlay changed its base.")
+
+    # The overlay records only the files it read itself
+    state = merged_state(overlay)
+    base_files = merged_state(base)['files']
+    state['files'] = {kind: sorted(set(base_files[kind]) | set(state['files'][kind])) for kind in base_files}
+    return state
+
+
+def overlay_mode(tree_dir, work_dir):
+    return overlay_state(tree_dir, work_dir, False)
+
+
+def overlay_snapshot_mode(tree_dir, work_dir):
+    return overlay_state(tree_dir, work_dir, True)
+
+
+# Mode name -> (function returning the merged state of a tree, or a part of it, whether the mode includes glob
+# matches in sorted order, and a function that changes the case before the mode and its reference merge it, or
+# None). Only the parts of the state a mode returns are compared.
+MODES = {
+    'lexer': (lexer_mode, False, None),
+    'keep-sources': (keep_sources_mode, False, None),
+    'cache-cold': (cache_cold_mode, False, None),
+    'cache-warm': (cache_warm_mode, False, None),
+    'content-store': (content_store_mode, False, None),
+    'prefetch': (prefetch_mode, False, None),
+    'filesystem-source': (filesystem_source_mode, True, None),
+    'zip': (zip_mode, True, None),
+    'tar': (tar_mode, True, None),
+    'git': (git_mode, True, None),
+    'snapshot': (snapshot_mode, False, None),
+    'effective-only': (effective_mode, False, None),
+    'fleet': (fleet_mode, False, None),
+    'watch': (watch_mode, False, None),
+    'serve': (serve_mode, False, None),
+    'overlay': (overlay_mode, False, overlay_case),
+    'overlay-snapshot': (overlay_snapshot_mode, False, overlay_case),
+    'history': (history_mode, True, None),
+}
+
+
+def short_repr(value):
+    """
+    Returns the repr of a value, shortened to MAX_REPR_LENGTH characters.
+    """
+
+    text = repr(value)
+    return text if len(text) <= MAX_REPR_LENGTH else text[:MAX_REPR_LENGTH] + '...'
+
+
+def first_difference(expected, actual, path='state'):
+    """
+    Returns a description of the first place where two nested values differ, or None when they are equal. Texts are
+    compared line by line.
+    """
+
+    if expected == actual:
+        return None
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        for key in list(expected) + [key for key in actual if key not in expected]:
+            if key not in actual or key not in expected:
+                return f"{path}.{key}: {'missing' if key not in actual else 'unexpected'}"
+            difference = first_difference(expected[key], actual[key], f"{path}.{key}")
+            if difference is not None:
+                return difference
+    elif isinstance(expected, str) and isinstance(actual, str) and ('\n' in expected or '\n' in actual):
+        expected_lines, actual_lines = expected.splitlines(True), actual.splitlines(True)
+        for number, (expected_line, actual_line) in enumerate(zip(expected_lines, actual_lines), 1):
+            if expected_line != actual_line:
+                return f"{path} line {number}: expected {short_repr(expected_line)}, got {short_repr(actual_line)}"
+        return f"{path}: {len(expected_lines)} lines expected, got {len(actual_lines)}"
+    elif isinstance(expected, (list, tuple)) and isinstance(actual, (list, tuple)):
+        for index, (expected_item, actual_item) in enumerate(zip(expected, actual)):
+            difference = first_difference(expected_item, actual_item, f"{path}[{index}]")
+            if difference is not None:
+                return difference
+        return f"{path}: {len(expected)} items expected, got {len(actual)}"
+    return f"{path}: expected {short_repr(expected)}, got {short_repr(actual)}"
+
+
+def check_case(files, modes, timings=None):
+    """
+    Writes a case (a dictionary of relative path to text) to a temporary directory, merges it with the reference
+    parser and with every mode, and returns a dictionary of mode name -> description of the first difference for
+    the modes that disagree with the reference. Modes that change the case get a tree and references of their own.
+    The seconds every mode took are added to timings when given.
+    """
+
+    failures = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        trees = {}  # Case preparation -> tree directory
+        references = {}
+        for mode in modes:
+            function, sorted_globs, prepare = MODES[mode]
+            if prepare not in trees:
+                trees[prepare] = os.path.join(work_dir, f"tree_{prepare.__name__}" if prepare else 'tree')
+                os.makedirs(trees[prepare])
+                write_config_files(trees[prepare], prepare(files) if prepare else files)
+            tree_dir = trees[prepare]
+            if (prepare, sorted_globs) not in references:
+                parser_class = SortedReferenceParser if sorted_globs else ReferenceParser
+                references[prepare, sorted_globs] = merged_state(parse_quietly(parser_class(tree_dir),
+                                                                               os.path.join(tree_dir, ROOT_FILENAME)))
+            mode_dir = os.path.join(work_dir, mode)
+            os.makedirs(mode_dir)
+            start = time.perf_counter()
+            try:
+                state = function(tree_dir, mode_dir)
+            except Exception as e:
+                failures[mode] = f"{type(e).__name__}: {e}"
+                continue
+            finally:
+                if timings is not None:
+                    timings[mode] = timings.get(mode, 0.0) + time.perf_counter() - start
+            reference = references[prepare, sorted_globs]
+            difference = first_difference({field: reference[field] for field in state}, state)
+            if difference is not None:
+                failures[mode] = difference
+    return failures
+
+
+def save_config_tail_difference(state):
+    """
+    Returns how the reference's merged state of SAVE_CONFIG_TAIL_CASE differs from what Klipper reads, or None.
+    """
+
+    values = {section_name: {key: value for key, _, value in keys} for section_name, _, keys in state['values']}
+    if values.get('stepper_x', {}).get('step_pin') != 'PA1':
+        return "the section after the SAVE_CONFIG block is missing"
+    if state['save_config'] is not None or values.get('printer', {}).get('kinematics') != 'corexy':
+        return "the modified SAVE_CONFIG block was applied"
+    return None
+
+
+# Fixed cases checked before the random ones: label, files and a function returning how the reference's merged state
+# differs from the expected one, or None
+KNOWN_CASES = [('save_config_tail', SAVE_CONFIG_TAIL_CASE, save_config_tail_difference)]
+
+
+def check_known_cases():
+    """
+    Merges the known cases with the reference parser and returns a dictionary of label -> description of how the
+    merged state differs from the expected one, for the cases that fail.
+    """
+
+    failures = {}
+    for label, files, difference_of in KNOWN_CASES:
+        with tempfile.TemporaryDirectory() as tree_dir:
+            write_config_files(tree_dir, files)
+            state = merged_state(parse_quietly(ReferenceParser(tree_dir), os.path.join(tree_dir, ROOT_FILENAME)))
+        difference = difference_of(state)
+        if difference is not None:
+            failures[label] = difference
+    return failures
+
+
+def simplified_lines(line):
+    """
+    Yields simpler variants of a line: with LF instead of CRLF, spaces instead of tabs, without its comment, and
+    without surrounding whitespace.
+    """
+
+    ending = line[len(line.rstrip('\r\n')):]
+    content = line[:len(line) - len(ending)]
+    if ending == '\r\n':
+        yield content + '\n'
+    if '\t' in content:
+        yield content.replace('\t', ' ') + ending
+    if '#' in content:
+        yield content[:content.index('#')].rstrip() + ending
+    if content != content.strip():
+        yield content.strip() + ending
+
+
+def shrink_case(files, mode, progress=None):
+    """
+    Reduces a case that fails in mode to a small one that still fails in mode. Files are dropped first, then ever
+    smaller runs of lines, then the remaining lines are simplified, until nothing can be removed anymore. Returns the
+    reduced case.
+    """
+
+    case = {path: LINE_PATTERN.findall(text) for path, text in files.items()}
+
+    def joined(candidate):
+        return {path: ''.join(lines) for path, lines in candidate.items()}
+
+    def fails(candidate):
+        return mode in check_case(joined(candidate), [mode])
+
+    changed = True
+    while changed:
+        changed = False
+        for path in [path for path in case if path != ROOT_FILENAME]:
+            candidate = {other: lines for other, lines in case.items() if other != path}
+            if fails(candidate):
+                case, changed = candidate, True
+
+        for path in case:
+            chunk = max(1, len(case[path]) // 2)
+            while chunk:
+                start = 0
+                while start < len(case[path]):
+                    candidate = dict(case)
+                    candidate[path] = case[path][:start] + case[path][start + chunk:]
+                    if fails(candidate):
+                        case, changed = candidate, True
+                    else:
+                        start += chunk
+                chunk //= 2
+
+        for path in case:
+            for index in range(len(case[path])):
+                for line in simplified_lines(case[path][index]):
+                    candidate = dict(case)
+                    candidate[path] = case[path][:index] + [line] + case[path][index + 1:]
+                    if fails(candidate):
+                        case, changed = candidate, True
+                        break
+        if progress and changed:
+            progress(f"  shrunk to {len(case)} file(s), {sum(map(len, case.values()))} line(s)")
+    return joined(case)
+
+
+def write_case(case_dir, files, difference):
+    """
+    Writes a case and the difference it produces to case_dir, replacing what was there.
+    """
+
+    shutil.rmtree(case_dir, ignore_errors=True)
+    write_config_files(case_dir, files)
+    with open(os.path.join(case_dir, DIFFERENCE_FILENAME), 'w', encoding='utf-8') as file:
+        file.write(difference + '\n')
+
+
+def read_case(case_dir):
+    """
+    Reads the configuration files of a case written by write_case.
+    """
+
+    files = {}
+    for directory, _, filenames in os.walk(case_dir):
+        for filename in filenames:
+            if filename.endswith('.cfg'):
+                path = os.path.join(directory, filename)
+                with open(path, encoding='utf-8', newline='') as file:
+                    files[os.path.relpath(path, case_dir).replace(os.sep, '/')] = file.read()
+    return files
+
+
+def format_case(files):
+    """
+    Formats the files of a case with visible line endings and tabs.
+    """
+
+    lines = []
+    for path, text in files.items():
+        lines.append(f"--- {path}")
+        lines.extend(f"  {line!r}" for line in LINE_PATTERN.findall(text))
+    return '\n'.join(lines)
+
+
+@click.command()
+@click.option('--iterations', default=200, show_default=True, help='Number of random cases to check.')
+@click.option('--seed', default=0, show_default=True, help='Seed of the first case; case N uses seed + N.')
+@click.option('--mode', 'modes', multiple=True, type=click.Choice(list(MODES)),
+              help='Check only this mode. Can be given multiple times; all modes are checked by default.')
+@click.option('--max-files', default=6, show_default=True, help='Maximum number of files in a case.')
+@click.option('--max-lines', default=30, show_default=True, help='Maximum number of generated lines per file.')
+@click.option('--output-dir', default='fuzz_failures', show_default=True,
+              help='Directory the shrunk reproducers are written to.')
+@click.option('--max-failures', default=3, show_default=True, help='Stop after this many failing cases.')
+@click.option('--no-shrink', is_flag=True, help='Write failing cases as generated.')
+@click.option('--replay', 'replay_dirs', multiple=True,
+              help='Check the cases in these directories, e.g. reproducers written earlier, instead of random ones.')
+def main(iterations, seed, modes, max_files, max_lines, output_dir, max_failures, no_shrink, replay_dirs):
+    """
+    Merges random edge-case configuration trees with the reference parser and every optimized mode and reports the
+    modes whose merged state differs.
+    """
+
+    modes = list(modes or MODES)
+    if 'git' in modes and shutil.which('git') is None:
+        print("git is not installed; skipping the git mode.")
+        modes.remove('git')
+
+    if replay_dirs:
+        cases = [(case_dir, read_case(case_dir)) for case_dir in replay_dirs]
+    else:
+        cases = ((f"seed {seed + iteration}",
+                  generate_edge_case_files(seed + iteration, max_files, max_lines)) for iteration in range(iterations))
+
+    timings = {}
+    checked = 0
+    failed = 0
+    start = time.perf_counter()
+    if not replay_dirs:
+        for label, difference in check_known_cases().items():
+            print(f"FAILED reference on known case {label}: {difference}")
+            failed += 1
+        cases = itertools.chain(((f"known case {label}", files) for label, files, _ in KNOWN_CASES), cases)
+    for label, files in cases:
+        failures = check_case(files, modes, timings)
+        checked += 1
+        failed += bool(failures)
+        for mode, difference in failures.items():
+            print(f"FAILED {mode} on {label}: {difference}")
+            if replay_dirs:
+                continue
+            if not no_shrink:
+                files = shrink_case(files, mode, print)
+                difference = check_case(files, [mode]).get(mode, difference)
+                print(f"  minimal difference: {difference}")
+            case_dir = os.path.join(output_dir, f"{mode}_{label.replace(' ', '_')}")
+            write_case(case_dir, files, difference)
+            print(format_case(files))
+            print(f"  written to {case_dir}; check again with --replay '{case_dir}'")
+        if failed >= max_failures:
+            print(f"Stopping after {failed} failing case(s).")
+            break
+
+    elapsed = time.perf_counter() - start
+    print(f"{checked} case(s) checked against {len(modes)} mode(s) in {elapsed:.2f} s, {failed} failed.")
+    for mode in modes:
+        print(f"  {mode:18} {timings.get(mode, 0.0) * 1000 / max(checked, 1):8.2f} ms per case")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
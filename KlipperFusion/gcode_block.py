@@ -20,7 +20,189 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import difflib
+
+from source_reader import split_lines
+
+# Overridden gcode block versions are stored as reverse deltas, like RCS does: the newest version keeps its lines and
+# every older version only keeps a delta against the version that replaced it. A delta is a tuple whose items are
+# either a range of line indexes to copy from the newer version or a tuple of lines that only the older version has.
+# Overrides usually copy a macro and change a few lines, so the history costs little more than the changed lines.
+
+
+def encode_delta(lines, newer_lines):
+    """
+    Returns lines as a delta against newer_lines. The common prefix and suffix are matched directly, so only the
+    changed middle of the block goes through difflib.
+    """
+
+    shortest = min(len(lines), len(newer_lines))
+    prefix = 0
+    while prefix < shortest and lines[prefix] == newer_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < shortest - prefix and lines[-1 - suffix] == newer_lines[-1 - suffix]:
+        suffix += 1
+
+    delta = [range(0, prefix)] if prefix else []
+    matcher = difflib.SequenceMatcher(None, newer_lines[prefix:len(newer_lines) - suffix],
+                                      lines[prefix:len(lines) - suffix], autojunk=False)
+    for tag, newer_start, newer_end, start, end in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append(range(prefix + newer_start, prefix + newer_end))
+        elif end > start:
+            delta.append(tuple(lines[prefix + start:prefix + end]))
+    if suffix:
+        delta.append(range(len(newer_lines) - suffix, len(newer_lines)))
+    return tuple(delta)
+
+
+def apply_delta(delta, newer_lines):
+    """
+    Rebuilds the lines that encode_delta encoded against newer_lines.
+    """
+
+    lines = []
+    for part in delta:
+        if type(part) is range:
+            lines.extend(newer_lines[part.start:part.stop])
+        else:
+            lines.extend(part)
+    return lines
+
+
+def delta_opcodes(delta, newer_length):
+    """
+    Returns the difflib-style opcodes (tag, i1, i2, j1, j2) that turn the version encoded by delta into the newer
+    version it was encoded against, so that overrides can be rendered as diffs without comparing the lines again.
+    """
+
+    opcodes = []
+    old = new = pending = 0  # pending counts older lines that wait for the next copied range
+    for part in delta + (range(newer_length, newer_length),):
+        if type(part) is not range:
+            pending += len(part)
+            continue
+        if pending or part.start > new:
+            tag = 'insert' if not pending else 'delete' if part.start == new else 'replace'
+            opcodes.append((tag, old, old + pending, new, part.start))
+            old += pending
+            pending = 0
+        if part:
+            opcodes.append(('equal', old, old + len(part), part.start, part.stop))
+            old += len(part)
+        new = part.stop
+    return opcodes
+
+
+def format_hunk_range(start, stop):
+    """
+    Formats a line range of a unified diff hunk header.
+    """
+
+    length = stop - start
+    if length == 1:
+        return str(start + 1)
+    return f"{start + 1 if length else start},{length}"
+
+
+def iter_unified_hunks(older, newer, opcodes, context=1):
+    """
+    Yields the hunks of a unified diff between two versions of a block from their opcodes, with context lines of
+    unchanged gcode around every change.
+    """
+
+    groups = []
+    group = []  # The hunk being collected; it only counts once it holds a change
+    changed = False
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag != 'equal':
+            group.append((tag, i1, i2, j1, j2))
+            changed = True
+        elif not changed:
+            group = [(tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2)]
+        elif i2 - i1 > 2 * context:
+            group.append((tag, i1, i1 + context, j1, j1 + context))
+            groups.append(group)
+            group = [(tag, i2 - context, i2, j2 - context, j2)]
+            changed = False
+        else:
+            group.append((tag, i1, i2, j1, j2))
+    if changed:
+        tag, i1, i2, j1, j2 = group[-1]
+        if tag == 'equal':
+            group[-1] = (tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context))
+        groups.append(group)
+
+    for group in groups:
+        first, last = group[0], group[-1]
+        yield f"@@ -{format_hunk_range(first[1], last[2])} +{format_hunk_range(first[3], last[4])} @@"
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in older[i1:i2]:
+                    yield f" {line}"
+                continue
+            for line in older[i1:i2]:
+                yield f"-{line}"
+            for line in newer[j1:j2]:
+                yield f"+{line}"
+
+
+def expand_versions(blocks):
+    """
+    Returns the lines of every version in a list of GCodeBlocks, oldest first. Each version is rebuilt from the one
+    after it, so the whole history is decoded in one pass instead of walking the delta chain once per version.
+    """
+
+    versions = [None] * len(blocks)
+    lines = None
+    for position in range(len(blocks) - 1, -1, -1):
+        block = blocks[position]
+        if block.delta is not None and position + 1 < len(blocks) and block.newer is blocks[position + 1]:
+            lines = apply_delta(block.delta, lines)
+        else:
+            lines = block.lines
+        versions[position] = lines
+    return versions
+
+
+def iter_history_diff(blocks, relpath, hide_unmodified=True):
+    """
+    Yields a gcode block with its overrides rendered as commented unified diffs between consecutive versions, each
+    labelled with the file that made the change, followed by the effective version in full.
+    """
+
+    latest = blocks[-1]
+    if len(blocks) == 1:
+        if hide_unmodified:
+            yield f"{latest.name}: # UNMODIFIED\n\n"
+            return
+        yield from latest.iter_block(hide_unmodified=False)
+        return
+
+    versions = [[line.rstrip('\n') for line in lines] for lines in expand_versions(blocks)]
+    yield "\n"
+    yield f"# {latest.name} defined in {relpath(blocks[0].filename) if blocks[0].filename else 'an unknown file'}\n"
+    for position in range(1, len(blocks)):
+        filename = blocks[position].filename
+        yield f"# {latest.name} overridden in {relpath(filename) if filename else 'an unknown file'}\n"
+        older, newer = versions[position - 1], versions[position]
+        block = blocks[position - 1]
+        if block.delta is not None and block.newer is blocks[position]:
+            opcodes = delta_opcodes(block.delta, len(newer))
+        else:
+            opcodes = difflib.SequenceMatcher(None, older, newer, autojunk=False).get_opcodes()
+        for line in iter_unified_hunks(older, newer, opcodes):
+            yield f"# {line}\n"
+    yield "\n"
+    yield f"{latest.name}:\n"
+    for line in versions[-1]:
+        yield f"{line}\n"
+
+
 class GCodeBlock:
+    __slots__ = ('name', 'filename', '_lines', 'delta', 'newer', 'preceding_comments', 'older_versions')
+
     def __init__(self, name, filename=''):
         """
         Initializes a new GCodeBlock with a name and optionally a filename where the block is defined.
@@ -28,16 +210,64 @@ class GCodeBlock:
 
         self.name = name
         self.filename = filename  # Track the filename where the block is defined
-        self.lines = []
-        self.preceding_comments = []
-        self.older_versions = []
+        self._lines = []
+        self.delta = None  # Set once a newer version replaces this one, see encode_against
+        self.newer = None
+        self.preceding_comments = ()
+        self.older_versions = ()  # Becomes a list once a version is finalized
+
+    @property
+    def lines(self):
+        """
+        The gcode lines of this version. A version that was replaced by a newer one is rebuilt from its delta, and
+        packed lines are split again.
+        """
+
+        if self.delta is None:
+            lines = self._lines
+            return split_lines(lines) if type(lines) is str else lines
+        deltas = []
+        block = self
+        while block.delta is not None:
+            deltas.append(block.delta)
+            block = block.newer
+        lines = block._lines
+        for delta in reversed(deltas):
+            lines = apply_delta(delta, lines)
+        return lines
+
+    @lines.setter
+    def lines(self, lines):
+        self._lines = lines
+        self.delta = None
+        self.newer = None
+
+    def pack(self, lines):
+        """
+        Stores lines joined into a single string, which takes far less memory than a list of line strings. Used for
+        blocks that are never extended or overridden afterwards; the lines property splits them again on access.
+        Lines are only packed when every line but the last ends with '\n', so that splitting restores them exactly.
+        """
+
+        text = ''.join(lines)
+        if text and len(lines) == text.count('\n') + (not text.endswith('\n')):
+            self.lines = text
+        else:
+            self.lines = list(lines)
+
+    def encode_against(self, newer):
+        """
+        Replaces the lines of this version by a delta against newer, the version that overrides it.
+        """
+
+        self.delta, self._lines, self.newer = encode_delta(self.lines, newer.lines), None, newer
 
     def add_line(self, line):
         """
         Appends a new line of G-code to the current block.
         """
 
-        self.lines.append(line)
+        self._lines.append(line)
 
     def set_preceding_comments(self, comments):
         """
@@ -56,8 +286,8 @@ class GCodeBlock:
             if self.lines or self.preceding_comments:
                 old_version = GCodeBlock(self.name, self.filename)
                 old_version.lines = self.lines.copy()
-                old_version.preceding_comments = self.preceding_comments.copy()
-                self.older_versions.append(old_version)
+                old_version.preceding_comments = tuple(self.preceding_comments)
+                self.older_versions = [*self.older_versions, old_version]
         except Exception as e:
             print(f"Error finalizing GCodeBlock '{self.name}': {e}")
 
@@ -74,26 +304,31 @@ class GCodeBlock:
         blocks are marked accordingly.
         """
 
+        return ''.join(self.iter_block(hide_unmodified))
+
+    def iter_block(self, hide_unmodified=True, lines=None):
+        """
+        Yields the textual representation of the G-code block piece by piece, so that it can be streamed to a file.
+        Callers that already decoded the lines of this version (see expand_versions) can pass them in.
+        """
+
         try:
             if hide_unmodified and not self.has_modifications():
-                return f"{self.name}: # UNMODIFIED\n\n"
+                yield f"{self.name}: # UNMODIFIED\n\n"
+                return
 
-            output = ""
             if self.older_versions:
-                output += "\n"  # Ensure there's a starting newline for separation
+                yield "\n"  # Ensure there's a starting newline for separation
                 for version in self.older_versions:
-                    output += "# Previous version defined in {}\n".format(version.filename)
+                    yield "# Previous version defined in {}\n".format(version.filename)
                     for comment in version.preceding_comments:
-                        output += "# {}\n".format(comment.rstrip('\n'))
+                        yield "# {}\n".format(comment.rstrip('\n'))
                     for line in version.lines:
-                        output += "# {}\n".format(line.rstrip('\n'))
-            if output:
-                output += "\n"
-            output += "{}:\n".format(self.name)
-            for line in self.lines:
-                output += "{}\n".format(line.rstrip('\n'))
-            return output
+                        yield "# {}\n".format(line.rstrip('\n'))
+                yield "\n"
+            yield "{}:\n".format(self.name)
+            for line in self.lines if lines is None else lines:
+                yield "{}\n".format(line.rstrip('\n'))
 
         except Exception as e:
             print(f"Error writing GCodeBlock '{self.name}': {e}")
-            return ""
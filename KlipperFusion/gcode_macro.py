@@ -21,6 +21,8 @@
 # SOFTWARE.
 
 class GCodeMacro:
+    __slots__ = ('name', 'filename', 'definitions', 'current_gcode_lines', 'parameters')
+
     def __init__(self, name, filename):
         """
         Initializes a new GCodeMacro with a name and filename.
@@ -0,0 +1,439 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import contextlib
+import errno
+import os
+import subprocess
+import threading
+import time
+
+from config_index import parse_selector
+from config_lexer import TOKEN_GCODE_START, TOKEN_LINE, tokenize_text
+from config_parser import ConfigParser
+from file_source import FileSource
+from file_table import filename_of
+from save_config import SAVE_CONFIG_MARKER, SAVE_CONFIG_PREFIX
+
+# Modes of git tree entries.
+GIT_MODE_TREE = b'40000'
+GIT_MODE_SYMLINK = b'120000'
+GIT_MODE_SUBMODULE = b'160000'
+MAX_SYMLINK_DEPTH = 8
+
+
+class GitError(Exception):
+    """Raised when a git command fails or an object cannot be read."""
+
+
+def run_git(repo_dir, *args):
+    """
+    Runs a git command in repo_dir and returns its standard output. Raises GitError when it fails.
+    """
+
+    try:
+        result = subprocess.run(['git', *args], cwd=repo_dir, capture_output=True, check=True)
+    except FileNotFoundError:
+        raise GitError("git is not installed.")
+    except subprocess.CalledProcessError as e:
+        raise GitError(e.stderr.decode(errors='replace').strip() or f"git {args[0]} failed.")
+    return result.stdout.decode()
+
+
+class GitObjectReader:
+    """Reads objects of a git repository over one persistent `git cat-file --batch` process, instead of starting a
+    git process per object. Trees are parsed once per object ID and kept, so the directories shared by many commits
+    are read only once."""
+
+    def __init__(self, repo_dir):
+        """
+        Starts the cat-file process for the repository containing repo_dir.
+        """
+
+        self.repo_dir = repo_dir
+        self.process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=repo_dir, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self.lock = threading.Lock()
+        self.trees = {}  # Tree ID -> {name: (mode, object ID)}
+        self.objects_read = 0
+
+    def read(self, object_id):
+        """
+        Returns (type, data) of an object. Raises GitError when the object does not exist.
+        """
+
+        with self.lock:
+            self.process.stdin.write(object_id.encode() + b'\n')
+            self.process.stdin.flush()
+            header = self.process.stdout.readline().split()
+            if len(header) != 3:
+                raise GitError(f"Cannot read git object {object_id}.")
+            data = self.process.stdout.read(int(header[2]))
+            self.process.stdout.read(1)
+            self.objects_read += 1
+        return header[1].decode(), data
+
+    def read_tree(self, tree_id):
+        """
+        Returns the entries of a tree as a dictionary of name -> (mode, object ID).
+        """
+
+        entries = self.trees.get(tree_id)
+        if entries is None:
+            _, data = self.read(tree_id)
+            id_size = len(tree_id) // 2
+            entries = {}
+            position = 0
+            while position < len(data):
+                space = data.index(b' ', position)
+                end = data.index(b'\0', space)
+                entries[data[space + 1:end].decode('utf-8', 'surrogateescape')] = \
+                    (data[position:space], data[end + 1:end + 1 + id_size].hex())
+                position = end + 1 + id_size
+            self.trees[tree_id] = entries
+        return entries
+
+    def read_commit(self, commit_id):
+        """
+        Returns the tree ID, committer timestamp and subject of a commit.
+        """
+
+        _, data = self.read(commit_id)
+        header, _, message = data.decode('utf-8', 'replace').partition('\n\n')
+        tree_id = None
+        timestamp = 0
+        for line in header.split('\n'):
+            if line.startswith('tree '):
+                tree_id = line[5:]
+            elif line.startswith('committer '):
+                timestamp = int(line.rsplit(' ', 2)[1])
+        return tree_id, timestamp, message.split('\n', 1)[0]
+
+    def close(self):
+        """
+        Stops the cat-file process.
+        """
+
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class GitTreeSource(FileSource):
+    """The files of one git commit, presented below the worktree directory of the repository. Content keys are blob
+    IDs, so a file is tokenized once for all commits and paths that share its blob when the sources of those commits
+    share a token cache. Symbolic links to files inside the repository are followed."""
+
+    def __init__(self, reader, root_dir, tree_id, token_cache=None):
+        """
+        Initializes the source for the root tree tree_id of a commit, read through a GitObjectReader.
+        """
+
+        super().__init__(root_dir, token_cache)
+        self.reader = reader
+        self.tree_id = tree_id
+        self.entries = {}  # Relative path -> (mode, object ID) or None
+
+    def entry(self, relative, depth=0):
+        """
+        Returns (mode, object ID) of the entry at a relative path, following symbolic links, or None when it does not
+        exist.
+        """
+
+        if relative in self.entries:
+            return self.entries[relative]
+        entry = (GIT_MODE_TREE, self.tree_id)
+        for part in relative.split(os.sep) if relative else ():
+            if entry[0] != GIT_MODE_TREE:
+                entry = None
+                break
+            entry = self.reader.read_tree(entry[1]).get(part)
+            if entry is None:
+                break
+        if entry is not None and entry[0] == GIT_MODE_SYMLINK:
+            link = os.fsdecode(self.reader.read(entry[1])[1])
+            target = os.path.normpath(os.path.join(os.path.dirname(relative), link))
+            entry = None
+            if depth < MAX_SYMLINK_DEPTH and not os.path.isabs(target) and not target.startswith(os.pardir):
+                entry = self.entry('' if target == os.curdir else target, depth + 1)
+        self.entries[relative] = entry
+        return entry
+
+    def content_key(self, relative):
+        entry = self.entry(relative)
+        if entry is None or entry[0] in (GIT_MODE_TREE, GIT_MODE_SUBMODULE):
+            return None
+        return entry[1]
+
+    def read_bytes(self, relative):
+        object_id = self.content_key(relative)
+        if object_id is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), relative)
+        return self.reader.read(object_id)[1]
+
+    def listdir(self, relative):
+        entry = self.entry(relative)
+        if entry is None or entry[0] != GIT_MODE_TREE:
+            return None
+        return list(self.reader.read_tree(entry[1]))
+
+
+def list_commits(repo_dir, revision_range='HEAD', first_parent=True, max_count=None):
+    """
+    Returns the IDs of the commits in revision_range, oldest first. With first_parent only the first parent of merge
+    commits is followed, and with max_count only the most recent commits are returned.
+    """
+
+    args = ['rev-list', '--reverse']
+    if first_parent:
+        args.append('--first-parent')
+    if max_count:
+        args.append(f'--max-count={max_count}')
+    return run_git(repo_dir, *args, revision_range, '--').split()
+
+
+def strip_gcode_bodies(tokens):
+    """
+    Returns the tokens of a file that can change the value of a key: section, include and gcode block starts,
+    key-value lines and SAVE_CONFIG lines. The lines before the first of those are kept, because they continue a
+    gcode block left open by the previous file, and so are all lines after a SAVE_CONFIG header, because any other
+    line there means the block is not read. Gcode bodies and comments never set a key otherwise, so a parser that
+    stores no gcode blocks produces the same values from the stripped stream, in a fraction of the time.
+    """
+
+    kept = []
+    started = False
+    in_gcode_block = False
+    in_save_config = False
+    for token in tokens:
+        if in_save_config:
+            kept.append(token)
+        elif token[0] != TOKEN_LINE:
+            started = True
+            in_gcode_block = token[0] == TOKEN_GCODE_START
+            kept.append(token)
+        elif not started or token[1].startswith(SAVE_CONFIG_PREFIX) or (not in_gcode_block and token[2] is not None):
+            kept.append(token)
+            in_save_config = token[1].startswith(SAVE_CONFIG_PREFIX) and SAVE_CONFIG_MARKER in token[1]
+    return kept
+
+
+class HistoryParser(ConfigParser):
+    """ConfigParser that merges one commit for a history walk. It stores no gcode blocks and tokenizes files into
+    streams without gcode bodies and comments, which keep the values of all keys."""
+
+    def __init__(self, base_path, file_source):
+        """
+        Initializes a parser reading from file_source.
+        """
+
+        super().__init__(base_path, section_filter=(), file_source=file_source)
+
+    @staticmethod
+    def tokenize_text(text):
+        """
+        Tokenizes the text of a configuration file and strips the tokens that cannot set a key.
+        """
+
+        return strip_gcode_bodies(tokenize_text(text))
+
+
+class WarningCollector:
+    """A minimal text stream that collects the warning lines a ConfigParser prints while merging a commit."""
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def write(self, text):
+        self.lines.extend(line for line in text.split('\n') if line)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class ConfigHistory:
+    """How the merged configuration of a printer changed over the commits of the git repository holding it.
+
+    All commits are read through one GitObjectReader. Before a commit is merged, the blob IDs of the files the
+    previous merge read, the files it found missing and the matches of its glob includes are looked up in the tree
+    of the commit; when none of them changed, neither did the merged configuration and the commit is skipped. Token
+    streams are memoized by blob ID, so every distinct version of a file is read and tokenized once, and merging a
+    commit replays cached tokens without gcode bodies and comments (see HistoryParser). The final value of every key
+    is compared with the previous merge, and each change becomes an event on the timeline of its key, together with
+    the value chain of the key at that commit."""
+
+    def __init__(self, filename):
+        """
+        Initializes the history of the root configuration file filename, which must lie in a git worktree.
+        """
+
+        self.root = os.path.realpath(filename)
+        self.base_path = os.path.dirname(self.root)
+        self.repo_dir = os.path.realpath(run_git(self.base_path, 'rev-parse', '--show-toplevel').strip())
+        self.commits = []
+        self.timelines = {}  # (section name, key) -> list of events, oldest first
+        self.token_cache = {}  # Blob ID -> tokens
+        self.stats = {}
+
+    def walk(self, revision_range='HEAD', first_parent=True, max_count=None):
+        """
+        Walks the commits of revision_range and records the changes of every key. Returns self.
+        """
+
+        start = time.perf_counter()
+        commit_ids = list_commits(self.repo_dir, revision_range, first_parent, max_count)
+        previous_values = {}
+        previous_tree = None
+        closure = None
+        merged = 0
+        with GitObjectReader(self.repo_dir) as reader:
+            for commit_id in commit_ids:
+                tree_id, timestamp, subject = reader.read_commit(commit_id)
+                commit = {'commit': commit_id, 'date': time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp)),
+                          'subject': subject, 'merged': False}
+                self.commits.append(commit)
+                source = GitTreeSource(reader, self.repo_dir, tree_id, self.token_cache)
+                if tree_id == previous_tree or (closure is not None and self.closure_unchanged(source, closure)):
+                    previous_tree = tree_id
+                    continue
+                previous_tree = tree_id
+
+                parser = HistoryParser(self.base_path, source)
+                warnings = []
+                with contextlib.redirect_stdout(WarningCollector(warnings)):
+                    parser.parse_file(self.root)
+                commit['merged'] = True
+                if warnings:
+                    commit['warnings'] = warnings
+                merged += 1
+                closure = (dict(parser.parsed_files), set(parser.missing_files), dict(parser.glob_results))
+                values = {(name, key): kvp for name, section in parser.sections.items()
+                          for key, kvp in section.key_value_pairs.items()}
+                self.record_changes(commit, previous_values, values)
+                previous_values = values
+            self.stats = {'commits': len(commit_ids), 'merged': merged, 'skipped': len(commit_ids) - merged,
+                          'distinct_blobs': len(self.token_cache), 'trees': len(reader.trees),
+                          'objects_read': reader.objects_read, 'seconds': time.perf_counter() - start}
+        return self
+
+    @staticmethod
+    def closure_unchanged(source, closure):
+        """
+        Checks whether the files, missing files and glob matches a merge depended on are the same in source.
+        """
+
+        files, missing_files, glob_results = closure
+        return (all(source.content_key(source.relative_path(path)) == key for path, key in files.items())
+                and not any(source.exists(path) for path in missing_files)
+                and all(source.expand_glob(pattern) == matches for pattern, matches in glob_results.items()))
+
+    def relpath(self, filename):
+        """
+        Returns a file name relative to the directory of the root file.
+        """
+
+        return os.path.relpath(filename, self.base_path)
+
+    def event(self, commit, status, kvp):
+        """
+        Returns a timeline event for a key that was added, changed or moved to another file in commit.
+        """
+
+        event = {'commit': commit['commit'], 'date': commit['date'], 'subject': commit['subject'], 'status': status}
+        if kvp is not None:
+            event['value'] = kvp.value
+            event['file'] = self.relpath(kvp.filename)
+            event['chain'] = [{'file': self.relpath(filename_of(occurrence[0])), 'value': occurrence[1]}
+                              for occurrence in kvp.occurrences] + [{'file': event['file'], 'value': kvp.value}]
+        return event
+
+    def record_changes(self, commit, previous_values, values):
+        """
+        Adds an event to the timeline of every key whose final value or defining file differs from the previous merge.
+        """
+
+        for entry, kvp in values.items():
+            previous = previous_values.get(entry)
+            if previous is None:
+                status = 'added'
+            elif previous.value != kvp.value:
+                status = 'changed'
+            elif previous.file_id != kvp.file_id:
+                status = 'moved'
+            else:
+                continue
+            self.timelines.setdefault(entry, []).append(self.event(commit, status, kvp))
+        for entry in previous_values:
+            if entry not in values:
+                self.timelines.setdefault(entry, []).append(self.event(commit, 'removed', None))
+
+    def select(self, selectors=(), keys=()):
+        """
+        Returns the timelines of the keys named by 'SECTION.KEY' or 'SECTION' selectors and of the given keys in any
+        section, as (section, key, events) tuples. Without selectors and keys, the timelines of all keys that changed
+        after the first merged commit are returned.
+        """
+
+        parsed = [parse_selector(selector) for selector in selectors]
+        wanted_keys = set(keys)
+        first_merged = next((commit['commit'] for commit in self.commits if commit['merged']), None)
+        selected = []
+        for (section_name, key), events in self.timelines.items():
+            if parsed or wanted_keys:
+                if key not in wanted_keys and not any(section_name == name and wanted in (None, key)
+                                                      for name, wanted in parsed):
+                    continue
+            elif len(events) < 2 and events[0]['commit'] == first_merged:
+                continue
+            selected.append((section_name, key, events))
+        return selected
+
+    def to_dict(self, selectors=(), keys=()):
+        """
+        Returns the selected timelines, the walked commits and the walk statistics as a JSON-serializable dictionary.
+        """
+
+        return {'root': self.root, 'repository': self.repo_dir, 'commits': self.commits,
+                'keys': [{'section': section_name, 'key': key, 'events': events}
+                         for section_name, key, events in self.select(selectors, keys)],
+                'stats': self.stats}
+
+
+def format_timeline(section_name, key, events, chain=False):
+    """
+    Formats the timeline of a key for the terminal, optionally with the value chain of every event.
+    """
+
+    lines = [f"[{section_name}] {key}"]
+    for event in events:
+        value = f"{event['value']}  ({event['file']})" if 'value' in event else '(removed)'
+        lines.append(f"  {event['date']}  {event['commit'][:10]}  {event['status']:8} {value}  {event['subject']}")
+        if chain and len(event.get('chain', ())) > 1:
+            lines.extend(f"      {link['value']} <- {link['file']}" for link in event['chain'])
+    return '\n'.join(lines)
@@ -0,0 +1,211 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import fnmatch
+import glob
+import json
+import os
+
+
+class GlobCache:
+    """Memoizes glob expansion for the duration of one run.
+
+    Every pattern is expanded at most once, and the directory listing behind a pattern whose wildcards are all in
+    its last component (such as 'macros/*.cfg') is read at most once, however many patterns look into that
+    directory. Results are exactly those of glob.glob, in the same order."""
+
+    def __init__(self):
+        """
+        Initializes empty pattern and directory caches.
+        """
+
+        self.patterns = {}  # Pattern -> list of matching paths
+        self.listings = {}  # Directory -> list of entry names, in os.scandir order
+        self.listing_reads = 0
+
+    def listdir(self, directory):
+        """
+        Returns the entry names of a directory, reading it only on first use. Unreadable directories are empty.
+        """
+
+        names = self.listings.get(directory)
+        if names is None:
+            self.listing_reads += 1
+            try:
+                with os.scandir(directory) as entries:
+                    names = [entry.name for entry in entries]
+            except OSError:
+                names = []
+            self.listings[directory] = names
+        return names
+
+    def expand(self, pattern):
+        """
+        Returns the paths matching pattern.
+        """
+
+        matches = self.patterns.get(pattern)
+        if matches is None:
+            directory, name_pattern = os.path.split(pattern)
+            if glob.has_magic(directory) or not glob.has_magic(name_pattern) or not directory:
+                matches = glob.glob(pattern)
+            else:
+                names = self.listdir(directory)
+                if not name_pattern.startswith('.'):
+                    # glob.glob skips hidden files unless the pattern itself starts with a dot
+                    names = [name for name in names if not name.startswith('.')]
+                matches = [os.path.join(directory, name) for name in fnmatch.filter(names, name_pattern)]
+            self.patterns[pattern] = matches
+        return matches
+
+
+class IncludeGraph:
+    """The include graph of a configuration tree, built while it is parsed.
+
+    Edges are recorded in include order, from the including file to every file it pulls in (glob includes add an edge
+    per match and remember the pattern). The files currently being parsed are kept both as a stack and as a set, so
+    an include cycle is detected in O(1) when a file is entered a second time, and the stack gives the full chain for
+    the report."""
+
+    def __init__(self):
+        """
+        Initializes an empty graph.
+        """
+
+        self.root = None
+        self.files = {}  # Path -> depth at which the file was first included (the root has depth 0)
+        self.edges = []  # (parent, child, pattern or None), in include order
+        self.missing_files = set()
+        self.cycles = []  # Chains of paths, each ending with the file that closed the cycle
+        self.stack = []
+        self.active = set()
+
+    @property
+    def current(self):
+        """
+        The file currently being parsed, or None outside of a parse.
+        """
+
+        return self.stack[-1] if self.stack else None
+
+    def add_edge(self, child, pattern=None):
+        """
+        Records that the file currently being parsed includes child, optionally through a glob pattern.
+        """
+
+        parent = self.current
+        if parent is None:
+            self.root = child
+        else:
+            self.edges.append((parent, child, pattern))
+        if child not in self.files:
+            self.files[child] = len(self.stack)
+
+    def add_missing(self, path, pattern=None):
+        """
+        Records an include of a file that does not exist.
+        """
+
+        self.add_edge(path, pattern)
+        self.missing_files.add(path)
+
+    def enter(self, path):
+        """
+        Marks path as being parsed. Returns the cycle chain instead of entering when path is already being parsed,
+        or None when it was entered.
+        """
+
+        if path in self.active:
+            chain = self.stack[self.stack.index(path):] + [path]
+            self.cycles.append(chain)
+            return chain
+        self.stack.append(path)
+        self.active.add(path)
+        return None
+
+    def leave(self, path):
+        """
+        Marks path as parsed.
+        """
+
+        self.stack.pop()
+        self.active.discard(path)
+
+    def children(self, path):
+        """
+        Returns the files path includes, in include order.
+        """
+
+        return [child for parent, child, _ in self.edges if parent == path]
+
+    def to_dict(self, base_path=None):
+        """
+        Returns a JSON-serializable description of the graph. Paths are made relative to base_path when it is given.
+        """
+
+        relpath = (lambda path: os.path.relpath(path, base_path)) if base_path else str
+        return {
+            'root': relpath(self.root) if self.root else None,
+            'files': [{'path': relpath(path), 'depth': depth, 'missing': path in self.missing_files}
+                      for path, depth in self.files.items()],
+            'edges': [{'from': relpath(parent), 'to': relpath(child), 'glob': relpath(pattern) if pattern else None}
+                      for parent, child, pattern in self.edges],
+            'cycles': [[relpath(path) for path in chain] for chain in self.cycles],
+        }
+
+    def to_json(self, base_path=None):
+        """
+        Returns the graph as a JSON document.
+        """
+
+        return json.dumps(self.to_dict(base_path), indent=2)
+
+    def to_dot(self, base_path=None):
+        """
+        Returns the graph in Graphviz DOT format. Missing files are drawn dashed, glob edges are labelled with their
+        pattern and edges that close a cycle are drawn in red.
+        """
+
+        relpath = (lambda path: os.path.relpath(path, base_path)) if base_path else str
+        cycle_edges = {(chain[-2], chain[-1]) for chain in self.cycles}
+        lines = ['digraph includes {', '    rankdir=LR;', '    node [shape=box];']
+        for path in self.files:
+            style = ' [style=dashed]' if path in self.missing_files else ''
+            lines.append(f'    {json.dumps(relpath(path))}{style};')
+        for parent, child, pattern in self.edges:
+            attributes = []
+            if pattern:
+                attributes.append(f'label={json.dumps(os.path.basename(pattern))}')
+            if (parent, child) in cycle_edges:
+                attributes.append('color=red')
+            suffix = f" [{', '.join(attributes)}]" if attributes else ''
+            lines.append(f'    {json.dumps(relpath(parent))} -> {json.dumps(relpath(child))}{suffix};')
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_cycle(chain, base_path=None):
+    """
+    Formats an include cycle as 'a.cfg -> b.cfg -> a.cfg'.
+    """
+
+    return ' -> '.join(os.path.relpath(path, base_path) if base_path else path for path in chain)
@@ -0,0 +1,123 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from config_lexer import TOKEN_INCLUDE
+
+DEFAULT_JOBS = 8
+
+
+class IncludePrefetcher:
+    """Discovers the include graph of a configuration tree and reads its files in a thread pool.
+
+    The prefetcher only reads and tokenizes files; it never touches the merged state. Its results are handed to the
+    ConfigParser, which still applies every token stream serially in Klipper include order. The merged sections,
+    key/value occurrences and gcode block history are therefore identical to a serial parse, while the time spent
+    waiting on slow storage (network mounts, SD cards) overlaps across files."""
+
+    def __init__(self, parser, jobs=DEFAULT_JOBS):
+        """
+        Initializes the prefetcher for the given parser, using up to jobs worker threads.
+        """
+
+        self.parser = parser
+        self.jobs = max(1, jobs)
+        self.tokens = {}  # Normalized path -> (tokens, fingerprint, source)
+        self.globs = {}  # Normalized glob pattern -> list of matching files
+        self.missing_files = set()
+        self.edges = {}  # Normalized path -> list of include targets in file order
+
+    def _load(self, path):
+        """
+        Worker task: returns the tokens of a file, or None when the file does not exist.
+        """
+
+        if not self.parser.file_exists(path):
+            return None
+        return self.parser.read_tokens(path)
+
+    def _include_targets(self, path, tokens):
+        """
+        Returns the include targets of a file in the order the parser will follow them.
+        """
+
+        current_dir = os.path.dirname(path)
+        return [self.parser.normalize_path(self.parser.include_path(token[1], current_dir), current_dir)
+                for token in tokens if token[0] == TOKEN_INCLUDE]
+
+    def prefetch(self, filepath):
+        """
+        Reads every file reachable from filepath and stores the results on the parser.
+        """
+
+        root = self.parser.normalize_path(filepath)
+        seen = {root}
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            pending = {}
+
+            def submit(target):
+                if '*' in target:
+                    pending[executor.submit(self.parser.match_glob, target)] = ('glob', target)
+                else:
+                    pending[executor.submit(self._load, target)] = ('file', target)
+
+            submit(root)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, target = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # Leave the file to the serial parser, which reports the error in context
+                        print(f"Warning: Prefetching {target} failed: {e}")
+                        continue
+
+                    if kind == 'glob':
+                        self.globs[target] = result
+                        children = [os.path.normpath(path) for path in result]
+                    elif result is None:
+                        self.missing_files.add(target)
+                        children = []
+                    else:
+                        self.tokens[target] = result
+                        children = self._include_targets(target, result[0])
+                        self.edges[target] = children
+
+                    for child in children:
+                        if child not in seen:
+                            seen.add(child)
+                            submit(child)
+
+        self.parser.prefetched_tokens.update(self.tokens)
+        self.parser.prefetched_globs.update(self.globs)
+        return self
+
+
+def prefetch_includes(parser, filepath, jobs=DEFAULT_JOBS):
+    """
+    Convenience wrapper that prefetches the include closure of filepath into parser.
+    """
+
+    return IncludePrefetcher(parser, jobs).prefetch(filepath)
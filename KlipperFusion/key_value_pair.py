@@ -21,20 +21,39 @@
 # SOFTWARE.
 
 import os
+import sys
+
+from file_table import filename_of, intern_filename
 
 
 class KeyValuePair:
+    # Slots keep the per-key footprint small when many printers are loaded into one process. Previous occurrences are
+    # stored as (file_id, value, inline_comment, preceding_comments) tuples referencing the shared file table.
+    __slots__ = ('key', 'file_id', 'value', 'inline_comment', 'preceding_comments', 'occurrences')
+
     def __init__(self, key, filename, value, inline_comment, preceding_comments):
         """
         Initializes a new KeyValuePair with a key, filename, value, and optional comments.
         """
 
-        self.key = key
-        self.filename = filename
-        self.value = value
+        self.key = sys.intern(key)
+        self.file_id = intern_filename(filename)
+        self.value = sys.intern(value)  # Values repeat heavily across printers and overrides
         self.inline_comment = inline_comment
-        self.preceding_comments = preceding_comments
-        self.occurrences = []
+        self.preceding_comments = tuple(preceding_comments) if preceding_comments else ()
+        self.occurrences = ()  # Becomes a list on the first override
+
+    @property
+    def filename(self):
+        """
+        The file in which the latest value was defined.
+        """
+
+        return filename_of(self.file_id)
+
+    @filename.setter
+    def filename(self, filename):
+        self.file_id = intern_filename(filename)
 
     def add_occurrence(self, filename, value, inline_comment, preceding_comments):
         """
@@ -43,19 +62,42 @@ class KeyValuePair:
         """
 
         try:
-            self.occurrences.append({
-                'filename': self.filename,
-                'value': self.value,
-                'inline_comment': self.inline_comment,
-                'preceding_comments': self.preceding_comments
-            })
-            self.filename = filename
-            self.value = value
+            record = (self.file_id, self.value, self.inline_comment, self.preceding_comments)
+            if self.occurrences:
+                self.occurrences.append(record)
+            else:
+                self.occurrences = [record]
+            self.file_id = intern_filename(filename)
+            self.value = sys.intern(value)
             self.inline_comment = inline_comment
-            self.preceding_comments = preceding_comments
+            self.preceding_comments = tuple(preceding_comments) if preceding_comments else ()
         except Exception as e:
             print(f"Error adding occurrence to KeyValuePair '{self.key}': {e}")
 
+    def set_value(self, filename, value):
+        """
+        Replaces the value and its file without recording the previous value, for parsers that only keep the
+        effective configuration.
+        """
+
+        self.file_id = intern_filename(filename)
+        self.value = sys.intern(value)
+
+    def copy(self):
+        """
+        Returns a copy of this key-value pair that can be overridden without changing this one. The value history is
+        copied, the immutable occurrence records in it are shared.
+        """
+
+        kvp = KeyValuePair.__new__(KeyValuePair)
+        kvp.key = self.key
+        kvp.file_id = self.file_id
+        kvp.value = self.value
+        kvp.inline_comment = self.inline_comment
+        kvp.preceding_comments = self.preceding_comments
+        kvp.occurrences = list(self.occurrences) if self.occurrences else ()
+        return kvp
+
     def get_latest_value(self):
         """
         Returns the most recent value associated with this key-value pair.
@@ -68,7 +110,7 @@ class KeyValuePair:
         Returns a list of all values (including the current and all previous values) associated with this key.
         """
 
-        return [occurrence['value'] for occurrence in self.occurrences] + [self.value]
+        return [occurrence[1] for occurrence in self.occurrences] + [self.value]
 
     def get_occurrence_details(self):
         """
@@ -77,13 +119,20 @@ class KeyValuePair:
         """
 
         # Include all occurrences plus the current state as part of the details
-        return self.occurrences + [{
+        details = [{
+            'filename': filename_of(file_id),
+            'value': value,
+            'inline_comment': inline_comment,
+            'preceding_comments': list(preceding_comments)
+        } for file_id, value, inline_comment, preceding_comments in self.occurrences]
+        details.append({
             'filename': self.filename,
             'value': self.value,
             'inline_comment': self.inline_comment,
-            'preceding_comments': self.preceding_comments,
+            'preceding_comments': list(self.preceding_comments),
             'duplicate_flag': False  # The latest occurrence is not considered a duplicate of itself
-        }]
+        })
+        return details
 
     def format_for_output(self, base_path):
         """
@@ -91,27 +140,32 @@ class KeyValuePair:
         of values and comments, adjusted relative to a specified base path.
         """
 
+        return ''.join(self.iter_output(base_path))
+
+    def iter_output(self, base_path, relpath=None):
+        """
+        Yields the formatted representation of the key-value pair piece by piece, without a trailing newline.
+        An optional memoizing relpath function can be passed to avoid recomputing relative paths for every key.
+        """
+
         try:
-            output = ""
             # Print preceding comments for the latest value
             for comment in self.preceding_comments:
-                output += f"# {comment}\n"
+                yield f"# {comment}\n"
 
             # Print previous values as comments with their source file and inline comments
-            for occ in self.occurrences:
-                relative_filename = os.path.relpath(occ['filename'], base_path)
-                prev_val_line = f"# {self.key}: {occ['value']} <- {relative_filename}:"
-                if occ['inline_comment']:
-                    prev_val_line += f" # {occ['inline_comment']}"
-                output += prev_val_line + "\n"
+            for file_id, value, inline_comment, _ in self.occurrences:
+                filename = filename_of(file_id)
+                relative_filename = relpath(filename) if relpath else os.path.relpath(filename, base_path)
+                if inline_comment:
+                    yield f"# {self.key}: {value} <- {relative_filename}: # {inline_comment}\n"
+                else:
+                    yield f"# {self.key}: {value} <- {relative_filename}:\n"
 
             # Print the current (latest) value with its inline comment
-            current_val_line = f"{self.key}: {self.value}"
             if self.inline_comment:
-                current_val_line += f" # {self.inline_comment}"
-            output += current_val_line
-
-            return output
+                yield f"{self.key}: {self.value} # {self.inline_comment}"
+            else:
+                yield f"{self.key}: {self.value}"
         except Exception as e:
             print(f"Error generating output for KeyValuePair '{self.key}': {e}")
-            return ""
@@ -21,33 +21,125 @@
 # SOFTWARE.
 
 import click
+import contextlib
+import json
 import os
+import re
 import sys
+import time
+from archive_audit import SUMMARY_FILENAME as AUDIT_SUMMARY_FILENAME, find_archives, run_audit, \
+    write_audit_summary
+from archive_source import ROOT_FILENAME, open_archive_source, split_archive_path
+from config_diff import MerkleTree, count_differences, diff_trees, format_diff
+from config_index import ConfigIndex, answer_queries, parse_selector
+from config_overlay import apply_overlays
 from config_parser import ConfigParser
+from content_store import format_dedup_stats
+from fleet import SUMMARY_FILENAME, find_printer_roots, run_fleet, write_summary
+from git_history import ConfigHistory, GitError, format_timeline
+from include_graph import format_cycle
+from include_prefetcher import prefetch_includes
+from macro_index import MacroIndex
+from parse_cache import DEFAULT_MAX_CACHE_BYTES, ParseCache
+from profiler import Profiler
+from save_config import SaveConfig
+from serve_mode import DEFAULT_MAX_STATE_MB, DEFAULT_SERVE_PORT, MergedStateCache, create_server
+from snapshot import SnapshotError, is_snapshot, snapshot_to_dict, write_json_export
+from text_index import FIELDS as TEXT_FIELDS, TextIndex
+from watch_mode import DEFAULT_DEBOUNCE, DEFAULT_POLL_INTERVAL, WatchSession, create_watcher
 
 
 # This script serves as the main entry point for KlipperFusion, a tool designed to merge, track, and update Klipper
 # configuration files.
 
-@click.command()
+
+class DefaultCommandGroup(click.Group):
+    """A click group that runs its default command when the first argument is not a known subcommand, so that
+    'klipper_fusion.py printer.cfg' keeps working next to subcommands such as 'klipper_fusion.py fleet'."""
+
+    def __init__(self, *args, default_command=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] not in ('--help', '-h'):
+            args.insert(0, self.default_command)
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultCommandGroup, default_command='merge')
+def cli():
+    """
+    KlipperFusion merges a Klipper configuration and all of its include files into a single annotated file.
+    Without a subcommand, the merge command is run.
+    """
+
+
+@cli.command('merge')
 @click.argument('filename')
 @click.option('--overwrite', is_flag=True, help='Overwrite the output file if it exists without prompting.')
 @click.option('--output', default=None, help='Optional custom output file path and name.')
 @click.option('--hide-unmodified', is_flag=True,
               help='Show detailed modifications for each section. If not set, unmodified sections are simply marked '
                    'as UNMODIFIED.')
-def main(filename, overwrite, output, hide_unmodified):
+@click.option('--cache-dir', default=None,
+              help='Directory of the persistent parse cache. Defaults to ~/.cache/klipper_fusion.')
+@click.option('--no-cache', is_flag=True, help='Parse every file from scratch without reading or updating the cache.')
+@click.option('--cache-max-mb', default=DEFAULT_MAX_CACHE_BYTES // (1024 * 1024), show_default=True,
+              help='Upper bound for the total size of the parse cache in megabytes.')
+@click.option('--watch', is_flag=True,
+              help='Keep running and rewrite the output file whenever a file in the include closure changes.')
+@click.option('--poll', is_flag=True, help='In watch mode, poll for changes instead of using inotify.')
+@click.option('--poll-interval', default=DEFAULT_POLL_INTERVAL, show_default=True,
+              help='In watch mode, seconds between two polls of the include closure.')
+@click.option('--debounce', default=DEFAULT_DEBOUNCE, show_default=True,
+              help='In watch mode, seconds without further changes before the output is rewritten.')
+@click.option('--jobs', '-j', default=1, show_default=True,
+              help='Number of threads used to read include files in parallel. 1 reads them serially.')
+@click.option('--profile', is_flag=True,
+              help='Print where the time of the merge went: per phase, per file, and the size of the merged state.')
+@click.option('--profile-trace', default=None,
+              help='Write a Chrome trace_event JSON file of the merge (implies --profile).')
+@click.option('--snapshot', default=None,
+              help='Also write the merged state to this binary snapshot, which other tools can load without parsing. '
+                   'Snapshots can only be loaded by the Python version that wrote them; only load trusted snapshots.')
+@click.option('--gcode-history', type=click.Choice(['full', 'diff']), default='full', show_default=True,
+              help='Write every version of an overridden gcode block in full, or only the effective version preceded '
+                   'by commented diffs of the overrides.')
+@click.option('--effective-only', is_flag=True,
+              help='Write only the effective configuration: the final value of every key and the last definition of '
+                   'every gcode block, without comments or history. Parses faster and uses less memory.')
+@click.option('--provenance', is_flag=True,
+              help='With --effective-only, precede every section with a comment listing the files that defined it.')
+def main(filename, overwrite, output, hide_unmodified, cache_dir, no_cache, cache_max_mb, watch, poll, poll_interval,
+         debounce, jobs, profile, profile_trace, snapshot, gcode_history, effective_only, provenance):
     """
     The main function that processes the command-line arguments and options.
 
     Args:
-        filename: The path to the input configuration file to be processed.
+        filename: The path to the input configuration file to be processed, or of a zip or tar backup, optionally
+            followed by the path of the root file inside it (e.g. 'backup.zip/config/printer.cfg').
         overwrite: A boolean flag to indicate whether the output file should be overwritten without prompting if it
             already exists.
         output: An optional custom path and name for the output file. If not specified, defaults to 'output.cfg' in
             the same directory as the input file.
         hide_unmodified: A boolean flag to control whether unmodified sections are simply marked as 'UNMODIFIED' or
             if their details are fully shown in the output.
+        cache_dir: An optional directory for the persistent parse cache.
+        no_cache: A boolean flag to disable the parse cache and the up-to-date check.
+        cache_max_mb: The size limit of the parse cache in megabytes; least recently used entries are evicted first.
+        watch: A boolean flag to keep running and incrementally rewrite the output whenever an input file changes.
+        poll: A boolean flag to poll for changes in watch mode instead of using inotify.
+        poll_interval: The number of seconds between two polls in watch mode.
+        debounce: The number of seconds a burst of changes has to settle before the output is rewritten.
+        jobs: The number of threads used to prefetch include files. The merge itself always stays in include order.
+        profile: A boolean flag to print a profile of the merge after writing the output.
+        profile_trace: An optional path for a Chrome trace_event file showing the include tree as nested spans.
+        snapshot: An optional path for a binary snapshot of the merged state.
+        gcode_history: 'full' to write every version of an overridden gcode block, 'diff' to write the overrides as
+            diffs against the previous version.
+        effective_only: A boolean flag to keep and write only the effective configuration, without history.
+        provenance: A boolean flag to list the files of every section in the effective-only output.
 
     This function initializes the configuration parser, processes the input file, and writes the combined and updated
     configuration to the output file. Error handling is included to manage issues such as file not found or other
@@ -58,6 +150,14 @@ def main(filename, overwrite, output, hide_unmodified):
     if not filename:
         sys.exit("Please provide a valid filename.")
 
+    # Watch mode keeps its merged state in memory and rewrites only the output file, so it has no use for these
+    if watch:
+        options = (('--snapshot', snapshot), ('--jobs', jobs > 1), ('--profile', profile),
+                   ('--profile-trace', profile_trace))
+        unsupported = [option for option, given in options if given]
+        if unsupported:
+            raise click.UsageError(f"{', '.join(unsupported)} cannot be used with --watch.")
+
     try:
         # Retrieve the base path and input file
         base_path, input_file = os.path.split(os.path.abspath(filename))
@@ -71,32 +171,835 @@ def main(filename, overwrite, output, hide_unmodified):
     # Use the specified output file and path if provided, otherwise default to output.cfg in the input file's directory
     output_file = output if output else os.path.join(base_path, "output.cfg")
 
+    # A path leading into a zip or tar backup is merged straight from the archive, without extracting it. The default
+    # output goes next to the archive, and the parse cache is not used since archive members have no file stats.
+    archive_source = None
+    archive_path, inner_path = split_archive_path(filename)
+    if archive_path is not None:
+        if watch:
+            sys.exit("Watch mode cannot watch an archive.")
+        try:
+            archive_source = open_archive_source(archive_path)
+            filename = os.path.join(archive_path, inner_path) if inner_path else archive_source.find_root()
+        except Exception as e:
+            sys.exit(f"Could not open the archive: {str(e)}")
+        base_path = os.path.dirname(filename)
+        output_file = output if output else os.path.join(os.path.dirname(archive_path), "output.cfg")
+        no_cache = True
+
+    # Open the parse cache unless it is disabled. A broken cache directory should never prevent a merge.
+    cache = None
+    if not no_cache:
+        try:
+            cache = ParseCache(cache_dir, cache_max_mb * 1024 * 1024)
+        except OSError as e:
+            print(f"Warning: Parse cache disabled: {e}")
+
+    # Skip the whole run when nothing in the include closure changed since the output file was written
+    cache_options = {'hide_unmodified': hide_unmodified, 'snapshot': os.path.abspath(snapshot) if snapshot else None,
+                     'gcode_history': gcode_history, 'effective_only': effective_only, 'provenance': provenance}
+    if cache is not None and not watch and (not snapshot or os.path.exists(snapshot)) and \
+            cache.is_run_unchanged(filename, output_file, cache_options):
+        print(f"{output_file} is up to date.")
+        return
+
     # Check if the output file exists
     if os.path.exists(output_file) and not overwrite:
         # Prompt the user for overwrite permission if not specified by the command line option
         click.confirm(f"{output_file} exists. Overwrite?", abort=True)
 
+    # In watch mode the merged state is kept in memory and the output is rewritten until the user interrupts
+    if watch:
+        session = WatchSession(filename, base_path, output_file, hide_unmodified, cache, gcode_history,
+                               effective_only, provenance)
+        watcher = create_watcher(poll_interval, use_inotify=not poll)
+        try:
+            session.run(watcher, debounce)
+        except KeyboardInterrupt:
+            print("Stopped watching.")
+        finally:
+            watcher.close()
+            if cache is not None:
+                cache.prune()
+        return
+
     # Initialize ConfigParser with error handling
     try:
-        parser = ConfigParser(base_path)
+        parser = ConfigParser(base_path, cache, effective_only=effective_only, file_source=archive_source)
     except Exception as e:
         sys.exit(f"An error occurred while creating the parser: {str(e)}")
 
+    # Profiling wraps the parser's methods only when requested, so a normal run is not affected at all
+    profiler = None
+    if profile or profile_trace:
+        profiler = Profiler().attach(parser)
+
     # Try to parse the file using the parser object with error handling
     try:
+        if jobs > 1:
+            prefetch_includes(parser, filename, jobs)
         parser.parse_file(filename)
     except Exception as e:
         sys.exit(f"Could not parse the file: {str(e)}")
 
     # Finally, try to write the parsed content to the output file with error handling
     try:
-        parser.write_output(output_file, hide_unmodified)  # Write the parsed content to the output file
+        # Write the parsed content to the output file
+        if effective_only:
+            parser.write_effective_output(output_file, provenance)
+        else:
+            parser.write_output(output_file, hide_unmodified, gcode_history)
     except Exception as e:
         sys.exit(f"An error occurred when writing the output: {str(e)}")
 
+    if snapshot:
+        try:
+            parser.write_snapshot(snapshot)
+        except Exception as e:
+            sys.exit(f"An error occurred when writing the snapshot: {str(e)}")
+
+    # Remember the include closure of this run and keep the cache within its size limit
+    if cache is not None:
+        cache.record_run(filename, output_file, cache_options, parser)
+        cache.prune()
+
     # If no exceptions were encountered, print a success message
     print("File written successfully.")
 
+    if profiler is not None:
+        profiler.collect_counts(parser)
+        print(profiler.format_summary())
+        if profile_trace:
+            profiler.write_chrome_trace(profile_trace)
+            print(f"Chrome trace written to {profile_trace}.")
+
+
+@cli.command('fleet')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--output-dir', default=None,
+              help='Directory for all merged outputs. If not set, each printer gets an output.cfg next to its root.')
+@click.option('--summary', default=None,
+              help=f'Path of the JSON summary. Defaults to {SUMMARY_FILENAME} in the output directory or the current '
+                   f'directory.')
+@click.option('--jobs', '-j', default=os.cpu_count() or 1, show_default=True,
+              help='Number of worker processes.')
+@click.option('--hide-unmodified', is_flag=True, help='Mark unmodified gcode blocks as UNMODIFIED in every output.')
+@click.option('--cache-dir', default=None,
+              help='Directory of the persistent parse cache. Defaults to ~/.cache/klipper_fusion.')
+@click.option('--no-cache', is_flag=True, help='Parse every file from scratch without reading or updating the cache.')
+def fleet(paths, output_dir, summary, jobs, hide_unmodified, cache_dir, no_cache):
+    """
+    Merges many printers in one batch.
+
+    Args:
+        paths: Root configuration files, or directories that are scanned recursively for printer.cfg files.
+        output_dir: An optional directory for all merged outputs.
+        summary: An optional path for the JSON summary with per-printer timings, counts, warnings and errors.
+        jobs: The number of worker processes merging printers in parallel.
+        hide_unmodified: A boolean flag to mark unmodified gcode blocks as 'UNMODIFIED'.
+        cache_dir: An optional directory for the persistent parse cache shared by all workers.
+        no_cache: A boolean flag to disable the parse cache.
+
+    Existing output files are overwritten without prompting. A printer whose configuration cannot be merged is
+    reported as failed in the summary without affecting the other printers; the exit status is 1 if any failed.
+    """
+
+    roots = find_printer_roots(paths)
+    if not roots:
+        sys.exit("No printer configurations found.")
+
+    start = time.perf_counter()
+    results = run_fleet(roots, output_dir, jobs, hide_unmodified, cache_dir, use_cache=not no_cache)
+    wall_seconds = time.perf_counter() - start
+
+    summary_file = summary or os.path.join(output_dir or os.getcwd(), SUMMARY_FILENAME)
+    totals = write_summary(results, summary_file, wall_seconds, jobs)
+    for result in results:
+        if result['status'] == 'failed':
+            print(f"FAILED {result['root']}: {result['error']}")
+    print(f"{totals['ok']} merged, {totals['up_to_date']} up to date, {totals['failed']} failed in "
+          f"{wall_seconds:.2f} s using {jobs} worker(s) ({totals['worker_seconds']:.2f} s of work). "
+          f"Summary written to {summary_file}.")
+    print(f"Shared include files: {format_dedup_stats(totals['dedup'])}.")
+    if totals['failed']:
+        sys.exit(1)
+
+
+@cli.command('audit')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--output-dir', default=None,
+              help='Directory for the merged outputs of all archives. If not set, no outputs are written.')
+@click.option('--summary', default=None,
+              help=f'Path of the JSON summary. Defaults to {AUDIT_SUMMARY_FILENAME} in the output directory or the '
+                   f'current directory.')
+@click.option('--jobs', '-j', default=os.cpu_count() or 1, show_default=True,
+              help='Number of worker processes.')
+@click.option('--hide-unmodified', is_flag=True, help='Mark unmodified gcode blocks as UNMODIFIED in every output.')
+@click.option('--root-name', default=ROOT_FILENAME, show_default=True,
+              help='Name of the root file; the shallowest file of this name in each archive is merged.')
+def audit(paths, output_dir, summary, jobs, hide_unmodified, root_name):
+    """
+    Audits a collection of zip and tar backups without extracting them.
+
+    Args:
+        paths: Archives, or directories that are scanned recursively for archives.
+        output_dir: An optional directory for the merged output of every archive.
+        summary: An optional path for the JSON summary with per-archive counts, missing files, include cycles,
+            warnings, errors and the digest of the merged configuration.
+        jobs: The number of worker processes auditing archives in parallel.
+        hide_unmodified: A boolean flag to mark unmodified gcode blocks as 'UNMODIFIED'.
+        root_name: The name of the root configuration file inside the archives.
+
+    Archives whose merged configurations are identical are grouped in the summary. An archive that cannot be merged
+    is reported as failed without affecting the others; the exit status is 1 if any failed.
+    """
+
+    archives = find_archives(paths)
+    if not archives:
+        sys.exit("No archives found.")
+
+    start = time.perf_counter()
+    results = run_audit(archives, output_dir, jobs, hide_unmodified, root_name)
+    wall_seconds = time.perf_counter() - start
+
+    summary_file = summary or os.path.join(output_dir or os.getcwd(), AUDIT_SUMMARY_FILENAME)
+    totals = write_audit_summary(results, summary_file, wall_seconds, jobs)
+    for result in results:
+        if result['status'] == 'failed':
+            print(f"FAILED {result['archive']}: {result['error']}")
+        elif result['missing_files'] or result['cycles']:
+            print(f"{result['archive']}: {len(result['missing_files'])} missing file(s), "
+                  f"{result['cycles']} include cycle(s)")
+    print(f"{totals['ok']} audited, {totals['failed']} failed in {wall_seconds:.2f} s using {jobs} worker(s) "
+          f"({totals['worker_seconds']:.2f} s of work), {totals['distinct_configurations']} distinct configuration(s), "
+          f"{totals['tokenized_files']} of {totals['files']} files tokenized. Summary written to {summary_file}.")
+    if totals['failed']:
+        sys.exit(1)
+
+
+def open_cache(cache_dir, no_cache):
+    """
+    Opens the parse cache unless it is disabled. A broken cache directory only disables the cache.
+    """
+
+    if no_cache:
+        return None
+    try:
+        return ParseCache(cache_dir)
+    except OSError as e:
+        print(f"Warning: Parse cache disabled: {e}", file=sys.stderr)
+        return None
+
+
+def parse_root(filename, cache, **parser_options):
+    """
+    Parses a root configuration file for a report. Parser warnings go to stderr, so that the report printed on stdout
+    can be piped.
+    """
+
+    parser = ConfigParser(os.path.dirname(os.path.abspath(filename)), cache, **parser_options)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            parser.parse_file(filename)
+    except Exception as e:
+        sys.exit(f"Could not parse {filename}: {str(e)}")
+    return parser
+
+
+def format_query_result(result, history):
+    """
+    Formats the answer to a query selector for the terminal.
+    """
+
+    section_name = result['section']
+    if 'keys' in result:
+        lines = [f"[{section_name}]  ({', '.join(result['files'])})"]
+        lines.extend(f"{key}: {value}" for key, value in result['keys'].items())
+        return '\n'.join(lines)
+    if 'gcode' in result:
+        return '\n'.join([f"[{section_name}] {result['key']}:"] + result['gcode'])
+    lines = [f"[{section_name}] {result['key']}: {result['value']}  ({result['file']})"]
+    if history:
+        lines.extend(f"    {entry['value']} <- {entry['file']}" for entry in result['history'])
+    return '\n'.join(lines)
+
+
+@cli.command('query')
+@click.argument('filename')
+@click.argument('selectors', nargs=-1)
+@click.option('--key', 'keys', multiple=True, help='List every section that defines this key.')
+@click.option('--file', 'files', multiple=True, help='List the entries that this file sets.')
+@click.option('--history', is_flag=True, help='Show the chain of values and the files that set them.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the answers as JSON.')
+@click.option('--cache-dir', default=None,
+              help='Directory of the persistent parse cache. Defaults to ~/.cache/klipper_fusion.')
+@click.option('--no-cache', is_flag=True, help='Parse every file from scratch without reading or updating the cache.')
+def query(filename, selectors, keys, files, history, as_json, cache_dir, no_cache):
+    """
+    Answers questions about single keys without writing the merged output.
+
+    Args:
+        filename: The path to the root configuration file.
+        selectors: 'SECTION.KEY' selectors (for example 'stepper_z.rotation_distance' or
+            'gcode_macro PRINT_START.gcode'), or bare section names to list all keys of a section.
+        keys: Keys to look up in every section.
+        files: Files whose entries are listed.
+        history: A boolean flag to show the value chain of each key instead of only its final value.
+        as_json: A boolean flag to print the answers as JSON.
+        cache_dir: An optional directory for the persistent parse cache.
+        no_cache: A boolean flag to disable the parse cache.
+
+    Only the gcode blocks of sections named by a selector are stored while parsing. The exit status is 1 if anything
+    asked for was not found.
+    """
+
+    if not (selectors or keys or files):
+        sys.exit("Please provide at least one selector, --key or --file.")
+
+    cache = open_cache(cache_dir, no_cache)
+    index = ConfigIndex()
+    section_filter = {parse_selector(selector)[0] for selector in selectors}
+    parser = parse_root(filename, cache, index=index, section_filter=section_filter)
+    base_path = parser.base_path
+    if cache is not None:
+        cache.prune()
+
+    answers, missing = answer_queries(index, selectors, keys, files, base_path)
+
+    if as_json:
+        print(json.dumps({'answers': answers, 'not_found': missing}, indent=2))
+    else:
+        for result in answers:
+            print(format_query_result(result, history))
+        for selector in missing:
+            print(f"Not found: {selector}")
+    if missing:
+        sys.exit(1)
+
+
+@cli.command('index')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--index-dir', default=None,
+              help='Directory of the text index. Defaults to ~/.cache/klipper_fusion/text_index.')
+@click.option('--jobs', '-j', default=os.cpu_count() or 1, show_default=True,
+              help='Number of worker processes.')
+@click.option('--prune', is_flag=True, help='Remove the segments of printers that are not among the given paths.')
+@click.option('--cache-dir', default=None,
+              help='Directory of the persistent parse cache. Defaults to ~/.cache/klipper_fusion.')
+@click.option('--no-cache', is_flag=True, help='Parse every file from scratch without reading or updating the cache.')
+def index(paths, index_dir, jobs, prune, cache_dir, no_cache):
+    """
+    Builds or updates the full-text index of many printers.
+
+    Args:
+        paths: Root configuration files, or directories that are scanned recursively for printer.cfg files.
+        index_dir: An optional directory for the index segments.
+        jobs: The number of worker processes indexing printers in parallel.
+        prune: A boolean flag to remove the segments of all other printers.
+        cache_dir: An optional directory for the persistent parse cache shared by all workers.
+        no_cache: A boolean flag to disable the parse cache.
+
+    Only printers whose root or included files changed since they were last indexed are merged again. The exit status
+    is 1 if any printer failed.
+    """
+
+    roots = find_printer_roots(paths)
+    if not roots:
+        sys.exit("No printer configurations found.")
+
+    start = time.perf_counter()
+    text_index = TextIndex(index_dir)
+    results = text_index.update(roots, jobs, cache_dir, use_cache=not no_cache)
+    removed = text_index.prune(roots) if prune else 0
+    wall_seconds = time.perf_counter() - start
+
+    counts = {status: sum(1 for result in results if result['status'] == status)
+              for status in ('indexed', 'unchanged', 'failed')}
+    for result in results:
+        if result['status'] == 'failed':
+            print(f"FAILED {result['root']}: {result['error']}")
+    print(f"{counts['indexed']} indexed, {counts['unchanged']} unchanged, {counts['failed']} failed, {removed} removed "
+          f"in {wall_seconds:.2f} s. Index stored in {text_index.index_dir}.")
+    if counts['failed']:
+        sys.exit(1)
+
+
+@cli.command('search')
+@click.argument('query', default='')
+@click.option('--regex', default=None, help='Only show entries whose text matches this regular expression.')
+@click.option('--field', 'fields', multiple=True, type=click.Choice(TEXT_FIELDS),
+              help='Only search entries of this kind. Can be given multiple times.')
+@click.option('--printer', 'printers', multiple=True,
+              help='Only search this printer root or directory. Can be given multiple times.')
+@click.option('--limit', default=None, type=int, help='Stop after this many matches.')
+@click.option('--index-dir', default=None,
+              help='Directory of the text index. Defaults to ~/.cache/klipper_fusion/text_index.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the matches as JSON.')
+def search(query, regex, fields, printers, limit, index_dir, as_json):
+    """
+    Searches the full-text index built with 'index'.
+
+    Args:
+        query: Words that must all occur in a matching entry, case-insensitively. A word ending in '*' matches
+            every word starting with it.
+        regex: An optional regular expression the text of a matching entry must contain.
+        fields: Entry kinds to search: section names, keys, values, comments or gcode lines.
+        printers: Optional printer roots, or directories scanned for printer.cfg files, to restrict the search to.
+        limit: An optional maximum number of matches.
+        index_dir: An optional directory of the index segments.
+        as_json: A boolean flag to print the matches as JSON.
+
+    Every match shows the printer, section and file an entry comes from. Values, comments and gcode lines of every
+    override are indexed, not only the effective ones.
+    """
+
+    if not query.strip() and not regex:
+        sys.exit("Give a query, a --regex, or both.")
+    try:
+        hits = TextIndex(index_dir).search(query, regex, fields or None,
+                                           find_printer_roots(printers) if printers else None, limit)
+    except re.error as e:
+        sys.exit(f"Invalid regular expression: {str(e)}")
+
+    if as_json:
+        print(json.dumps(hits, indent=2))
+        return
+    for hit in hits:
+        key = f" {hit['key']}" if hit['key'] else ''
+        print(f"{hit['printer']}: [{hit['section']}]{key} ({hit['file']}, {hit['field']}): {hit['text']}")
+    print(f"{len(hits)} match(es).")
+
+
+@cli.command('graph')
+@click.argument('filename')
+@click.option('--format', 'graph_format', type=click.Choice(['dot', 'json']), default='dot', show_default=True,
+              help='Graphviz DOT or JSON.')
+@click.option('--output', default=None, help='Write the graph to this file instead of printing it.')
+@click.option('--cache-dir', default=None,
+              help='Directory of the persistent parse cache. Defaults to ~/.cache/klipper_fusion.')
+@click.option('--no-cache', is_flag=True, help='Parse every file from scratch without reading or updating the cache.')
+def graph(filename, graph_format, output, cache_dir, no_cache):
+    """
+    Exports the include graph of a configuration.
+
+    Args:
+        filename: The path to the root configuration file.
+        graph_format: 'dot' for Graphviz or 'json'.
+        output: An optional path for the graph. If not specified, the graph is printed.
+        cache_dir: An optional directory for the persistent parse cache.
+        no_cache: A boolean flag to disable the parse cache.
+
+    Paths are relative to the directory of the root file. Missing files are marked, glob includes carry their pattern
+    and include cycles are listed. Parser warnings go to stderr so that the printed graph can be piped.
+    """
+
+    cache = open_cache(cache_dir, no_cache)
+    parser = parse_root(filename, cache, section_filter=())
+    base_path = parser.base_path
+    if cache is not None:
+        cache.prune()
+
+    include_graph = parser.include_graph
+    text = include_graph.to_dot(base_path) if graph_format == 'dot' else include_graph.to_json(base_path) + '\n'
+    if output:
+        with open(output, 'w') as file:
+            file.write(text)
+        print(f"Include graph with {len(include_graph.files)} files and {len(include_graph.edges)} includes "
+              f"written to {output}.")
+    else:
+        sys.stdout.write(text)
+    for chain in include_graph.cycles:
+        print(f"Include cycle: {format_cycle(chain, base_path)}", file=sys.stderr)
+
+
+@cli.command('diff')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--json', 'as_json', is_flag=True, help='Print the differences as JSON.')
+@click.option('--cache-dir', default=None,
+              help='Directory of the persistent parse cache. Defaults to ~/.cache/klipper_fusion.')
+@click.option('--no-cache', is_flag=True, help='Parse every file from scratch without reading or updating the cache.')
+def diff(paths, as_json, cache_dir, no_cache):
+    """
+    Compares merged configurations section by section.
+
+    Args:
+        paths: Two root configuration files to compare, or more to print a matrix of how many sections differ
+            between every pair.
+        as_json: A boolean flag to print the differences as JSON.
+        cache_dir: An optional directory for the persistent parse cache.
+        no_cache: A boolean flag to disable the parse cache.
+
+    Each configuration is merged once and hashed into a tree of section, key and gcode digests, so identical sections
+    are skipped without looking at their contents. Two configurations are reported with every changed, added and
+    removed key and gcode block together with the file that set it; the exit status is 1 if they differ.
+    """
+
+    if len(paths) < 2:
+        sys.exit("Please provide at least two configuration files to compare.")
+
+    cache = open_cache(cache_dir, no_cache)
+    trees = [MerkleTree(parse_root(path, cache)) for path in paths]
+    if cache is not None:
+        cache.prune()
+
+    if len(paths) == 2:
+        report = diff_trees(trees[0], trees[1])
+        if as_json:
+            print(json.dumps(report, indent=2))
+        else:
+            print(format_diff(report, paths[0], paths[1]))
+        if not report['identical']:
+            sys.exit(1)
+        return
+
+    matrix = [[count_differences(left, right) for right in trees] for left in trees]
+    if as_json:
+        print(json.dumps({'paths': list(paths), 'differing_sections': matrix}, indent=2))
+        return
+    for index, path in enumerate(paths):
+        print(f"[{index}] {path}")
+    print('     ' + ''.join(f"{index:>6}" for index in range(len(paths))))
+    for index, row in enumerate(matrix):
+        print(f"{index:>5}" + ''.join(f"{count:>6}" for count in row))
+
+
+@cli.command('export')
+@click.argument('source')
+@click.option('--section', 'sections', multiple=True, help='Export only this section. Can be given several times.')
+@click.option('--output', default=None, help='Write the JSON to this file instead of printing it.')
+@click.option('--cache-dir', default=None,
+              help='Directory of the persistent parse cache. Defaults to ~/.cache/klipper_fusion.')
+@click.option('--no-cache', is_flag=True, help='Parse every file from scratch without reading or updating the cache.')
+def export(source, sections, output, cache_dir, no_cache):
+    """
+    Exports a merged configuration as JSON.
+
+    Args:
+        source: A snapshot written with 'merge --snapshot', or a root configuration file that is merged first.
+        sections: Optional section names; only these sections are loaded and exported.
+        output: An optional path for the JSON. If not specified, the JSON is printed.
+        cache_dir: An optional directory for the persistent parse cache.
+        no_cache: A boolean flag to disable the parse cache.
+
+    The export contains every section with its files, the final value, provenance and history of every key, all gcode
+    block versions, and the include graph.
+    """
+
+    if is_snapshot(source):
+        try:
+            parser = ConfigParser.from_snapshot(source, sections or None)
+        except (OSError, SnapshotError) as e:
+            sys.exit(f"Could not load the snapshot: {str(e)}")
+    else:
+        cache = open_cache(cache_dir, no_cache)
+        parser = parse_root(source, cache)
+        if cache is not None:
+            cache.prune()
+        if sections:
+            parser.sections = {name: section for name, section in parser.sections.items() if name in sections}
+
+    if output:
+        write_json_export(parser, output)
+        print(f"{len(parser.sections)} sections exported to {output}.")
+    else:
+        print(json.dumps(snapshot_to_dict(parser), indent=2))
+
+
+@cli.command('overlay')
+@click.argument('source')
+@click.argument('overlays', nargs=-1, required=True)
+@click.option('--json', 'as_json', is_flag=True, help='Print the change report as JSON.')
+@click.option('--output', default=None, help='Write the merged output of the overlaid configuration to this file.')
+@click.option('--effective-only', is_flag=True, help='With --output, write only the effective configuration.')
+@click.option('--cache-dir', default=None,
+              help='Directory of the persistent parse cache. Defaults to ~/.cache/klipper_fusion.')
+@click.option('--no-cache', is_flag=True, help='Parse every file from scratch without reading or updating the cache.')
+def overlay(source, overlays, as_json, output, effective_only, cache_dir, no_cache):
+    """
+    Shows what candidate override files would change, without editing the configuration.
+
+    Args:
+        source: A snapshot written with 'merge --snapshot', or a root configuration file that is merged first.
+        overlays: The override files to layer on top of the merged configuration, in order.
+        as_json: A boolean flag to print the change report as JSON.
+        output: An optional path for the merged output of the overlaid configuration.
+        effective_only: A boolean flag to write only the effective configuration to output.
+        cache_dir: An optional directory for the persistent parse cache.
+        no_cache: A boolean flag to disable the parse cache.
+
+    The overlays are parsed as if the root file included them last, before its SAVE_CONFIG block, so saved values
+    still win. Only the overlays are parsed; the merged configuration they are layered on is left unchanged.
+    """
+
+    cache = None
+    if is_snapshot(source):
+        try:
+            base = ConfigParser.from_snapshot(source)
+        except (OSError, SnapshotError) as e:
+            sys.exit(f"Could not load the snapshot: {str(e)}")
+    else:
+        cache = open_cache(cache_dir, no_cache)
+        base = parse_root(source, cache)
+
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            overlaid = apply_overlays(base, [os.path.abspath(path) for path in overlays])
+    except Exception as e:
+        sys.exit(f"Could not apply the overlays: {str(e)}")
+    if cache is not None:
+        cache.prune()
+
+    report = overlaid.change_report()
+    if as_json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_diff(report, source, ' + '.join(overlays)))
+
+    if output:
+        try:
+            if effective_only:
+                overlaid.write_effective_output(output)
+            else:
+                overlaid.write_output(output, hide_unmodified=False)
+        except Exception as e:
+            sys.exit(f"An error occurred when writing the output: {str(e)}")
+        print(f"Overlaid configuration written to {output}.", file=sys.stderr if as_json else sys.stdout)
+
+
+@cli.command('macros')
+@click.argument('filename')
+@click.option('--callers', multiple=True, help='List the sections that call this macro.')
+@click.option('--calls', multiple=True, help='List the macros this macro or section calls.')
+@click.option('--blast-radius', multiple=True,
+              help='List every section that calls this macro directly or indirectly.')
+@click.option('--uses', multiple=True,
+              help="List the sections referencing a printer object or macro variable, such as 'toolhead' or "
+                   "'gcode_macro _USER_VARIABLES.verbose'.")
+@click.option('--refs', multiple=True, help='List the printer objects and macro variables a macro references.')
+@click.option('--unused', is_flag=True, help='List the macros that no other section calls.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the answers as JSON.')
+@click.option('--cache-dir', default=None,
+              help='Directory of the persistent parse cache. Defaults to ~/.cache/klipper_fusion.')
+@click.option('--no-cache', is_flag=True, help='Parse every file from scratch without reading or updating the cache.')
+def macros(filename, callers, calls, blast_radius, uses, refs, unused, as_json, cache_dir, no_cache):
+    """
+    Answers questions about the macro call graph of a configuration.
+
+    Args:
+        filename: The path to the root configuration file.
+        callers: Macros whose callers are listed.
+        calls: Macros or sections whose called macros are listed.
+        blast_radius: Macros whose direct and indirect callers are listed.
+        uses: Printer objects or macro variables whose users are listed.
+        refs: Macros or sections whose referenced printer objects and macro variables are listed.
+        unused: A boolean flag to list the macros that are not called anywhere in the configuration.
+        as_json: A boolean flag to print the answers as JSON.
+        cache_dir: An optional directory for the persistent parse cache.
+        no_cache: A boolean flag to disable the parse cache.
+
+    Macros can be named as 'PRINT_START' or 'gcode_macro PRINT_START'. The call graph is built from the last
+    definition of every gcode block. Without any question, a summary and the unused macros are printed.
+    """
+
+    cache = open_cache(cache_dir, no_cache)
+    parser = parse_root(filename, cache)
+    if cache is not None:
+        cache.prune()
+    index = MacroIndex.build(parser.sections)
+
+    questions = [('callers', name, index.callers_of) for name in callers] + \
+                [('calls', name, index.calls) for name in calls] + \
+                [('blast_radius', name, index.blast_radius) for name in blast_radius] + \
+                [('uses', name, index.users_of) for name in uses] + \
+                [('refs', name, index.references_of) for name in refs]
+    if unused or not questions:
+        questions.append(('unused', None, lambda _: index.unused_macros()))
+    answers = [{'question': question, 'name': name, 'answer': answer(name)} for question, name, answer in questions]
+
+    if as_json:
+        print(json.dumps({'macros': len(index.macros), 'sections_with_gcode': len(index.lines), 'answers': answers},
+                         indent=2))
+        return
+    print(f"{len(index.macros)} macros, {len(index.lines)} sections with gcode.")
+    for answer in answers:
+        title = answer['question'].replace('_', ' ') + (f" {answer['name']}" if answer['name'] else ' macros')
+        print(f"{title}: {len(answer['answer'])}")
+        for item in answer['answer']:
+            print(f"    {item}")
+
+
+@cli.command('history')
+@click.argument('filename')
+@click.argument('selectors', nargs=-1)
+@click.option('--range', 'revision_range', default='HEAD', show_default=True,
+              help='Commits to walk, in any form git rev-list accepts (for example v1.0..HEAD).')
+@click.option('--key', 'keys', multiple=True, help='Show the timeline of this key in every section.')
+@click.option('--max-count', default=None, type=int, help='Walk only the most recent N commits of the range.')
+@click.option('--all-parents', is_flag=True, help='Also walk the commits of merged branches.')
+@click.option('--chain', is_flag=True, help='Show the value chain and the files that set it for every change.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the timelines as JSON.')
+def history(filename, selectors, revision_range, keys, max_count, all_parents, chain, as_json):
+    """
+    Shows when and in which commit the values of a configuration kept in a git repository changed.
+
+    Args:
+        filename: The path to the root configuration file inside a git worktree.
+        selectors: 'SECTION.KEY' selectors or bare section names whose timelines are shown.
+        revision_range: The commits to walk.
+        keys: Keys whose timelines are shown in every section.
+        max_count: An optional limit on the number of commits.
+        all_parents: A boolean flag to follow all parents of merge commits instead of only the first one.
+        chain: A boolean flag to show the value chain of every change.
+        as_json: A boolean flag to print the timelines as JSON.
+
+    Files are read from the git object database over one persistent 'git cat-file --batch' process, and every
+    distinct file version is tokenized once. Commits that change no file the merged configuration depends on are
+    skipped without merging. Without selectors or keys, every key that changed within the range is shown.
+    """
+
+    try:
+        config_history = ConfigHistory(filename).walk(revision_range, not all_parents, max_count)
+    except GitError as e:
+        sys.exit(f"Could not read the git history of {filename}: {e}")
+
+    if as_json:
+        print(json.dumps(config_history.to_dict(selectors, keys), indent=2))
+        return
+    for section_name, key, events in config_history.select(selectors, keys):
+        print(format_timeline(section_name, key, events, chain))
+    previous_warnings = None
+    for commit in config_history.commits:
+        # Unchanged warnings are only reported at the first commit that raised them
+        if commit['merged'] and commit.get('warnings') != previous_warnings:
+            previous_warnings = commit.get('warnings')
+            for warning in previous_warnings or ():
+                print(f"{commit['commit'][:10]}: {warning}", file=sys.stderr)
+    stats = config_history.stats
+    print(f"Walked {stats['commits']} commits, merged {stats['merged']}, read {stats['distinct_blobs']} distinct "
+          f"file versions and {stats['trees']} trees in {stats['seconds']:.2f} s.", file=sys.stderr)
+
+
+@cli.command('mesh')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--profile', 'profiles', multiple=True,
+              help='Only show this bed mesh profile. Can be given several times.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the meshes and comparisons as JSON.')
+def mesh(paths, profiles, as_json):
+    """
+    Shows the bed meshes saved in the SAVE_CONFIG blocks of configuration files and compares them.
+
+    Args:
+        paths: Configuration files with a SAVE_CONFIG block, for example printer.cfg and the printer-*.cfg backups
+            Klipper writes on every SAVE_CONFIG.
+        profiles: Bed mesh profiles to show. If not specified, all profiles are shown.
+        as_json: A boolean flag to print the meshes and comparisons as JSON.
+
+    Only the SAVE_CONFIG block of each file is read, so includes are not followed. Every mesh is listed with its shape
+    and statistics, and every later mesh of a profile is compared point by point with the first one. The exit status
+    is 1 if no mesh was found.
+    """
+
+    meshes = []
+    first_meshes = {}
+    for path in paths:
+        try:
+            save_config = SaveConfig.from_file(path)
+        except OSError as e:
+            print(f"Error reading {path}: {e}", file=sys.stderr)
+            continue
+        for bed_mesh in save_config.meshes.values():
+            if profiles and bed_mesh.profile not in profiles:
+                continue
+            entry = {'file': path, 'profile': bed_mesh.profile, 'x_count': bed_mesh.x_count,
+                     'y_count': bed_mesh.y_count, 'stats': bed_mesh.stats()}
+            first = first_meshes.setdefault(bed_mesh.profile, bed_mesh)
+            if first is not bed_mesh:
+                entry['compared_to'] = first.filename
+                try:
+                    entry['difference'] = first.compare(bed_mesh)
+                except ValueError as e:
+                    entry['difference'] = None
+                    entry['error'] = str(e)
+            meshes.append(entry)
+
+    if as_json:
+        print(json.dumps({'meshes': meshes}, indent=2))
+    else:
+        for entry in meshes:
+            stats = entry['stats']
+            print(f"{entry['file']}  [bed_mesh {entry['profile']}]  {entry['x_count']}x{entry['y_count']}  "
+                  f"min {stats['min']:.6f}  max {stats['max']:.6f}  range {stats['range']:.6f}  "
+                  f"mean {stats['mean']:.6f}  stdev {stats['stdev']:.6f}")
+            if 'compared_to' in entry:
+                difference = entry['difference']
+                if difference is None:
+                    print(f"    vs {entry['compared_to']}: {entry['error']}")
+                else:
+                    print(f"    vs {entry['compared_to']}: max difference {difference['max_abs']:.6f}  "
+                          f"mean {difference['mean']:.6f}  rms {difference['rms']:.6f}")
+    if not meshes:
+        print("No bed mesh found.", file=sys.stderr)
+        sys.exit(1)
+
+
+@cli.command('serve')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--host', default='127.0.0.1', show_default=True, help='Address the HTTP server listens on.')
+@click.option('--port', default=DEFAULT_SERVE_PORT, show_default=True, help='Port the HTTP server listens on.')
+@click.option('--socket', 'socket_path', default=None, help='Listen on this Unix domain socket instead of TCP.')
+@click.option('--max-state-mb', default=DEFAULT_MAX_STATE_MB, show_default=True,
+              help='Upper bound for the estimated memory of the merged states kept warm.')
+@click.option('--preload', is_flag=True, help='Merge every printer before accepting requests.')
+@click.option('--verbose', is_flag=True, help='Log every request.')
+@click.option('--cache-dir', default=None,
+              help='Directory of the persistent parse cache. Defaults to ~/.cache/klipper_fusion.')
+@click.option('--no-cache', is_flag=True, help='Parse every file from scratch without reading or updating the cache.')
+def serve(paths, host, port, socket_path, max_state_mb, preload, verbose, cache_dir, no_cache):
+    """
+    Runs a local HTTP server that keeps the merged state of printers in memory.
+
+    Args:
+        paths: Root configuration files, or directories that are searched for printer.cfg files.
+        host: The address the server listens on.
+        port: The port the server listens on.
+        socket_path: An optional Unix domain socket to listen on instead of host and port.
+        max_state_mb: The memory bound of the merged states; least recently used printers are dropped first.
+        preload: A boolean flag to merge every printer at startup.
+        verbose: A boolean flag to log every request.
+        cache_dir: An optional directory for the persistent parse cache.
+        no_cache: A boolean flag to disable the parse cache.
+
+    The server answers merged-output, query and diff requests for the given printers from their warm state and merges
+    a printer again when a file of its include closure changed. See serve_mode.ServeRequestHandler for the endpoints.
+    """
+
+    roots = find_printer_roots(paths)
+    if not roots:
+        sys.exit("No configuration files found.")
+    states = MergedStateCache(max_state_mb * 1024 * 1024, open_cache(cache_dir, no_cache))
+    if preload:
+        start = time.perf_counter()
+        for root in roots:
+            states.get(root)
+        print(f"Merged {len(roots)} printers in {time.perf_counter() - start:.2f} s.")
+
+    try:
+        server = create_server(roots, states, host, port, socket_path, verbose)
+    except FileExistsError:
+        raise click.UsageError(f"{socket_path} exists and is not a socket.")
+    except OSError as e:
+        sys.exit(f"Could not start the server: {e}")
+    address = socket_path if socket_path else f"http://{host}:{server.server_address[1]}"
+    print(f"Serving {len(roots)} printers on {address}. Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopped serving.")
+    finally:
+        server.server_close()
+        if states.cache is not None:
+            states.cache.prune()
+
 
 if __name__ == '__main__':
-    main()
+    cli()
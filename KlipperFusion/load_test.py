@@ -0,0 +1,227 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import concurrent.futures
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+
+import click
+
+from serve_mode import DEFAULT_SERVE_PORT
+
+# Load test for 'klipper_fusion.py serve'. It sends a mix of merge, query and diff requests over keep-alive
+# connections from several threads and reports throughput and latency percentiles. With --spawn, the server is
+# started as a subprocess for the given configuration directories; otherwise an already running server is used.
+
+REQUEST_KINDS = ('merge', 'query', 'diff')
+QUERY_KEYS = ('run_current', 'rotation_distance', 'max_velocity', 'microsteps', 'pid_kp', 'variable_verbose')
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection over a Unix domain socket."""
+
+    def __init__(self, socket_path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def open_connection(host, port, socket_path):
+    """
+    Opens a keep-alive connection to the server.
+    """
+
+    if socket_path:
+        return UnixHTTPConnection(socket_path)
+    return http.client.HTTPConnection(host, port, timeout=60)
+
+
+def fetch(connection, path):
+    """
+    Sends a GET request and returns (status, body).
+    """
+
+    connection.request('GET', path)
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def wait_for_server(host, port, socket_path, timeout=30.0):
+    """
+    Waits until the server answers /stats, or raises TimeoutError.
+    """
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = open_connection(host, port, socket_path)
+            status, _ = fetch(connection, '/stats')
+            connection.close()
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError("The server did not start in time.")
+
+
+def build_request(kind, roots, rng):
+    """
+    Returns the path of a random request of the given kind.
+    """
+
+    root = rng.choice(roots)
+    if kind == 'merge':
+        params = {'root': root, 'hide_unmodified': rng.choice(['0', '1'])}
+    elif kind == 'query':
+        params = {'root': root, 'key': rng.choice(QUERY_KEYS)}
+    else:
+        params = {'left': root, 'right': rng.choice(roots)}
+    return f"/{kind}?{urllib.parse.urlencode(params)}"
+
+
+def run_worker(host, port, socket_path, paths):
+    """
+    Sends the given request paths over one connection and returns (latencies, error count).
+    """
+
+    connection = open_connection(host, port, socket_path)
+    latencies = []
+    errors = 0
+    for path in paths:
+        start = time.perf_counter()
+        try:
+            status, _ = fetch(connection, path)
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = open_connection(host, port, socket_path)
+            status = None
+        latencies.append(time.perf_counter() - start)
+        if status != 200:
+            errors += 1
+    connection.close()
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    """
+    Returns the value below which the given fraction of the sorted values lies.
+    """
+
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', show_default=True, help='Address of the server.')
+@click.option('--port', default=DEFAULT_SERVE_PORT, show_default=True, help='Port of the server.')
+@click.option('--socket', 'socket_path', default=None, help='Connect to this Unix domain socket instead of TCP.')
+@click.option('--spawn', 'spawn_paths', multiple=True,
+              help='Start a server for these configuration files or directories for the duration of the test.')
+@click.option('--requests', 'request_count', default=2000, show_default=True, help='Total number of requests.')
+@click.option('--concurrency', '-c', default=8, show_default=True, help='Number of parallel connections.')
+@click.option('--mix', default='merge,query,diff', show_default=True,
+              help='Comma-separated request kinds to send, chosen uniformly.')
+@click.option('--touch-every', default=0, show_default=True,
+              help='Touch the root file of a random printer every N requests, so that the server has to merge it '
+                   'again. 0 never touches files.')
+@click.option('--seed', default=0, show_default=True, help='Seed of the request mix.')
+def main(host, port, socket_path, spawn_paths, request_count, concurrency, mix, touch_every, seed):
+    """
+    Sends a mix of requests to a KlipperFusion server and reports throughput and latency.
+    """
+
+    kinds = [kind.strip() for kind in mix.split(',') if kind.strip()]
+    unknown = [kind for kind in kinds if kind not in REQUEST_KINDS]
+    if not kinds or unknown:
+        sys.exit(f"--mix accepts {', '.join(REQUEST_KINDS)}.")
+
+    process = None
+    if spawn_paths:
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'klipper_fusion.py'),
+                   'serve', *spawn_paths]
+        command += ['--socket', socket_path] if socket_path else ['--host', host, '--port', str(port)]
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_server(host, port, socket_path)
+        connection = open_connection(host, port, socket_path)
+        status, body = fetch(connection, '/printers')
+        connection.close()
+        roots = json.loads(body)['roots']
+        if status != 200 or not roots:
+            sys.exit("The server does not serve any printers.")
+
+        rng = random.Random(seed)
+        paths = [build_request(rng.choice(kinds), roots, rng) for _ in range(request_count)]
+        batches = [[]]
+        for number, path in enumerate(paths, 1):
+            batches[-1].append(path)
+            if touch_every and number % touch_every == 0:
+                batches.append([])
+
+        latencies = []
+        errors = 0
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            for batch_number, batch in enumerate(batches):
+                if batch_number:
+                    os.utime(rng.choice(roots))
+                chunks = [batch[worker::concurrency] for worker in range(concurrency)]
+                for worker_latencies, worker_errors in executor.map(
+                        lambda chunk: run_worker(host, port, socket_path, chunk), [chunk for chunk in chunks if chunk]):
+                    latencies.extend(worker_latencies)
+                    errors += worker_errors
+        elapsed = time.perf_counter() - start
+
+        connection = open_connection(host, port, socket_path)
+        _, body = fetch(connection, '/stats')
+        connection.close()
+        stats = json.loads(body)
+    finally:
+        if process is not None:
+            # Interrupt the server like Ctrl+C, so that it shuts down cleanly and removes its socket
+            process.send_signal(signal.SIGINT)
+            process.wait()
+
+    latencies.sort()
+    print(f"{len(latencies)} requests ({', '.join(kinds)}) to {len(roots)} printers over {concurrency} connections "
+          f"in {elapsed:.2f} s: {len(latencies) / elapsed:,.0f} requests/s, {errors} errors")
+    print(f"  latency p50 {percentile(latencies, 0.5) * 1000:7.2f} ms, "
+          f"p95 {percentile(latencies, 0.95) * 1000:7.2f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:7.2f} ms, max {latencies[-1] * 1000:7.2f} ms")
+    print(f"  server: {stats['printers']} printers warm, {stats['bytes'] / 1024 / 1024:.1f} MiB, {stats['hits']} hits, "
+          f"{stats['misses']} misses, {stats['reloads']} reloads, {stats['evictions']} evictions")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import re
+
+MACRO_PREFIX = 'gcode_macro '
+
+JINJA_TAG = re.compile(r'\{%.*?%\}|\{#.*?#\}')
+COMMAND = re.compile(r'\s*([A-Za-z_][A-Za-z0-9_.]*)')
+PRINTER_ITEM = re.compile(r'''printer\[\s*(["'])(.+?)\1\s*\](?:\.(\w+))?''')
+PRINTER_ATTRIBUTE = re.compile(r'printer\.(\w+)')
+PARAMETER = re.compile(r'(\w+)=(\S+)')
+
+
+def macro_reference(macro_name, variable=None):
+    """
+    Returns the reference name of a macro variable, such as 'gcode_macro _USER_VARIABLES.verbose'. Macro names are
+    case-insensitive in Klipper and are therefore upper-cased.
+    """
+
+    reference = MACRO_PREFIX + macro_name.strip().upper()
+    return f"{reference}.{variable.lower()}" if variable else reference
+
+
+def scan_gcode(lines):
+    """
+    Scans the lines of a gcode block in one pass and returns (commands, references).
+
+    commands lists the upper-cased command of every line in call order, without duplicates. Jinja tags are removed
+    first, so commands inside '{% if %}' branches are found too; UPDATE_DELAYED_GCODE adds the 'delayed_gcode ID'
+    section it starts. references is the set of printer objects and macro variables the block reads or writes through
+    printer[...], printer.<object> or SET_GCODE_VARIABLE.
+    """
+
+    commands = {}
+    references = set()
+    in_tag = False
+    for line in lines:
+        if 'printer' in line:
+            for _, item, attribute in PRINTER_ITEM.findall(line):
+                if item.startswith(MACRO_PREFIX):
+                    references.add(macro_reference(item[len(MACRO_PREFIX):], attribute))
+                else:
+                    references.add(item)
+            references.update(PRINTER_ATTRIBUTE.findall(line))
+
+        if in_tag:
+            end = line.find('%}')
+            if end < 0:
+                continue
+            line = line[end + 2:]
+            in_tag = False
+        if '{' in line:
+            line = JINJA_TAG.sub(' ', line)
+            start = line.find('{%')
+            if start >= 0:
+                line = line[:start]
+                in_tag = True
+
+        match = COMMAND.match(line)
+        if match is None:
+            continue
+        command = match.group(1).upper()
+        commands[command] = None
+        if command == 'UPDATE_DELAYED_GCODE' or command == 'SET_GCODE_VARIABLE':
+            parameters = {name.upper(): value for name, value in PARAMETER.findall(line)}
+            if command == 'UPDATE_DELAYED_GCODE' and 'ID' in parameters:
+                commands['delayed_gcode ' + parameters['ID']] = None
+            elif command == 'SET_GCODE_VARIABLE' and 'MACRO' in parameters and 'VARIABLE' in parameters:
+                references.add(macro_reference(parameters['MACRO'], parameters['VARIABLE']))
+    return tuple(commands), references
+
+
+class MacroIndex:
+    """Call graph of the gcode in a merged configuration.
+
+    Every section with gcode blocks (gcode_macro, delayed_gcode, homing_override, filament sensors and so on) is a
+    caller; it calls the commands of the last definition of each of its blocks. Commands are resolved to gcode_macro
+    sections by upper-cased name, and UPDATE_DELAYED_GCODE resolves to delayed_gcode sections. Reverse edges are kept
+    for commands and for references to printer objects and macro variables, so "who calls X" is a dictionary lookup.
+
+    update() is incremental: a section whose gcode lines did not change since the previous update is not scanned
+    again, and only the edges of changed, added or removed sections are rewritten."""
+
+    def __init__(self):
+        """
+        Initializes an empty index.
+        """
+
+        self.macros = {}  # Upper-cased macro name -> section name
+        self.delayed_gcode = {}  # 'delayed_gcode ID' -> section name
+        self.lines = {}  # Section name -> tuple of the gcode lines the entry was built from
+        self.commands = {}  # Section name -> commands in call order
+        self.references = {}  # Section name -> printer objects and macro variables referenced
+        self.callers = {}  # Command -> names of the sections calling it
+        self.users = {}  # Reference -> names of the sections referencing it
+        self.scanned = 0  # Sections scanned by the last update
+
+    @classmethod
+    def build(cls, sections):
+        """
+        Returns an index of the sections of a merged configuration (a name -> ConfigurationSection dictionary).
+        """
+
+        index = cls()
+        index.update(sections)
+        return index
+
+    def update(self, sections):
+        """
+        Brings the index up to date with sections, scanning only sections whose gcode changed.
+        """
+
+        self.scanned = 0
+        self.macros = {}
+        self.delayed_gcode = {}
+        current = set()
+        for name, section in sections.items():
+            if name.startswith(MACRO_PREFIX):
+                self.macros[name[len(MACRO_PREFIX):].strip().upper()] = name
+            elif name.startswith('delayed_gcode '):
+                self.delayed_gcode['delayed_gcode ' + name[len('delayed_gcode '):].strip()] = name
+            if not section.gcode_blocks:
+                continue
+            current.add(name)
+            lines = tuple(line for blocks in section.gcode_blocks.values() if blocks for line in blocks[-1].lines)
+            if self.lines.get(name) != lines:
+                self._remove(name)
+                self._add(name, lines)
+        for name in [name for name in self.lines if name not in current]:
+            self._remove(name)
+        return self
+
+    def _add(self, name, lines):
+        """
+        Scans the gcode of a section and adds its edges.
+        """
+
+        commands, references = scan_gcode(lines)
+        self.scanned += 1
+        self.lines[name] = lines
+        self.commands[name] = commands
+        self.references[name] = references
+        for command in commands:
+            self.callers.setdefault(command, set()).add(name)
+        for reference in references:
+            self.users.setdefault(reference, set()).add(name)
+
+    def _remove(self, name):
+        """
+        Removes the edges of a section.
+        """
+
+        if name not in self.lines:
+            return
+        del self.lines[name]
+        for command in self.commands.pop(name):
+            callers = self.callers[command]
+            callers.discard(name)
+            if not callers:
+                del self.callers[command]
+        for reference in self.references.pop(name):
+            users = self.users[reference]
+            users.discard(name)
+            if not users:
+                del self.users[reference]
+
+    def resolve(self, command):
+        """
+        Returns the section a command runs (a gcode_macro or delayed_gcode section), or None for built-in commands.
+        """
+
+        return self.macros.get(command.upper()) or self.delayed_gcode.get(command)
+
+    def section_name(self, name):
+        """
+        Returns the section name for a macro name ('PRINT_START') or a section name ('gcode_macro PRINT_START').
+        """
+
+        return self.resolve(name) or name
+
+    def calls(self, name):
+        """
+        Returns the sections called by a macro or section, in call order.
+        """
+
+        resolved = (self.resolve(command) for command in self.commands.get(self.section_name(name), ()))
+        return [section for section in resolved if section is not None]
+
+    def callers_of(self, name):
+        """
+        Returns the sections that call a macro (given by macro or section name), sorted by name.
+        """
+
+        section = self.section_name(name)
+        if section.startswith(MACRO_PREFIX):
+            command = section[len(MACRO_PREFIX):].strip().upper()
+        else:
+            command = section
+        return sorted(self.callers.get(command, ()))
+
+    def blast_radius(self, name):
+        """
+        Returns every section that calls a macro directly or through other macros, sorted by name. These are the
+        sections whose behaviour changes when the macro is overridden.
+        """
+
+        affected = set()
+        pending = [self.section_name(name)]
+        while pending:
+            for caller in self.callers_of(pending.pop()):
+                if caller not in affected:
+                    affected.add(caller)
+                    pending.append(caller)
+        return sorted(affected)
+
+    def unused_macros(self):
+        """
+        Returns the macros no other section calls, sorted by name. Most macros without '_' prefix are meant to be run
+        by hand or by the slicer, so they show up here as well.
+        """
+
+        unused = []
+        for macro_name, section in self.macros.items():
+            callers = self.callers.get(macro_name, ())
+            if not callers or callers == {section}:
+                unused.append(section)
+        return sorted(unused)
+
+    def users_of(self, reference):
+        """
+        Returns the sections that reference a printer object or macro variable (such as 'toolhead' or
+        'gcode_macro _USER_VARIABLES.verbose'), sorted by name.
+        """
+
+        if reference.startswith(MACRO_PREFIX):
+            macro_name, _, variable = reference[len(MACRO_PREFIX):].partition('.')
+            reference = macro_reference(macro_name, variable or None)
+        return sorted(self.users.get(reference, ()))
+
+    def references_of(self, name):
+        """
+        Returns the printer objects and macro variables a macro or section references, sorted.
+        """
+
+        return sorted(self.references.get(self.section_name(name), ()))
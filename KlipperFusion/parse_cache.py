@@ -0,0 +1,262 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import os
+import pickle
+import threading
+
+from config_lexer import TOKEN_FORMAT_VERSION
+from include_graph import GlobCache
+from source_reader import read_source_text
+
+CACHE_FORMAT_VERSION = 1
+DEFAULT_MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def default_cache_dir():
+    """
+    Returns the default cache directory, honouring XDG_CACHE_HOME when it is set.
+    """
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'klipper_fusion')
+
+
+def content_digest(text):
+    """
+    Returns the content hash used to fingerprint the text of a configuration file.
+    """
+
+    return hashlib.sha256(text.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+class ParseCache:
+    """Persistent on-disk cache of per-file token streams.
+
+    Each entry is keyed by the normalized path of a configuration file and stores the file's modification time, size
+    and content hash next to its token stream. An unchanged stat result lets the parser replay the tokens without
+    reading the file at all; a changed stat result with an identical content hash only costs the read. The cache also
+    keeps one manifest per run so that a rerun can be skipped entirely when nothing in the include closure changed.
+    Old entries are evicted, least recently used first, once the cache grows beyond max_bytes."""
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+        """
+        Initializes the cache rooted at cache_dir, creating the directory layout when needed.
+        """
+
+        self.cache_dir = os.path.abspath(cache_dir or default_cache_dir())
+        self.max_bytes = max_bytes
+        self.files_dir = os.path.join(self.cache_dir, 'files')
+        self.runs_dir = os.path.join(self.cache_dir, 'runs')
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.files_dir, exist_ok=True)
+        os.makedirs(self.runs_dir, exist_ok=True)
+
+    @staticmethod
+    def _entry_name(key):
+        """
+        Maps an arbitrary key to a file name inside the cache directory.
+        """
+
+        return hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest() + '.pickle'
+
+    @staticmethod
+    def _load(entry_path):
+        """
+        Loads a pickled cache entry, returning None when it is missing, unreadable or from another format version.
+        """
+
+        try:
+            with open(entry_path, 'rb') as file:
+                entry = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Warning: Ignoring unreadable cache entry {entry_path}: {e}")
+            return None
+
+        if not isinstance(entry, dict) or entry.get('version') != (CACHE_FORMAT_VERSION, TOKEN_FORMAT_VERSION):
+            return None
+        return entry
+
+    @staticmethod
+    def _store(entry_path, entry):
+        """
+        Atomically writes a cache entry so that concurrent runs never observe a partially written file. The temporary
+        file is named after the process and thread, so threads storing the same entry do not write into each other.
+        """
+
+        entry['version'] = (CACHE_FORMAT_VERSION, TOKEN_FORMAT_VERSION)
+        temp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as file:
+                pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, entry_path)
+        except OSError as e:
+            print(f"Warning: Could not write cache entry {entry_path}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @staticmethod
+    def _touch(entry_path):
+        """
+        Marks a cache entry as recently used for the eviction policy.
+        """
+
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+
+    def get_tokens(self, filepath, tokenize_text):
+        """
+        Returns (tokens, fingerprint) for filepath, where fingerprint is a (mtime_ns, size, digest) tuple.
+
+        The cached token stream is reused when the file's stat result or content hash matches the cached entry,
+        otherwise the file is tokenized with tokenize_text and the entry is refreshed.
+        """
+
+        stat = os.stat(filepath)
+        entry_path = os.path.join(self.files_dir, self._entry_name(filepath))
+        entry = self._load(entry_path)
+
+        if entry is not None and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            self.hits += 1
+            self._touch(entry_path)
+            return entry['tokens'], (entry['mtime_ns'], entry['size'], entry['digest'])
+
+        text = read_source_text(filepath)
+        digest = content_digest(text)
+
+        if entry is not None and entry['digest'] == digest:
+            self.hits += 1
+            tokens = entry['tokens']
+        else:
+            self.misses += 1
+            tokens = tokenize_text(text)
+
+        self._store(entry_path, {'path': filepath, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size,
+                                 'digest': digest, 'tokens': tokens})
+        return tokens, (stat.st_mtime_ns, stat.st_size, digest)
+
+    def _run_entry_path(self, root_filepath, output_filepath, options):
+        """
+        Returns the manifest path for a run identified by its root file, output file and output options.
+        """
+
+        key = repr((os.path.abspath(root_filepath), os.path.abspath(output_filepath), sorted(options.items())))
+        return os.path.join(self.runs_dir, self._entry_name(key))
+
+    @staticmethod
+    def _file_unchanged(path, fingerprint):
+        """
+        Checks whether a file still matches its recorded (mtime_ns, size, digest) fingerprint.
+        """
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        mtime_ns, size, digest = fingerprint
+        if stat.st_mtime_ns == mtime_ns and stat.st_size == size:
+            return True
+        if stat.st_size != size:
+            return False
+        try:
+            return content_digest(read_source_text(path)) == digest
+        except (OSError, ValueError):
+            return False
+
+    def is_run_unchanged(self, root_filepath, output_filepath, options):
+        """
+        Returns True when the previous run with the same root, output and options saw exactly the same include
+        closure: every parsed file is unchanged, every missing file is still missing, every glob expands to the same
+        files, and the output file is the one that run wrote.
+        """
+
+        manifest = self._load(self._run_entry_path(root_filepath, output_filepath, options))
+        if manifest is None:
+            return False
+
+        try:
+            stat = os.stat(output_filepath)
+        except OSError:
+            return False
+        if (stat.st_mtime_ns, stat.st_size) != manifest['output']:
+            return False
+
+        glob_cache = GlobCache()
+        for pattern, matching_files in manifest['globs'].items():
+            if glob_cache.expand(pattern) != matching_files:
+                return False
+        if any(os.path.exists(path) for path in manifest['missing']):
+            return False
+        return all(self._file_unchanged(path, fingerprint) for path, fingerprint in manifest['files'].items())
+
+    def record_run(self, root_filepath, output_filepath, options, parser):
+        """
+        Stores the include closure seen by parser together with the fingerprint of the output it produced.
+        """
+
+        if any(fingerprint is None for fingerprint in parser.parsed_files.values()):
+            return
+
+        try:
+            stat = os.stat(output_filepath)
+        except OSError as e:
+            print(f"Warning: Could not record run manifest: {e}")
+            return
+
+        self._store(self._run_entry_path(root_filepath, output_filepath, options), {
+            'files': dict(parser.parsed_files),
+            'missing': sorted(parser.missing_files),
+            'globs': dict(parser.glob_results),
+            'output': (stat.st_mtime_ns, stat.st_size),
+        })
+
+    def prune(self):
+        """
+        Evicts the least recently used entries until the cache fits into max_bytes.
+        """
+
+        entries = []
+        total_size = 0
+        for directory in (self.files_dir, self.runs_dir):
+            for entry in os.scandir(directory):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
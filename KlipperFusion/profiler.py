@@ -0,0 +1,249 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import functools
+import json
+import os
+import threading
+import time
+
+# Parser methods wrapped while profiling, with the category each call is reported under.
+PROFILED_METHODS = (
+    ('parse_file', 'file'),
+    ('expand_glob', 'glob'),
+    ('load_tokens', 'load'),
+    ('read_tokens', 'read'),
+    ('tokenize_text', 'tokenize'),
+    ('write_output', 'write'),
+    ('write_effective_output', 'write'),
+)
+
+
+class Span:
+    """A single timed call of a profiled parser method."""
+
+    __slots__ = ('name', 'category', 'path', 'start', 'end', 'parent', 'thread', 'children_time', 'result_size')
+
+    def __init__(self, name, category, path, start, parent, thread):
+        self.name = name
+        self.category = category
+        self.path = path
+        self.start = start
+        self.end = start
+        self.parent = parent
+        self.thread = thread
+        self.children_time = 0.0
+        self.result_size = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def self_time(self):
+        return self.duration - self.children_time
+
+
+class Profiler:
+    """Records where the time of a merge goes: glob expansion, file I/O, tokenizing, applying tokens and writing.
+
+    Profiling is opt-in per parser: attach() wraps a handful of the parser's methods on that instance only, so a
+    parser that is not profiled runs exactly the same code as before and pays nothing. Calls nest naturally, because
+    included files are parsed from within the including file, which makes the recorded spans a faithful picture of
+    the include tree. The spans can be summarized as a table or exported as a Chrome trace_event file."""
+
+    def __init__(self):
+        """
+        Initializes an empty profile.
+        """
+
+        self.spans = []
+        self.origin = time.perf_counter()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.base_path = ''
+        self.counts = {}
+
+    def attach(self, parser):
+        """
+        Starts profiling parser by wrapping its profiled methods on the instance.
+        """
+
+        self.base_path = parser.base_path
+        for name, category in PROFILED_METHODS:
+            setattr(parser, name, self._wrap(getattr(parser, name), name, category))
+        return self
+
+    def _wrap(self, method, name, category):
+        """
+        Returns a wrapper that records a span around every call of method.
+        """
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            stack = getattr(self.local, 'stack', None)
+            if stack is None:
+                stack = self.local.stack = []
+            path = args[0] if args and isinstance(args[0], str) and category != 'tokenize' else None
+            span = Span(name, category, path, time.perf_counter(), stack[-1] if stack else None, threading.get_ident())
+            stack.append(span)
+            try:
+                result = method(*args, **kwargs)
+                if category in ('load', 'tokenize'):
+                    span.result_size = len(result)
+                return result
+            finally:
+                span.end = time.perf_counter()
+                stack.pop()
+                if stack:
+                    stack[-1].children_time += span.duration
+                with self.lock:
+                    self.spans.append(span)
+
+        return wrapper
+
+    def collect_counts(self, parser):
+        """
+        Records the size of the merged state: files, sections, keys, overrides and gcode blocks.
+        """
+
+        sections = parser.sections.values()
+        self.counts = {
+            'files': len(parser.parsed_files),
+            'missing_files': len(parser.missing_files),
+            'glob_includes': len(parser.glob_results),
+            'sections': len(parser.sections),
+            'keys': sum(len(section.key_value_pairs) for section in sections),
+            'overrides': sum(len(kvp.occurrences) for section in sections for kvp in section.key_value_pairs.values()),
+            'gcode_blocks': sum(len(blocks) for section in sections for blocks in section.gcode_blocks.values()),
+        }
+        return self.counts
+
+    def _relative(self, path):
+        """
+        Returns path relative to the parser's base path for display.
+        """
+
+        return os.path.relpath(path, self.base_path) if path and self.base_path else (path or '')
+
+    def phase_times(self):
+        """
+        Returns the total time per phase. Reading excludes tokenizing and applying excludes everything done for
+        nested files, so the phases add up to the wall time of the merge.
+        """
+
+        phases = {'glob': 0.0, 'read': 0.0, 'tokenize': 0.0, 'apply': 0.0, 'write': 0.0}
+        for span in self.spans:
+            if span.category == 'file':
+                # Whatever a file span did besides loading tokens and nested includes is spent applying tokens
+                if span.path and '*' not in span.path:
+                    phases['apply'] += span.self_time
+            elif span.category == 'glob':
+                phases['glob'] += span.self_time
+            elif span.category == 'read':
+                phases['read'] += span.self_time
+            elif span.category == 'tokenize':
+                phases['tokenize'] += span.duration
+            elif span.category == 'write':
+                phases['write'] += span.duration
+        return phases
+
+    def file_records(self):
+        """
+        Returns one record per parsed file with its include depth, line count and time spent per phase.
+        """
+
+        records = {}
+
+        def record_for(path):
+            return records.setdefault(path, {'path': self._relative(path), 'depth': 0, 'lines': 0, 'read': 0.0,
+                                             'tokenize': 0.0, 'apply': 0.0, 'total': 0.0})
+
+        for span in self.spans:
+            if span.category == 'load':
+                record = record_for(span.path)
+                record['lines'] = span.result_size or 0
+                file_span = span.parent
+                if file_span is not None:
+                    record['apply'] += file_span.self_time
+                    record['total'] += file_span.duration
+                    # Glob includes add a parse_file level of their own that is not an include level
+                    ancestor, depth = file_span.parent, 0
+                    while ancestor is not None:
+                        if ancestor.category == 'file' and '*' not in (ancestor.path or ''):
+                            depth += 1
+                        ancestor = ancestor.parent
+                    record['depth'] = depth
+            elif span.category == 'read':
+                record_for(span.path)['read'] += span.self_time
+            elif span.category == 'tokenize' and span.parent is not None and span.parent.category == 'read':
+                record_for(span.parent.path)['tokenize'] += span.duration
+        return list(records.values())
+
+    def format_summary(self, limit=20):
+        """
+        Returns the profile as a printable table: time per phase, the slowest files and the merged state counts.
+        """
+
+        lines = ["Time per phase:"]
+        phases = self.phase_times()
+        total = sum(phases.values()) or 1.0
+        for phase, seconds in phases.items():
+            lines.append(f"  {phase:<10} {seconds * 1000:10.2f} ms {seconds / total:7.1%}")
+
+        records = sorted(self.file_records(), key=lambda record: record['total'], reverse=True)
+        lines.append(f"Files ({len(records)}, slowest {min(limit, len(records))} by inclusive time):")
+        lines.append(f"  {'depth':>5} {'lines':>7} {'read ms':>9} {'tok ms':>9} {'apply ms':>9} {'total ms':>9}  file")
+        for record in records[:limit]:
+            lines.append(f"  {record['depth']:>5} {record['lines']:>7} {record['read'] * 1000:9.2f} "
+                         f"{record['tokenize'] * 1000:9.2f} {record['apply'] * 1000:9.2f} "
+                         f"{record['total'] * 1000:9.2f}  {record['path']}")
+
+        if self.counts:
+            lines.append("Merged state: " + ", ".join(f"{count} {name.replace('_', ' ')}"
+                                                      for name, count in self.counts.items()))
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, trace_filepath):
+        """
+        Writes the spans as a Chrome trace_event JSON file, viewable in chrome://tracing or Perfetto. Files are
+        shown as nested spans following the include tree.
+        """
+
+        events = []
+        for span in sorted(self.spans, key=lambda item: item.start):
+            name = self._relative(span.path) if span.path else span.name
+            args = {'method': span.name}
+            if span.result_size is not None:
+                args['size'] = span.result_size
+            events.append({
+                'name': name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': (span.start - self.origin) * 1e6,
+                'dur': span.duration * 1e6,
+                'pid': os.getpid(),
+                'tid': span.thread,
+                'args': args,
+            })
+        with open(trace_filepath, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'counts': self.counts}}, file)
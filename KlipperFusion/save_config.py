@@ -0,0 +1,285 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from array import array
+import hashlib
+import math
+import operator
+
+from config_lexer import TOKEN_LINE
+from source_reader import read_source_text, split_lines
+
+# Klipper appends the SAVE_CONFIG block to the main configuration file after a header line containing this marker.
+# Every line of the block starts with the prefix followed by a space.
+SAVE_CONFIG_PREFIX = '#*#'
+SAVE_CONFIG_MARKER = 'SAVE_CONFIG'
+BED_MESH_SECTION_PREFIX = 'bed_mesh '
+
+
+def save_config_intact(lines):
+    """
+    Checks the lines after a SAVE_CONFIG header the way Klipper does: up to trailing blank lines, every line has to
+    start with the prefix, followed by a space unless the line is just the prefix. Klipper does not read a block that
+    was modified after its header and reads the whole file as regular configuration instead.
+    """
+
+    lines = [line.rstrip('\r\n') for line in lines]
+    while lines and not lines[-1].strip():
+        lines.pop()
+    prefix_length = len(SAVE_CONFIG_PREFIX)
+    return all(line.startswith(SAVE_CONFIG_PREFIX) and line[prefix_length:prefix_length + 1] in ('', ' ')
+               for line in lines)
+
+
+def warn_modified_save_config(filename):
+    """
+    Prints the warning for a SAVE_CONFIG block that is not read because lines were added after its header.
+    """
+
+    print(f"Warning: {filename} has lines after its SAVE_CONFIG header that do not belong to the block. Like "
+          f"Klipper, the block is ignored and the whole file is read as regular configuration.")
+
+
+def find_save_config(tokens, filename):
+    """
+    Returns the index of the token holding the SAVE_CONFIG header line, or None when the file has no SAVE_CONFIG
+    block or the block was modified after its header, in which case a warning is printed.
+    """
+
+    for position, token in enumerate(tokens):
+        if token[0] == TOKEN_LINE and token[1].startswith(SAVE_CONFIG_PREFIX) and SAVE_CONFIG_MARKER in token[1]:
+            tail = tokens[position + 1:]
+            if all(token[0] == TOKEN_LINE for token in tail) and save_config_intact([token[1] for token in tail]):
+                return position
+            warn_modified_save_config(filename)
+            return None
+    return None
+
+
+def array_stats(points):
+    """
+    Returns the minimum, maximum, range, mean, standard deviation and root mean square of a non-empty array or list
+    of floats. An array is converted to a list first, so its float objects are created once instead of once per
+    pass, and every pass runs in C through min, max, sum and map.
+    """
+
+    values = points.tolist() if isinstance(points, array) else points
+    count = len(values)
+    mean = sum(values) / count
+    mean_square = sum(map(operator.mul, values, values)) / count
+    low = min(values)
+    high = max(values)
+    return {'min': low, 'max': high, 'range': high - low, 'mean': mean,
+            'stdev': math.sqrt(max(mean_square - mean * mean, 0.0)), 'rms': math.sqrt(mean_square)}
+
+
+class BedMesh:
+    """A bed mesh profile saved by Klipper. The probed points are kept row by row in a single array of doubles, which
+    takes 8 bytes per point instead of a string or float object each."""
+
+    __slots__ = ('profile', 'filename', 'x_count', 'y_count', 'points')
+
+    def __init__(self, profile, filename, x_count, y_count, points):
+        """
+        Initializes a mesh of y_count rows of x_count points each.
+        """
+
+        self.profile = profile
+        self.filename = filename
+        self.x_count = x_count
+        self.y_count = y_count
+        self.points = points
+
+    @classmethod
+    def from_rows(cls, profile, filename, rows):
+        """
+        Builds a mesh from the comma separated rows of a points value. Raises ValueError when a row cannot be parsed
+        or the rows differ in length.
+        """
+
+        points = array('d')
+        x_count = None
+        for row in rows:
+            values = row.split(',')
+            if x_count is None:
+                x_count = len(values)
+            elif len(values) != x_count:
+                raise ValueError(f"Row {row.strip()!r} of bed mesh '{profile}' has {len(values)} points instead of "
+                                 f"{x_count}.")
+            points.extend(map(float, values))
+        if x_count is None:
+            raise ValueError(f"Bed mesh '{profile}' has no points.")
+        return cls(profile, filename, x_count, len(points) // x_count, points)
+
+    def rows(self):
+        """
+        Returns the points as a list of rows.
+        """
+
+        x_count = self.x_count
+        return [self.points[start:start + x_count].tolist() for start in range(0, len(self.points), x_count)]
+
+    def iter_row_text(self):
+        """
+        Yields every row formatted the way Klipper writes it, with six decimals.
+        """
+
+        x_count = self.x_count
+        for start in range(0, len(self.points), x_count):
+            yield ', '.join(['%.6f' % point for point in self.points[start:start + x_count]])
+
+    def iter_output(self):
+        """
+        Yields the points as a multi-line 'points' value with indented rows.
+        """
+
+        yield "points:\n"
+        for row in self.iter_row_text():
+            yield f"  {row}\n"
+
+    def summary(self):
+        """
+        Returns a one-line description of the mesh.
+        """
+
+        stats = self.stats()
+        return f"{self.x_count}x{self.y_count} mesh, range {stats['range']:.6f}, mean {stats['mean']:.6f}"
+
+    def digest(self):
+        """
+        Returns a hex digest of the shape and points of the mesh.
+        """
+
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(f"{self.x_count}x{self.y_count}".encode())
+        hasher.update(self.points.tobytes())
+        return hasher.hexdigest()
+
+    def stats(self):
+        """
+        Returns the minimum, maximum, range, mean, standard deviation and root mean square of the points.
+        """
+
+        return array_stats(self.points)
+
+    def compare(self, other):
+        """
+        Compares this mesh with a newer one of the same shape and returns the statistics of the point differences
+        (other minus this) together with the largest absolute difference. Raises ValueError when the shapes differ.
+        """
+
+        if (self.x_count, self.y_count) != (other.x_count, other.y_count):
+            raise ValueError(f"Cannot compare a {self.x_count}x{self.y_count} mesh with a "
+                             f"{other.x_count}x{other.y_count} mesh.")
+        result = array_stats(list(map(operator.sub, other.points.tolist(), self.points.tolist())))
+        result['max_abs'] = max(result['max'], -result['min'])
+        return result
+
+
+class SaveConfig:
+    """The SAVE_CONFIG block Klipper appends to the main configuration file.
+
+    Klipper reads the block after the rest of the configuration, so its values override every file. Sections map
+    key names to their string values, except for the points of bed mesh profiles, which are parsed into BedMesh
+    objects."""
+
+    def __init__(self, filename):
+        """
+        Initializes an empty block read from filename.
+        """
+
+        self.filename = filename
+        self.sections = {}  # Section name -> {key: value}
+        self.meshes = {}  # Section name -> BedMesh
+
+    @classmethod
+    def from_lines(cls, lines, filename):
+        """
+        Parses the lines of a SAVE_CONFIG block. Lines before the first section, like the header, are skipped.
+        Keys are separated from values by '=' or ':', and indented lines continue the value of the previous key.
+        """
+
+        save_config = cls(filename)
+        section_name = None
+        key = None
+        continuation = []
+        for line in lines:
+            if not line.startswith(SAVE_CONFIG_PREFIX):
+                continue
+            body = line[len(SAVE_CONFIG_PREFIX) + 1:].rstrip()
+            content = body.strip()
+            if not content:
+                continue
+            if body[0] in ' \t':
+                if key is not None:
+                    continuation.append(content)
+                continue
+            save_config.store(section_name, key, continuation)
+            key = None
+            continuation = []
+            if content.startswith('['):
+                section_name = content.strip('[]').strip()
+                save_config.sections.setdefault(section_name, {})
+                continue
+            if section_name is None:
+                continue
+            separator = min((position for position in (content.find('='), content.find(':')) if position >= 0),
+                            default=-1)
+            if separator < 0:
+                continue
+            key = content[:separator].strip()
+            continuation = [content[separator + 1:].strip()]
+        save_config.store(section_name, key, continuation)
+        return save_config
+
+    @classmethod
+    def from_file(cls, filepath):
+        """
+        Reads the SAVE_CONFIG block of a configuration file, which is empty when the file has none or when the block
+        was modified after its header.
+        """
+
+        lines = split_lines(read_source_text(filepath))
+        for position, line in enumerate(lines):
+            if line.startswith(SAVE_CONFIG_PREFIX) and SAVE_CONFIG_MARKER in line:
+                if save_config_intact(lines[position + 1:]):
+                    return cls.from_lines(lines[position:], filepath)
+                warn_modified_save_config(filepath)
+                break
+        return cls(filepath)
+
+    def store(self, section_name, key, parts):
+        """
+        Stores a parsed key of a section. The points of a bed mesh profile become a BedMesh; if they
+        cannot be parsed, a warning is printed and they are kept as a plain value.
+        """
+
+        if key is None:
+            return
+        if key == 'points' and section_name.startswith(BED_MESH_SECTION_PREFIX):
+            try:
+                self.meshes[section_name] = BedMesh.from_rows(section_name[len(BED_MESH_SECTION_PREFIX):].strip(),
+                                                              self.filename, [part for part in parts if part])
+                return
+            except ValueError as e:
+                print(f"Warning: {e}")
+        self.sections[section_name][key] = '\n  '.join(parts).strip()
@@ -0,0 +1,493 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import contextlib
+import errno
+import io
+import json
+import os
+import socketserver
+import stat
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config_diff import MerkleTree, diff_trees
+from config_index import ConfigIndex, answer_queries
+from config_overlay import OverlayParser
+from config_parser import ConfigParser
+from file_source import FilesystemSource
+from watch_mode import ClosureState
+
+# A local server that keeps the merged state of many printers warm, so that a dashboard can ask for merged outputs,
+# queries and diffs without starting a Python process and parsing the whole include tree for every request. Every
+# request checks the include closure of the printers it touches with a few stat calls and merges a printer again when
+# one of its files changed. The states live in an LRU that is bounded by their estimated memory footprint.
+
+DEFAULT_SERVE_PORT = 8765
+DEFAULT_MAX_STATE_MB = 256
+GCODE_HISTORY_MODES = ('full', 'diff')
+
+
+class RequestError(Exception):
+    """Raised while handling a request to answer it with an HTTP error status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def estimate_state_size(parser):
+    """
+    Returns an estimate of the memory held by the merged state of a parser in bytes: its sections, values, comments,
+    value history, gcode blocks and bed meshes. Strings shared through interning are counted once per reference, so
+    the estimate errs on the high side.
+    """
+
+    getsizeof = sys.getsizeof
+    size = getsizeof(parser.sections)
+    for name, section in parser.sections.items():
+        size += getsizeof(name) + getsizeof(section) + getsizeof(section.key_value_pairs)
+        size += getsizeof(section.gcode_blocks) + getsizeof(section.filenames) + getsizeof(section.file_order)
+        for kvp in section.key_value_pairs.values():
+            size += getsizeof(kvp) + getsizeof(kvp.value) + getsizeof(kvp.preceding_comments)
+            size += sum(map(getsizeof, kvp.preceding_comments))
+            if kvp.occurrences:
+                size += getsizeof(kvp.occurrences)
+                size += sum(getsizeof(occurrence) + getsizeof(occurrence[1]) for occurrence in kvp.occurrences)
+        for blocks in section.gcode_blocks.values():
+            size += getsizeof(blocks)
+            for block in blocks:
+                size += getsizeof(block)
+                stored = block.delta if block.delta is not None else block._lines
+                size += getsizeof(stored)
+                if not isinstance(stored, str):
+                    size += sum(getsizeof(part) for part in stored if not isinstance(part, range))
+        if section.bed_mesh is not None:
+            size += getsizeof(section.bed_mesh) + getsizeof(section.bed_mesh.points)
+    return size
+
+
+class ThreadLocalStdout:
+    """Stand-in for sys.stdout that sends what a thread prints inside capture() to that thread's sink and everything
+    else to the wrapped stream. contextlib.redirect_stdout swaps the process-wide stream instead, so captures in
+    overlapping request threads restore each other's streams in the wrong order."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        sink = getattr(self.local, 'sink', None)
+        return (self.stream if sink is None else sink).write(text)
+
+    def flush(self):
+        sink = getattr(self.local, 'sink', None)
+        (self.stream if sink is None else sink).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @contextlib.contextmanager
+    def capture(self):
+        """
+        Collects what the current thread prints in a StringIO, which the context manager yields.
+        """
+
+        previous = getattr(self.local, 'sink', None)
+        sink = self.local.sink = io.StringIO()
+        try:
+            yield sink
+        finally:
+            self.local.sink = previous
+
+
+INSTALL_LOCK = threading.Lock()
+
+
+def capture_output():
+    """
+    Returns a context manager that collects what the current thread prints, see ThreadLocalStdout. The router is
+    installed as sys.stdout on first use.
+    """
+
+    with INSTALL_LOCK:
+        if not isinstance(sys.stdout, ThreadLocalStdout):
+            sys.stdout = ThreadLocalStdout(sys.stdout)
+        return sys.stdout.capture()
+
+
+class PrinterState:
+    """Merged state of one printer root together with everything derived from it: the query index, the hash tree
+    used for diffs and the merged outputs rendered so far."""
+
+    def __init__(self, root, cache=None):
+        """
+        Merges the configuration tree of root. Parser warnings are collected instead of being printed.
+        """
+
+        self.root = root
+        self.index = ConfigIndex()
+        self.parser = ConfigParser(os.path.dirname(root), cache, index=self.index)
+        start = time.perf_counter()
+        with capture_output() as messages:
+            self.parser.parse_file(root)
+        self.merge_time = time.perf_counter() - start
+        self.warnings = messages.getvalue().splitlines()
+        self.closure = ClosureState(self.parser)
+        self.tree = None
+        self.rendered = {}  # Output options -> merged output
+        self.size = estimate_state_size(self.parser)
+
+    def is_stale(self):
+        """
+        Returns True when a file of the include closure changed since the state was merged.
+        """
+
+        changed, _ = self.closure.changed_files()
+        return bool(changed)
+
+    def merkle_tree(self):
+        """
+        Returns the hash tree of the merged state, building it on first use.
+        """
+
+        if self.tree is None:
+            self.tree = MerkleTree(self.parser)
+        return self.tree
+
+    def render(self, hide_unmodified=True, gcode_history='full', effective_only=False, provenance=False):
+        """
+        Returns the merged output for the given options and whether it was rendered now. The effective output is
+        rendered from the full state, so both kinds of output share one merge.
+        """
+
+        options = (hide_unmodified, gcode_history, effective_only, provenance)
+        text = self.rendered.get(options)
+        if text is not None:
+            return text, False
+        if effective_only:
+            text = ''.join(self.parser.iter_effective_output(provenance))
+        else:
+            text = ''.join(self.parser.iter_output(hide_unmodified, gcode_history))
+        self.rendered[options] = text
+        return text, True
+
+
+class MergedStateCache:
+    """LRU of PrinterStates bounded by their estimated memory. The most recently used state is always kept, even when
+    it alone exceeds the bound. Printers are merged outside of the cache lock, so a cold printer only delays the
+    requests for that printer."""
+
+    def __init__(self, max_bytes, cache=None):
+        """
+        Initializes an empty cache holding at most max_bytes of merged state, merging through an optional ParseCache.
+        """
+
+        self.max_bytes = max_bytes
+        self.cache = cache
+        self.states = collections.OrderedDict()  # Root -> PrinterState, least recently used first
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.root_locks = {}  # Root -> lock held while the printer is merged
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    def get(self, root):
+        """
+        Returns the up-to-date PrinterState of root, merging it when it is not cached or when its files changed.
+        Concurrent requests for a printer that is being merged wait for that merge instead of merging it again.
+        """
+
+        state = self._lookup(root)
+        if state is not None:
+            return state
+        with self.lock:
+            root_lock = self.root_locks.setdefault(root, threading.Lock())
+        with root_lock:
+            # Another request may have merged the printer while this one waited
+            state = self._lookup(root)
+            if state is not None:
+                return state
+            state = PrinterState(root, self.cache)
+            with self.lock:
+                if root in self.states:
+                    self.reloads += 1
+                    self._remove(root)
+                else:
+                    self.misses += 1
+                self.states[root] = state
+                self.total_bytes += state.size
+                self._evict()
+            return state
+
+    def _lookup(self, root):
+        """
+        Returns the cached state of root when its files did not change, or None. The stat calls of the staleness check
+        run outside of the cache lock.
+        """
+
+        with self.lock:
+            state = self.states.get(root)
+        if state is None or state.is_stale():
+            return None
+        with self.lock:
+            self.hits += 1
+            if self.states.get(root) is state:
+                self.states.move_to_end(root)
+        return state
+
+    def render(self, root, **options):
+        """
+        Returns the merged output of root for the given output options. Rendered outputs are kept with the state and
+        count towards its size.
+        """
+
+        state = self.get(root)
+        with self.lock:
+            text, rendered = state.render(**options)
+            if rendered and self.states.get(root) is state:
+                state.size += sys.getsizeof(text)
+                self.total_bytes += sys.getsizeof(text)
+                self._evict()
+        return text
+
+    def _remove(self, root):
+        state = self.states.pop(root)
+        self.total_bytes -= state.size
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.states) > 1:
+            self._remove(next(iter(self.states)))
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Returns the counters of the cache as a dictionary.
+        """
+
+        with self.lock:
+            return {'printers': len(self.states), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'reloads': self.reloads, 'evictions': self.evictions,
+                    'states': [{'root': root, 'bytes': state.size, 'merge_ms': round(state.merge_time * 1000, 2)}
+                               for root, state in self.states.items()]}
+
+
+class ServeRequestHandler(BaseHTTPRequestHandler):
+    """Answers the HTTP API of the server. All requests are GET requests with URL query parameters:
+
+    /printers                      the printer roots the server answers for
+    /merge?root=R                  merged output (hide_unmodified, gcode_history, effective_only, provenance)
+    /query?root=R&selector=S       query answers as JSON (selector, key and file can be repeated)
+    /diff?left=R&right=R           structural diff of two printers as JSON
+    /overlay?root=R&file=F         what override files would change, as JSON (file can be repeated)
+    /stats                         cache counters as JSON"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'KlipperFusion'
+    # Headers and body are buffered and sent together when the request is done. Sent separately, the small header
+    # write runs into Nagle's algorithm and delayed ACKs on keep-alive connections and every response takes 40 ms.
+    wbufsize = 64 * 1024
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        handlers = {'/printers': self.handle_printers, '/merge': self.handle_merge, '/query': self.handle_query,
+                    '/diff': self.handle_diff, '/overlay': self.handle_overlay, '/stats': self.handle_stats}
+        handler = handlers.get(url.path)
+        if handler is None:
+            self.send_error_text(404, f"Unknown endpoint {url.path}")
+            return
+        try:
+            handler(params)
+        except RequestError as e:
+            self.send_error_text(e.status, str(e))
+        except Exception as e:
+            self.send_error_text(500, f"Unexpected error: {e}")
+
+    def root_param(self, params, name='root'):
+        """
+        Returns the printer root named by a request parameter. Only the roots the server was started with are served.
+        """
+
+        values = params.get(name)
+        if not values:
+            raise RequestError(400, f"Missing parameter '{name}'.")
+        root = os.path.abspath(values[0])
+        if root not in self.server.roots:
+            raise RequestError(404, f"Unknown printer root {values[0]}")
+        return root
+
+    @staticmethod
+    def flag_param(params, name):
+        return params.get(name, ['0'])[0].lower() in ('1', 'true', 'yes')
+
+    def handle_printers(self, params):
+        self.send_json({'roots': sorted(self.server.roots)})
+
+    def handle_merge(self, params):
+        gcode_history = params.get('gcode_history', ['full'])[0]
+        if gcode_history not in GCODE_HISTORY_MODES:
+            raise RequestError(400, f"gcode_history must be one of {', '.join(GCODE_HISTORY_MODES)}.")
+        text = self.server.states.render(
+            self.root_param(params), hide_unmodified=self.flag_param(params, 'hide_unmodified'),
+            gcode_history=gcode_history, effective_only=self.flag_param(params, 'effective_only'),
+            provenance=self.flag_param(params, 'provenance'))
+        self.send_body(200, text.encode(), 'text/plain; charset=utf-8')
+
+    def handle_query(self, params):
+        selectors, keys, files = params.get('selector', []), params.get('key', []), params.get('file', [])
+        if not (selectors or keys or files):
+            raise RequestError(400, "Provide at least one selector, key or file parameter.")
+        state = self.server.states.get(self.root_param(params))
+        answers, missing = answer_queries(state.index, selectors, keys, files, state.parser.base_path)
+        self.send_json({'answers': answers, 'not_found': missing})
+
+    def handle_diff(self, params):
+        left = self.server.states.get(self.root_param(params, 'left'))
+        right = self.server.states.get(self.root_param(params, 'right'))
+        self.send_json(diff_trees(left.merkle_tree(), right.merkle_tree()))
+
+    def handle_overlay(self, params):
+        files = params.get('file', [])
+        if not files:
+            raise RequestError(400, "Provide at least one file parameter.")
+        state = self.server.states.get(self.root_param(params))
+        paths = [self.overlay_path(state.parser.base_path, path) for path in files]
+        overlay = OverlayParser(state.parser)
+        # Files the overlays include are confined to the configuration directory as well
+        overlay.file_source = FilesystemSource(state.parser.base_path)
+        with capture_output():
+            for path in paths:
+                overlay.add_file(path)
+            overlay.finish()
+        self.send_json(overlay.change_report())
+
+    @staticmethod
+    def overlay_path(base_path, path):
+        """
+        Resolves an overlay file parameter relative to the printer's configuration directory. Only files inside that
+        directory are read, and files outside of it are refused with the same message as missing ones, so a client
+        cannot probe the rest of the file system.
+        """
+
+        resolved = os.path.realpath(os.path.join(base_path, path))
+        if os.path.commonpath([resolved, os.path.realpath(base_path)]) != os.path.realpath(base_path) or \
+                not os.path.isfile(resolved):
+            raise RequestError(404, f"Overlay file {path} not found in the configuration directory of the printer.")
+        return resolved
+
+    def handle_stats(self, params):
+        self.send_json(self.server.states.stats())
+
+    def send_json(self, data):
+        self.send_body(200, json.dumps(data).encode(), 'application/json')
+
+    def send_error_text(self, status, message):
+        self.send_body(status, (message + '\n').encode(), 'text/plain; charset=utf-8')
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ServeHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer with a listen backlog that is large enough for a dashboard opening many connections at
+    once. With the default backlog of 5, surplus connection attempts are dropped and retried a second later."""
+
+    request_queue_size = 128
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server listening on a Unix domain socket. A socket left at the path by a server that was not shut down
+    cleanly is replaced, but any other file there is an error, and closing the server removes only the socket that
+    this server bound."""
+
+    daemon_threads = True
+    request_queue_size = 128
+    socket_identity = None  # (st_dev, st_ino) of the socket file once bound
+
+    def server_bind(self):
+        """
+        Removes a stale socket at the path and binds the new one. Raises FileExistsError when the path exists and is
+        not a socket.
+        """
+
+        try:
+            mode = os.lstat(self.server_address).st_mode
+        except FileNotFoundError:
+            mode = None
+        if mode is not None:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError(errno.EEXIST, "File exists and is not a socket", self.server_address)
+            os.unlink(self.server_address)
+        super().server_bind()
+        socket_stat = os.lstat(self.server_address)
+        self.socket_identity = (socket_stat.st_dev, socket_stat.st_ino)
+
+    def server_close(self):
+        """
+        Closes the server and removes its socket file, unless another server has replaced it in the meantime.
+        """
+
+        super().server_close()
+        if self.socket_identity is None:
+            return
+        try:
+            socket_stat = os.lstat(self.server_address)
+        except FileNotFoundError:
+            return
+        if stat.S_ISSOCK(socket_stat.st_mode) and (socket_stat.st_dev, socket_stat.st_ino) == self.socket_identity:
+            os.unlink(self.server_address)
+        self.socket_identity = None
+
+
+def create_server(roots, states, host='127.0.0.1', port=DEFAULT_SERVE_PORT, socket_path=None, verbose=False):
+    """
+    Creates the HTTP server for the given printer roots and MergedStateCache, listening on host and port or on a Unix
+    domain socket when socket_path is given. Raises FileExistsError when socket_path exists and is not a socket.
+    """
+
+    if socket_path is not None:
+        server = ThreadingUnixHTTPServer(socket_path, ServeRequestHandler)
+    else:
+        server = ServeHTTPServer((host, port), ServeRequestHandler)
+    server.roots = frozenset(roots)
+    server.states = states
+    server.verbose = verbose
+    return server
@@ -0,0 +1,371 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from array import array
+import json
+import marshal
+import os
+import struct
+import sys
+import zlib
+
+from configuration_section import ConfigurationSection
+from file_table import filename_of, intern_filename
+from gcode_block import GCodeBlock, expand_versions
+from key_value_pair import KeyValuePair
+from save_config import BedMesh, SaveConfig
+
+# A snapshot starts with a fixed prefix (magic, format version, the major and minor version of the Python that wrote
+# it, header length), followed by a marshalled header and one marshalled record per section, optionally
+# zlib-compressed. Records hold only plain values (strings, numbers, bytes, tuples, lists, sets and dicts) from which
+# the objects are rebuilt. The marshal format may change between Python versions, so a snapshot is only read by the
+# Python version that wrote it. Like pickle, marshal is not meant for data from untrusted sources, so snapshots should
+# only be loaded when they come from a trusted place. The header holds the file table, the parser's bookkeeping, the
+# include graph and the offset and length of every section record, so single sections can be loaded without reading
+# the others. Compression makes snapshots about three times smaller but roughly doubles the time to load them.
+# Version 2 stores overridden gcode block versions as deltas against the version that replaced them, version 3 adds
+# the saved bed mesh points of a section as the raw bytes of their array, version 4 the values of the SAVE_CONFIG block
+# so that overlays can apply them again, version 5 what the block added to each section so that overlays can take it
+# off, version 6 the section, comments and open gcode block the root file ended with, where overlays continue. Version
+# 7 replaces pickle by marshal, and version 8 adds the Python version to the prefix.
+SNAPSHOT_MAGIC = b'KFSNAP\0\0'
+SNAPSHOT_FORMAT_VERSION = 8
+SNAPSHOT_PREFIX = struct.Struct('<8sIHHQ')
+SNAPSHOT_COMPRESSION_LEVEL = 1
+
+
+class SnapshotError(Exception):
+    """Raised when a file is not a snapshot, is damaged, or was written in an unsupported format version or by another
+    Python version."""
+
+
+class FileIndexer:
+    """Maps file paths to compact indexes into the string table of a snapshot."""
+
+    def __init__(self):
+        self.paths = []
+        self.indexes = {}
+
+    def index(self, path):
+        """
+        Returns the index of path, adding it to the table when it is not known yet.
+        """
+
+        index = self.indexes.get(path)
+        if index is None:
+            index = self.indexes[path] = len(self.paths)
+            self.paths.append(path)
+        return index
+
+
+def encode_delta_record(delta):
+    """
+    Returns a gcode block delta with its ranges of copied lines replaced by (start, stop) pairs. The parts of a
+    delta are never empty, so a pair of integers cannot be mistaken for a tuple of lines.
+    """
+
+    return tuple((part.start, part.stop) if type(part) is range else part for part in delta)
+
+
+def decode_delta_record(record):
+    """
+    Rebuilds a gcode block delta from encode_delta_record.
+    """
+
+    return tuple(range(*part) if type(part[0]) is int else part for part in record)
+
+
+def encode_block(block, indexer):
+    """
+    Returns the snapshot record of a GCodeBlock and its older versions. A version that was overridden is stored as
+    its delta against the next version.
+    """
+
+    return (indexer.index(block.filename), block._lines, tuple(block.preceding_comments),
+            tuple(encode_block(version, indexer) for version in block.older_versions),
+            encode_delta_record(block.delta) if block.delta is not None else None)
+
+
+def encode_section(section, indexer):
+    """
+    Returns the snapshot record of a ConfigurationSection. File names are replaced by indexes into the string table.
+    """
+
+    file_index = indexer.index
+    key_value_pairs = tuple(
+        (kvp.key, file_index(filename_of(kvp.file_id)), kvp.value, kvp.inline_comment, kvp.preceding_comments,
+         tuple((file_index(filename_of(file_id)), value, inline_comment, preceding_comments)
+               for file_id, value, inline_comment, preceding_comments in kvp.occurrences))
+        for kvp in section.key_value_pairs.values())
+    gcode_blocks = tuple((name, tuple(encode_block(block, indexer) for block in blocks))
+                         for name, blocks in section.gcode_blocks.items())
+    mesh = section.bed_mesh
+    bed_mesh = (mesh.profile, file_index(mesh.filename), mesh.x_count, mesh.y_count, mesh.points.tobytes()) \
+        if mesh is not None else None
+    return section.name, tuple(file_index(path) for path in section.file_order), key_value_pairs, gcode_blocks, \
+        bed_mesh
+
+
+def decode_block(name, record, filenames):
+    """
+    Rebuilds a GCodeBlock from its snapshot record.
+    """
+
+    file_index, lines, preceding_comments, older_versions, delta = record
+    block = GCodeBlock(name, filenames[file_index])
+    block.lines = lines
+    block.delta = decode_delta_record(delta) if delta is not None else None
+    block.preceding_comments = preceding_comments
+    if older_versions:
+        block.older_versions = [decode_block(name, version, filenames) for version in older_versions]
+    return block
+
+
+def decode_section(record, filenames, file_ids):
+    """
+    Rebuilds a ConfigurationSection from its snapshot record. file_ids maps string table indexes to the IDs of the
+    process-wide file table.
+    """
+
+    name, file_indexes, key_value_pairs, gcode_blocks, bed_mesh = record
+    section = ConfigurationSection(name, filenames[file_indexes[0]])
+    for index in file_indexes[1:]:
+        section.add_file(filenames[index])
+    pairs = section.key_value_pairs
+    for key, file_index, value, inline_comment, preceding_comments, occurrences in key_value_pairs:
+        kvp = KeyValuePair.__new__(KeyValuePair)
+        kvp.key = sys.intern(key)
+        kvp.file_id = file_ids[file_index]
+        kvp.value = sys.intern(value)
+        kvp.inline_comment = inline_comment
+        kvp.preceding_comments = preceding_comments
+        kvp.occurrences = [(file_ids[occurrence[0]],) + occurrence[1:] for occurrence in occurrences] if occurrences \
+            else ()
+        pairs[key] = kvp
+    for block_name, blocks in gcode_blocks:
+        blocks = section.gcode_blocks[block_name] = [decode_block(block_name, block, filenames) for block in blocks]
+        for block, newer in zip(blocks, blocks[1:]):
+            if block.delta is not None:
+                block.newer = newer
+    if bed_mesh is not None:
+        profile, file_index, x_count, y_count, data = bed_mesh
+        points = array('d')
+        points.frombytes(data)
+        section.bed_mesh = BedMesh(profile, filenames[file_index], x_count, y_count, points)
+    return section
+
+
+def write_snapshot(parser, snapshot_filepath, compress=False):
+    """
+    Writes the merged state of a parser to a binary snapshot: sections with their provenance, the occurrence history
+    of every key, gcode block versions, the include graph and the files the merge depended on.
+    """
+
+    indexer = FileIndexer()
+    records = [marshal.dumps(encode_section(section, indexer)) for section in parser.sections.values()]
+    if compress:
+        records = [zlib.compress(record, SNAPSHOT_COMPRESSION_LEVEL) for record in records]
+    offsets = []
+    offset = 0
+    for name, record in zip(parser.sections, records):
+        offsets.append((name, offset, len(record)))
+        offset += len(record)
+
+    graph = parser.include_graph
+    save_config = parser.save_config
+    header = marshal.dumps({
+        'base_path': parser.base_path,
+        'compressed': compress,
+        'files': indexer.paths,
+        'sections': offsets,
+        'parsed_files': parser.parsed_files,
+        'missing_files': sorted(parser.missing_files),
+        'glob_results': parser.glob_results,
+        'save_config': (save_config.filename, save_config.sections, parser.save_config_layer)
+        if save_config is not None else None,
+        'root_end': (parser.root_end_section.name if parser.root_end_section is not None else None,
+                     parser.root_end_comments,
+                     (parser.gcode_block_name, parser.gcode_block_filename, parser.gcode_block_lines)
+                     if parser.in_gcode_block else None),
+        'include_graph': {'root': graph.root, 'files': graph.files, 'edges': graph.edges,
+                          'missing_files': sorted(graph.missing_files), 'cycles': graph.cycles},
+    })
+
+    temp_path = f"{snapshot_filepath}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(SNAPSHOT_PREFIX.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, *sys.version_info[:2], len(header)))
+        file.write(header)
+        for record in records:
+            file.write(record)
+    os.replace(temp_path, snapshot_filepath)
+
+
+def read_snapshot_header(file):
+    """
+    Reads and validates the prefix and header of an open snapshot file. Returns the header and the file offset of the
+    first section record.
+    """
+
+    prefix = file.read(SNAPSHOT_PREFIX.size)
+    if len(prefix) != SNAPSHOT_PREFIX.size:
+        raise SnapshotError("File is too short to be a snapshot.")
+    magic, version, *python_version, header_length = SNAPSHOT_PREFIX.unpack(prefix)
+    if magic != SNAPSHOT_MAGIC:
+        raise SnapshotError("File is not a KlipperFusion snapshot.")
+    if version != SNAPSHOT_FORMAT_VERSION:
+        raise SnapshotError(f"Unsupported snapshot format version {version} (expected {SNAPSHOT_FORMAT_VERSION}).")
+    if tuple(python_version) != sys.version_info[:2]:
+        raise SnapshotError(f"Snapshot was written by Python {python_version[0]}.{python_version[1]} and can only be "
+                            f"read by that version (this is Python {sys.version_info[0]}.{sys.version_info[1]}).")
+    return load_record(file.read(header_length)), SNAPSHOT_PREFIX.size + header_length
+
+
+def load_record(data):
+    """
+    Reads the header or a section record of a snapshot. Raises SnapshotError when the data is damaged.
+    """
+
+    try:
+        return marshal.loads(data)
+    except (EOFError, ValueError, TypeError) as e:
+        raise SnapshotError(f"Snapshot is damaged: {e}")
+
+
+def is_snapshot(filepath):
+    """
+    Checks whether a file starts with the snapshot magic.
+    """
+
+    try:
+        with open(filepath, 'rb') as file:
+            return file.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+    except OSError:
+        return False
+
+
+def load_snapshot_into(parser, snapshot_filepath, sections=None):
+    """
+    Restores the merged state stored in a snapshot into an empty parser without parsing any configuration file.
+    With sections, only the named sections are loaded (names missing from the snapshot are ignored); everything
+    else in the header, including the include graph, is always restored.
+    """
+
+    with open(snapshot_filepath, 'rb') as file:
+        header, data_start = read_snapshot_header(file)
+        filenames = header['files']
+        file_ids = [intern_filename(path) for path in filenames]
+        wanted = None if sections is None else set(sections)
+        compressed = header['compressed']
+        if wanted is None:
+            data = memoryview(file.read())
+        for name, offset, length in header['sections']:
+            if wanted is None:
+                record = data[offset:offset + length]
+            elif name in wanted:
+                file.seek(data_start + offset)
+                record = file.read(length)
+            else:
+                continue
+            if compressed:
+                record = zlib.decompress(record)
+            parser.sections[name] = decode_section(load_record(record), filenames, file_ids)
+
+    parser.base_path = header['base_path']
+    parser.parsed_files = header['parsed_files']
+    parser.missing_files = set(header['missing_files'])
+    parser.glob_results = header['glob_results']
+    if header['save_config'] is not None:
+        filename, saved_sections, parser.save_config_layer = header['save_config']
+        parser.save_config = SaveConfig(filename)
+        parser.save_config.sections = saved_sections
+        parser.save_config.meshes = {name: section.bed_mesh for name, section in parser.sections.items()
+                                     if section.bed_mesh is not None and section.bed_mesh.filename == filename}
+    root_end_name, parser.root_end_comments, gcode_block = header['root_end']
+    parser.root_end_section = parser.sections.get(root_end_name)
+    if gcode_block is not None:
+        parser.in_gcode_block = True
+        parser.gcode_block_name, parser.gcode_block_filename, parser.gcode_block_lines = gcode_block
+    graph = parser.include_graph
+    graph_state = header['include_graph']
+    graph.root = graph_state['root']
+    graph.files = graph_state['files']
+    graph.edges = graph_state['edges']
+    graph.missing_files = set(graph_state['missing_files'])
+    graph.cycles = graph_state['cycles']
+    return parser
+
+
+def snapshot_to_dict(parser):
+    """
+    Returns the merged state of a parser (parsed or loaded from a snapshot) as a JSON-serializable dictionary, for
+    tools that cannot read the binary snapshot. Paths are relative to the parser's base path.
+    """
+
+    def relpath(path):
+        return os.path.relpath(path, parser.base_path) if path else path
+
+    def block_to_dict(block, lines):
+        return {'file': relpath(block.filename), 'lines': [line.rstrip('\n') for line in lines],
+                'preceding_comments': list(block.preceding_comments),
+                'older_versions': [block_to_dict(version, version.lines) for version in block.older_versions]}
+
+    sections = {}
+    for name, section in parser.sections.items():
+        keys = {}
+        for key, kvp in section.key_value_pairs.items():
+            keys[key] = {
+                'value': kvp.value,
+                'file': relpath(kvp.filename),
+                'inline_comment': kvp.inline_comment,
+                'preceding_comments': list(kvp.preceding_comments),
+                'history': [{'file': relpath(filename_of(file_id)), 'value': value, 'inline_comment': inline_comment,
+                             'preceding_comments': list(preceding_comments)}
+                            for file_id, value, inline_comment, preceding_comments in kvp.occurrences],
+            }
+        sections[name] = {
+            'files': sorted(relpath(path) for path in section.filenames),
+            'keys': keys,
+            'gcode_blocks': {block_name: [block_to_dict(block, lines)
+                                          for block, lines in zip(blocks, expand_versions(blocks))]
+                             for block_name, blocks in section.gcode_blocks.items()},
+        }
+        if section.bed_mesh is not None:
+            mesh = section.bed_mesh
+            sections[name]['bed_mesh'] = {'file': relpath(mesh.filename), 'x_count': mesh.x_count,
+                                          'y_count': mesh.y_count, 'points': mesh.rows()}
+    return {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'base_path': parser.base_path,
+        'files': sorted(relpath(path) for path in parser.parsed_files),
+        'missing_files': sorted(relpath(path) for path in parser.missing_files),
+        'include_graph': parser.include_graph.to_dict(parser.base_path),
+        'sections': sections,
+    }
+
+
+def write_json_export(parser, json_filepath):
+    """
+    Writes the merged state of a parser as JSON.
+    """
+
+    with open(json_filepath, 'w') as file:
+        json.dump(snapshot_to_dict(parser), file, indent=2)
@@ -0,0 +1,190 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from array import array
+import locale
+import mmap
+import os
+import re
+
+# Files at least this large are mapped into memory instead of being read into a bytes object first
+MMAP_THRESHOLD = 1024 * 1024
+
+# Line ends in raw file contents, a '\r\n' pair counting as a single line end
+LINE_END_PATTERN = re.compile(rb'\r\n?|\n')
+
+
+def source_encoding():
+    """
+    Returns the encoding configuration files are decoded with, which is the same default open() uses in text mode.
+    """
+
+    return locale.getpreferredencoding(False)
+
+
+def read_source_bytes(filepath):
+    """
+    Reads the raw contents of a file in one call. Files of at least MMAP_THRESHOLD bytes are returned as a read-only
+    mmap, smaller files as bytes.
+    """
+
+    with open(filepath, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return file.read()
+
+
+def decode_source(data):
+    """
+    Decodes raw file contents to text, translating '\\r\\n' and '\\r' line endings to '\\n' the way text mode does.
+    """
+
+    text = str(data, source_encoding())
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
+def split_lines(text):
+    """
+    Splits text into lines that keep their '\n' terminators, exactly like iterating over a text file.
+
+    str.splitlines does this in C, but it also breaks lines at other Unicode line boundaries. Those are rare in
+    configuration files, so the line count is checked against the number of '\n' characters and the slower
+    split on '\n' is only used when they differ.
+    """
+
+    lines = text.splitlines(True)
+    if len(lines) == text.count('\n') + (not text.endswith('\n') and text != ''):
+        return lines
+    parts = text.split('\n')
+    lines = [part + '\n' for part in parts[:-1]]
+    if parts[-1]:
+        lines.append(parts[-1])
+    return lines
+
+
+def read_source_text(filepath):
+    """
+    Reads and decodes a whole configuration file with a single bulk read.
+    """
+
+    data = read_source_bytes(filepath)
+    try:
+        return decode_source(data)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+class SourceFile:
+    """The raw contents of a configuration file together with a table of line start offsets.
+
+    The offset table is built on first use, so later stages can slice single lines or line ranges back out of the
+    original source text without reading the file again."""
+
+    __slots__ = ('path', 'data', '_line_offsets')
+
+    def __init__(self, path, data):
+        """
+        Initializes the source from its path and raw contents (bytes or mmap).
+        """
+
+        self.path = path
+        self.data = data
+        self._line_offsets = None
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Reads a file in one bulk read and wraps its contents.
+        """
+
+        return cls(filepath, read_source_bytes(filepath))
+
+    @property
+    def text(self):
+        """
+        Returns the decoded text of the whole file.
+        """
+
+        return decode_source(self.data)
+
+    @property
+    def line_offsets(self):
+        """
+        Returns the byte offset of the start of every line, followed by the size of the file. Lines end at '\n',
+        '\r\n' or a lone '\r', the same line ends decode_source translates.
+        """
+
+        if self._line_offsets is None:
+            data = self.data
+            find = data.find
+            offsets = array('Q', [0])
+            append = offsets.append
+            if find(b'\r') >= 0:
+                offsets.extend(match.end() for match in LINE_END_PATTERN.finditer(data))
+            else:
+                position = find(b'\n')
+                while position >= 0:
+                    position += 1
+                    append(position)
+                    position = find(b'\n', position)
+            if offsets[-1] != len(data):
+                append(len(data))
+            self._line_offsets = offsets
+        return self._line_offsets
+
+    @property
+    def line_count(self):
+        """
+        Returns the number of lines in the file.
+        """
+
+        return len(self.line_offsets) - 1
+
+    def byte_range(self, first_line, last_line=None):
+        """
+        Returns the (start, end) byte offsets of the lines first_line..last_line (zero-based, inclusive).
+        """
+
+        offsets = self.line_offsets
+        if last_line is None:
+            last_line = first_line
+        return offsets[first_line], offsets[last_line + 1]
+
+    def lines(self, first_line, last_line=None):
+        """
+        Returns the decoded source text of the lines first_line..last_line (zero-based, inclusive).
+        """
+
+        start, end = self.byte_range(first_line, last_line)
+        return decode_source(self.data[start:end])
+
+    def close(self):
+        """
+        Releases the mapping of a memory-mapped file.
+        """
+
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
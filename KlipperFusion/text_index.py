@@ -0,0 +1,494 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import bisect
+import contextlib
+import hashlib
+import io
+import os
+import pickle
+import re
+import struct
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from config_parser import ConfigParser
+from configuration_section import cached_relpath
+from file_table import filename_of
+from gcode_block import expand_versions
+from parse_cache import DEFAULT_MAX_CACHE_BYTES, ParseCache, default_cache_dir
+from watch_mode import ClosureState
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+# An inverted index over the merged configurations of a fleet. Every printer gets a segment file holding its entries
+# (section names, keys, values, comments and gcode lines, each with the section and file it belongs to) and a sorted
+# term dictionary mapping every lowercased word to the entries containing it. A segment also stores the include
+# closure of the merge it was built from, so an update only merges and indexes the printers whose files changed.
+# A segment file starts with a fixed prefix (magic, format version, header length), followed by a small pickled
+# header with the root and closure, so staleness checks do not load the entries, and the pickled body.
+SEGMENT_MAGIC = b'KFTIDX\0\0'
+SEGMENT_FORMAT_VERSION = 1
+SEGMENT_PREFIX = struct.Struct('<8sIQ')
+SEGMENT_SUFFIX = '.kfidx'
+
+FIELDS = ('section', 'key', 'value', 'comment', 'gcode')
+FIELD_SECTION, FIELD_KEY, FIELD_VALUE, FIELD_COMMENT, FIELD_GCODE = range(len(FIELDS))
+
+TERM_PATTERN = re.compile(r'\w+')
+
+
+def default_index_dir():
+    """
+    Returns the default directory of the text index, inside the default cache directory.
+    """
+
+    return os.path.join(default_cache_dir(), 'text_index')
+
+
+def iter_terms(text):
+    """
+    Returns the distinct lowercased words of a text.
+    """
+
+    return set(TERM_PATTERN.findall(text.lower()))
+
+
+def regex_literals(pattern):
+    """
+    Returns lowercased word fragments that every match of a regular expression must contain, e.g. ['tmc22'] for
+    'TMC22\\d+'. Only literal runs outside of alternations and optional repeats are used, so the fragments are a safe
+    prefilter: an entry whose terms contain none of a fragment cannot match.
+    """
+
+    literals = []
+
+    def walk(items):
+        run = []
+        for op, argument in items:
+            if op is sre_parse.LITERAL:
+                run.append(chr(argument))
+                continue
+            literals.append(''.join(run))
+            run = []
+            if op is sre_parse.SUBPATTERN:
+                walk(argument[-1])
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and argument[0] >= 1:
+                walk(argument[2])
+        literals.append(''.join(run))
+
+    walk(sre_parse.parse(pattern))
+    fragments = {fragment for literal in literals for fragment in TERM_PATTERN.findall(literal.lower())}
+    return sorted(fragment for fragment in fragments if len(fragment) >= 2)
+
+
+def segment_name(root):
+    """
+    Returns the file name of the segment of a printer root.
+    """
+
+    return hashlib.blake2b(root.encode('utf-8', 'surrogateescape'), digest_size=10).hexdigest() + SEGMENT_SUFFIX
+
+
+class TextSegment:
+    """The index of one printer: string tables, one row per entry in column arrays, and a sorted term dictionary with
+    the ids of the entries containing each term."""
+
+    def __init__(self, root, base_path, closure=None):
+        """
+        Initializes an empty segment for the merged configuration of root.
+        """
+
+        self.root = root
+        self.base_path = base_path
+        self.closure = closure
+        self.files = []
+        self.sections = []
+        self.strings = []
+        self.entry_sections = array('I')
+        self.entry_files = array('I')
+        self.entry_fields = array('B')
+        self.entry_keys = array('i')  # String id of the key or gcode block an entry belongs to, -1 for none
+        self.entry_texts = array('I')
+        self.terms = []
+        self.postings = []  # Entry ids of every term, aligned with terms
+
+    @classmethod
+    def from_parser(cls, parser, root):
+        """
+        Builds the segment of a merged configuration. Every value, comment and gcode line of the value and gcode
+        history is indexed with the file that defined it, not only the effective ones.
+        """
+
+        segment = cls(root, parser.base_path, ClosureState(parser))
+        relpath = cached_relpath(parser.base_path)
+        file_ids = {}
+        string_ids = {}
+        entries = {}
+
+        def file_id(filename):
+            index = file_ids.get(filename)
+            if index is None:
+                index = file_ids[filename] = len(segment.files)
+                segment.files.append(relpath(filename) if filename else '')
+            return index
+
+        def string_id(text):
+            index = string_ids.get(text)
+            if index is None:
+                index = string_ids[text] = len(segment.strings)
+                segment.strings.append(text)
+            return index
+
+        def add(section_id, filename, field, key, text):
+            if text:
+                entries[(section_id, file_id(filename), field, string_id(key) if key else -1, string_id(text))] = None
+
+        for section_id, (name, section) in enumerate(parser.sections.items()):
+            segment.sections.append(name)
+            for filename in section.file_order:
+                add(section_id, filename, FIELD_SECTION, None, name)
+            for key, kvp in section.key_value_pairs.items():
+                for occurrence in (*kvp.occurrences, (kvp.file_id, kvp.value, kvp.inline_comment,
+                                                      kvp.preceding_comments)):
+                    filename = filename_of(occurrence[0])
+                    add(section_id, filename, FIELD_KEY, None, key)
+                    add(section_id, filename, FIELD_VALUE, key, occurrence[1])
+                    add(section_id, filename, FIELD_COMMENT, key, occurrence[2])
+                    for comment in occurrence[3]:
+                        add(section_id, filename, FIELD_COMMENT, key, comment)
+            for block_name, blocks in section.gcode_blocks.items():
+                for block, lines in zip(blocks, expand_versions(blocks)):
+                    for comment in block.preceding_comments:
+                        add(section_id, block.filename, FIELD_COMMENT, block_name, comment.strip())
+                    for line in lines:
+                        add(section_id, block.filename, FIELD_GCODE, block_name, line.strip())
+
+        text_terms = {}
+        postings = {}
+        for entry_id, (section_id, file_index, field, key, text) in enumerate(entries):
+            segment.entry_sections.append(section_id)
+            segment.entry_files.append(file_index)
+            segment.entry_fields.append(field)
+            segment.entry_keys.append(key)
+            segment.entry_texts.append(text)
+            terms = text_terms.get(text)
+            if terms is None:
+                terms = text_terms[text] = iter_terms(segment.strings[text])
+            for term in terms:
+                entry_ids = postings.get(term)
+                if entry_ids is None:
+                    postings[term] = array('I', (entry_id,))
+                else:
+                    entry_ids.append(entry_id)
+        segment.terms = sorted(postings)
+        segment.postings = [postings[term] for term in segment.terms]
+        return segment
+
+    def write(self, segment_filepath):
+        """
+        Atomically writes the segment to a file.
+        """
+
+        header = pickle.dumps({'root': self.root, 'base_path': self.base_path, 'closure': self.closure,
+                               'entries': len(self.entry_texts), 'terms': len(self.terms)}, pickle.HIGHEST_PROTOCOL)
+        body = pickle.dumps((self.files, self.sections, self.strings, self.entry_sections, self.entry_files,
+                             self.entry_fields, self.entry_keys, self.entry_texts, self.terms, self.postings),
+                            pickle.HIGHEST_PROTOCOL)
+        temp_path = f"{segment_filepath}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(SEGMENT_PREFIX.pack(SEGMENT_MAGIC, SEGMENT_FORMAT_VERSION, len(header)))
+            file.write(header)
+            file.write(body)
+        os.replace(temp_path, segment_filepath)
+
+    @staticmethod
+    def read_header(file):
+        """
+        Reads and validates the prefix and header of an open segment file. Raises ValueError for files that are not
+        segments or were written in another format version.
+        """
+
+        prefix = file.read(SEGMENT_PREFIX.size)
+        if len(prefix) != SEGMENT_PREFIX.size:
+            raise ValueError("File is too short to be an index segment.")
+        magic, version, header_length = SEGMENT_PREFIX.unpack(prefix)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_FORMAT_VERSION:
+            raise ValueError("File is not an index segment of the current format version.")
+        return pickle.loads(file.read(header_length))
+
+    @classmethod
+    def load(cls, segment_filepath):
+        """
+        Loads a segment written by write.
+        """
+
+        with open(segment_filepath, 'rb') as file:
+            header = cls.read_header(file)
+            segment = cls(header['root'], header['base_path'], header['closure'])
+            (segment.files, segment.sections, segment.strings, segment.entry_sections, segment.entry_files,
+             segment.entry_fields, segment.entry_keys, segment.entry_texts, segment.terms,
+             segment.postings) = pickle.load(file)
+        return segment
+
+    def term_entries(self, term):
+        """
+        Returns the ids of the entries containing a word.
+        """
+
+        position = bisect.bisect_left(self.terms, term)
+        if position < len(self.terms) and self.terms[position] == term:
+            return set(self.postings[position])
+        return set()
+
+    def prefix_entries(self, prefix):
+        """
+        Returns the ids of the entries containing a word that starts with prefix.
+        """
+
+        entry_ids = set()
+        for position in range(bisect.bisect_left(self.terms, prefix), len(self.terms)):
+            if not self.terms[position].startswith(prefix):
+                break
+            entry_ids.update(self.postings[position])
+        return entry_ids
+
+    def fragment_entries(self, fragment):
+        """
+        Returns the ids of the entries containing a word that contains fragment. This scans the term dictionary,
+        which is much smaller than the entries themselves.
+        """
+
+        entry_ids = set()
+        for term, postings in zip(self.terms, self.postings):
+            if fragment in term:
+                entry_ids.update(postings)
+        return entry_ids
+
+    def search(self, terms=(), prefixes=(), pattern=None, fields=None):
+        """
+        Returns the ids of the entries that contain every term, a word starting with every prefix, and a match of
+        the compiled regular expression pattern, optionally only entries of the given field numbers. The pattern is
+        only run on the entries its literal fragments leave over.
+        """
+
+        candidates = None
+        lookups = [(self.term_entries, term) for term in terms] + [(self.prefix_entries, prefix) for prefix in prefixes]
+        if pattern is not None:
+            lookups.extend((self.fragment_entries, fragment) for fragment in regex_literals(pattern.pattern))
+        for lookup, argument in lookups:
+            entry_ids = lookup(argument)
+            candidates = entry_ids if candidates is None else candidates & entry_ids
+            if not candidates:
+                return []
+        entry_ids = sorted(candidates) if candidates is not None else range(len(self.entry_texts))
+        if fields is not None:
+            entry_ids = [entry_id for entry_id in entry_ids if self.entry_fields[entry_id] in fields]
+        if pattern is not None:
+            entry_ids = [entry_id for entry_id in entry_ids
+                         if pattern.search(self.strings[self.entry_texts[entry_id]])]
+        return list(entry_ids)
+
+    def hit(self, entry_id):
+        """
+        Returns an entry as a JSON-serializable dictionary.
+        """
+
+        key = self.entry_keys[entry_id]
+        return {'printer': self.root, 'section': self.sections[self.entry_sections[entry_id]],
+                'file': self.files[self.entry_files[entry_id]], 'field': FIELDS[self.entry_fields[entry_id]],
+                'key': self.strings[key] if key >= 0 else None, 'text': self.strings[self.entry_texts[entry_id]]}
+
+
+def index_printer(root, segment_filepath, cache_dir=None, cache_max_bytes=DEFAULT_MAX_CACHE_BYTES, use_cache=True):
+    """
+    Merges a printer configuration and writes its segment. Runs inside a worker process, so everything it reports is
+    returned as a plain dictionary; messages the parser prints are captured as warnings.
+    """
+
+    result = {'root': root, 'status': 'indexed', 'error': None, 'warnings': []}
+    messages = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(messages):
+            cache = ParseCache(cache_dir, cache_max_bytes) if use_cache else None
+            parser = ConfigParser(os.path.dirname(root), cache)
+            parser.parse_file(root)
+            segment = TextSegment.from_parser(parser, root)
+            segment.write(segment_filepath)
+            result['entries'] = len(segment.entry_texts)
+            result['terms'] = len(segment.terms)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = time.perf_counter() - start
+    result['warnings'] = messages.getvalue().splitlines()
+    return result
+
+
+class TextIndex:
+    """A directory of printer segments. update brings the segments of a set of printers up to date, search answers
+    queries over all of them. Loaded segments are kept, so one TextIndex answers many queries without reading the
+    segments again."""
+
+    def __init__(self, index_dir=None):
+        """
+        Initializes an index stored in index_dir, creating the directory when needed.
+        """
+
+        self.index_dir = os.path.abspath(index_dir or default_index_dir())
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.loaded = {}  # Segment path -> (modification time, TextSegment)
+
+    def segment_path(self, root):
+        """
+        Returns the path of the segment of a printer root.
+        """
+
+        return os.path.join(self.index_dir, segment_name(root))
+
+    def segment_paths(self):
+        """
+        Returns the paths of all segments in the index directory.
+        """
+
+        return sorted(os.path.join(self.index_dir, name) for name in os.listdir(self.index_dir)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def is_current(self, root):
+        """
+        Returns True when the segment of root exists and nothing in the include closure it was built from changed.
+        """
+
+        try:
+            with open(self.segment_path(root), 'rb') as file:
+                header = TextSegment.read_header(file)
+        except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+            return False
+        changed, _ = header['closure'].changed_files()
+        return header['root'] == root and not changed
+
+    def update(self, roots, jobs=1, cache_dir=None, cache_max_bytes=DEFAULT_MAX_CACHE_BYTES, use_cache=True,
+               progress=print):
+        """
+        Brings the segments of the given printer roots up to date and returns one result dictionary per root, in the
+        order of roots. Printers whose include closure is unchanged keep their segment; the others are merged and
+        indexed again, in a process pool when jobs is larger than one.
+        """
+
+        results = {}
+        stale = []
+        for root in roots:
+            if self.is_current(root):
+                results[root] = {'root': root, 'status': 'unchanged', 'error': None, 'warnings': [], 'seconds': 0.0}
+            else:
+                stale.append(root)
+
+        def report(result):
+            results[result['root']] = result
+            if progress:
+                progress(f"[{len(results)}/{len(roots)}] {result['status']:>9}  {result['seconds'] * 1000:8.1f} ms  "
+                         f"{result['root']}")
+
+        arguments = [(root, self.segment_path(root), cache_dir, cache_max_bytes, use_cache) for root in stale]
+        if jobs > 1 and len(stale) > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = {executor.submit(index_printer, *argument): argument[0] for argument in arguments}
+                for future in as_completed(futures):
+                    try:
+                        report(future.result())
+                    except Exception as e:
+                        report({'root': futures[future], 'status': 'failed', 'seconds': 0.0, 'warnings': [],
+                                'error': f"Worker failed: {type(e).__name__}: {e}"})
+        else:
+            for argument in arguments:
+                report(index_printer(*argument))
+
+        if use_cache and stale:
+            try:
+                ParseCache(cache_dir, cache_max_bytes).prune()
+            except OSError as e:
+                print(f"Warning: Could not prune the parse cache: {e}")
+        return [results[root] for root in roots]
+
+    def prune(self, roots):
+        """
+        Removes the segments of all printers except the given roots and returns how many were removed.
+        """
+
+        keep = {self.segment_path(root) for root in roots}
+        removed = 0
+        for path in self.segment_paths():
+            if path not in keep:
+                os.remove(path)
+                self.loaded.pop(path, None)
+                removed += 1
+        return removed
+
+    def segment(self, segment_filepath):
+        """
+        Returns the loaded segment stored at a path, reading it again only when the file changed.
+        """
+
+        mtime = os.stat(segment_filepath).st_mtime_ns
+        loaded = self.loaded.get(segment_filepath)
+        if loaded is None or loaded[0] != mtime:
+            loaded = self.loaded[segment_filepath] = (mtime, TextSegment.load(segment_filepath))
+        return loaded[1]
+
+    def search(self, query='', regex=None, fields=None, roots=None, limit=None):
+        """
+        Searches the segments of the given roots, or of all printers, and returns the matching entries as
+        dictionaries. Every word of query must occur in an entry, case-insensitively; a word ending in '*' matches
+        words starting with it. regex is matched against the entry texts after prefiltering them by its literal
+        fragments. fields restricts the search to entries of some of the FIELDS.
+        """
+
+        terms, prefixes = [], []
+        for word in query.split():
+            words = TERM_PATTERN.findall(word.lower())
+            if word.endswith('*') and words:
+                # In 'tmc2209:run_cur*' only the last word is a prefix
+                terms.extend(words[:-1])
+                prefixes.append(words[-1])
+            else:
+                terms.extend(words)
+        pattern = re.compile(regex) if regex else None
+        field_numbers = {FIELDS.index(field) for field in fields} if fields else None
+        paths = [self.segment_path(root) for root in roots] if roots is not None else self.segment_paths()
+
+        hits = []
+        for path in paths:
+            try:
+                segment = self.segment(path)
+            except (OSError, ValueError, pickle.UnpicklingError, EOFError) as e:
+                print(f"Warning: Skipping unreadable index segment {path}: {e}")
+                continue
+            for entry_id in segment.search(terms, prefixes, pattern, field_numbers):
+                hits.append(segment.hit(entry_id))
+                if limit is not None and len(hits) >= limit:
+                    return hits
+        return hits
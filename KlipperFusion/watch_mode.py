@@ -0,0 +1,416 @@
+# MIT License
+#
+# Copyright (c) 2024 Kamil Ercan Turkarslan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from config_parser import ConfigParser
+from configuration_section import cached_relpath
+from gcode_block import expand_versions
+from include_graph import GlobCache
+from source_reader import read_source_text
+
+DEFAULT_POLL_INTERVAL = 0.5
+DEFAULT_DEBOUNCE = 0.2
+
+
+class MemoryTokenCache:
+    """In-memory token store used while watching a configuration tree.
+
+    It exposes the same get_tokens interface as ParseCache, so it can be handed to ConfigParser directly. Unchanged
+    files are replayed from memory without being read, and files that changed are tokenized again (through the
+    optional persistent cache, which is kept up to date as a side effect)."""
+
+    def __init__(self, persistent_cache=None):
+        """
+        Initializes an empty token store, optionally backed by a persistent ParseCache.
+        """
+
+        self.persistent_cache = persistent_cache
+        self.entries = {}  # Normalized path -> (mtime_ns, size, tokens, fingerprint)
+        self.retokenized = []
+
+    def get_tokens(self, filepath, tokenize_text):
+        """
+        Returns (tokens, fingerprint) for filepath, tokenizing it only when its stat result changed.
+        """
+
+        stat = os.stat(filepath)
+        entry = self.entries.get(filepath)
+        if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry[2], entry[3]
+
+        self.retokenized.append(filepath)
+        if self.persistent_cache is not None:
+            tokens, fingerprint = self.persistent_cache.get_tokens(filepath, tokenize_text)
+        else:
+            tokens = tokenize_text(read_source_text(filepath))
+            fingerprint = None
+        self.entries[filepath] = (stat.st_mtime_ns, stat.st_size, tokens, fingerprint)
+        return tokens, fingerprint
+
+
+def section_signature(section):
+    """
+    Returns a hashable value that changes whenever the output of a ConfigurationSection would change.
+
+    Comparing signatures only touches references to already existing strings, which is far cheaper than formatting
+    a section, so it is used to decide which sections have to be rendered again.
+    """
+
+    key_value_pairs = tuple(
+        (key, kvp.file_id, kvp.value, kvp.inline_comment, kvp.preceding_comments, tuple(kvp.occurrences))
+        for key, kvp in section.key_value_pairs.items())
+    gcode_blocks = tuple(
+        (block_name, tuple((tuple(lines), tuple(block.preceding_comments))
+                           for block, lines in zip(blocks, expand_versions(blocks))))
+        for block_name, blocks in section.gcode_blocks.items())
+    bed_mesh = section.bed_mesh.digest() if section.bed_mesh is not None else None
+    return tuple(section.filenames), key_value_pairs, gcode_blocks, bed_mesh
+
+
+class ClosureState:
+    """Snapshot of everything a merge depended on: the parsed files, the missing files and the glob matches."""
+
+    def __init__(self, parser):
+        """
+        Captures the include closure recorded by a ConfigParser after parsing.
+        """
+
+        self.files = {}
+        for path in parser.parsed_files:
+            try:
+                stat = os.stat(path)
+                self.files[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                self.files[path] = None
+        self.missing_files = set(parser.missing_files)
+        self.glob_results = dict(parser.glob_results)
+
+    def changed_files(self):
+        """
+        Returns (changed_paths, earliest_change_time) describing how the file system diverged from this snapshot.
+        The change time is taken from the modification times of the changed files when they still exist.
+        """
+
+        changed = []
+        change_times = []
+        for path, fingerprint in self.files.items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                changed.append(path)
+                continue
+            if (stat.st_mtime_ns, stat.st_size) != fingerprint:
+                changed.append(path)
+                change_times.append(stat.st_mtime_ns / 1e9)
+        for path in self.missing_files:
+            if os.path.exists(path):
+                changed.append(path)
+        glob_cache = GlobCache()
+        for pattern, matching_files in self.glob_results.items():
+            current_files = glob_cache.expand(pattern)
+            if current_files != matching_files:
+                changed.extend(set(current_files).symmetric_difference(matching_files) or [pattern])
+        return changed, (min(change_times) if change_times else None)
+
+    def probe(self):
+        """
+        Returns a comparable stamp of the current file system state of the closure, used to detect when a burst of
+        saves has settled.
+        """
+
+        stats = []
+        for path in self.files:
+            try:
+                stat = os.stat(path)
+                stats.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stats.append(None)
+        missing = tuple(os.path.exists(path) for path in self.missing_files)
+        glob_cache = GlobCache()
+        globs = tuple(tuple(glob_cache.expand(pattern)) for pattern in self.glob_results)
+        return tuple(stats), missing, globs
+
+    def refresh(self):
+        """
+        Takes the current file system state as the new baseline, so that only later changes are reported. Used after
+        a failed merge, when the closure of the last successful merge is watched until the problem is fixed.
+        """
+
+        for path in list(self.files):
+            try:
+                stat = os.stat(path)
+                self.files[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                del self.files[path]
+                self.missing_files.add(path)
+        for path in list(self.missing_files):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            self.missing_files.discard(path)
+            self.files[path] = (stat.st_mtime_ns, stat.st_size)
+        glob_cache = GlobCache()
+        self.glob_results = {pattern: glob_cache.expand(pattern) for pattern in self.glob_results}
+
+    def watched_directories(self):
+        """
+        Returns the directories whose entries can influence the merge, for watchers that observe directories.
+        """
+
+        directories = {os.path.dirname(path) for path in self.files}
+        directories.update(os.path.dirname(path) for path in self.missing_files)
+        for pattern in self.glob_results:
+            directory = os.path.dirname(pattern)
+            while '*' in directory:
+                directory = os.path.dirname(directory)
+            directories.add(directory)
+            directories.update(os.path.dirname(path) for path in self.glob_results[pattern])
+        return {directory for directory in directories if os.path.isdir(directory)}
+
+
+class PollingWatcher:
+    """Waits for changes by periodically comparing the closure snapshot against the file system."""
+
+    def __init__(self, interval=DEFAULT_POLL_INTERVAL):
+        """
+        Initializes the watcher with the polling interval in seconds.
+        """
+
+        self.interval = interval
+
+    def watch(self, directories):
+        """
+        Polling does not need to register directories.
+        """
+
+    def wait(self, state):
+        """
+        Blocks until the file system diverges from state.
+        """
+
+        while True:
+            time.sleep(self.interval)
+            if state.changed_files()[0]:
+                return
+
+    def close(self):
+        """
+        Releases the watcher's resources.
+        """
+
+
+class InotifyWatcher:
+    """Waits for changes using the Linux inotify API through ctypes, without any third-party dependency.
+
+    Directories are watched rather than files, so that editors which save by writing a new file and renaming it over
+    the old one are noticed as well."""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        """
+        Creates the inotify instance. Raises OSError when inotify is not available on this platform.
+        """
+
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watch_descriptors = {}  # Directory -> watch descriptor
+
+    def watch(self, directories):
+        """
+        Adds inotify watches for directories that are not watched yet.
+        """
+
+        for directory in directories:
+            if directory in self.watch_descriptors:
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.WATCH_MASK)
+            if wd < 0:
+                print(f"Warning: Could not watch {directory}: {os.strerror(ctypes.get_errno())}")
+            else:
+                self.watch_descriptors[directory] = wd
+
+    def _drain(self):
+        """
+        Reads and discards all pending events, returning True when there were any.
+        """
+
+        received = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return received
+            if not data:
+                return received
+            offset = 0
+            while offset < len(data):
+                _, _, _, name_length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size + name_length
+                received = True
+
+    def wait(self, state):
+        """
+        Blocks until an event in a watched directory makes the file system diverge from state.
+        """
+
+        while True:
+            select.select([self.fd], [], [])
+            if self._drain() and state.changed_files()[0]:
+                return
+
+    def close(self):
+        """
+        Releases the inotify instance.
+        """
+
+        os.close(self.fd)
+
+
+def create_watcher(poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+    """
+    Returns an InotifyWatcher when possible and falls back to a PollingWatcher otherwise.
+    """
+
+    if use_inotify:
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            print(f"inotify unavailable ({e}), falling back to polling every {poll_interval}s.")
+    return PollingWatcher(poll_interval)
+
+
+class WatchSession:
+    """Keeps the merged state of one configuration tree warm and rewrites the output file whenever it changes."""
+
+    def __init__(self, filename, base_path, output_filepath, hide_unmodified=True, persistent_cache=None,
+                 gcode_history='full', effective_only=False, provenance=False):
+        """
+        Initializes the session for the root configuration file and the output file it maintains. With
+        effective_only the output holds only the effective configuration, optionally with provenance comments.
+        """
+
+        self.filename = filename
+        self.base_path = base_path
+        self.output_filepath = output_filepath
+        self.hide_unmodified = hide_unmodified
+        self.gcode_history = gcode_history
+        self.effective_only = effective_only
+        self.provenance = provenance
+        self.token_cache = MemoryTokenCache(persistent_cache)
+        self.signatures = {}  # Section name -> signature of the last rendered version
+        self.rendered = {}  # Section name -> last rendered text
+        self.parser = None
+        self.state = None
+
+    def merge(self):
+        """
+        Re-merges the tree, re-renders only sections whose contents changed and rewrites the output file.
+        Returns (retokenized_files, re_emitted_sections).
+        """
+
+        self.token_cache.retokenized = []
+        parser = ConfigParser(self.base_path, self.token_cache, effective_only=self.effective_only)
+        parser.parse_file(self.filename)
+        relpath = cached_relpath(parser.base_path) if self.provenance else None
+
+        signatures = {}
+        rendered = {}
+        re_emitted = []
+        for section_name, section in parser.sections.items():
+            signature = section_signature(section)
+            signatures[section_name] = signature
+            if self.signatures.get(section_name) == signature:
+                rendered[section_name] = self.rendered[section_name]
+            elif self.effective_only:
+                rendered[section_name] = ''.join(section.iter_effective_output(relpath))
+                re_emitted.append(section_name)
+            else:
+                rendered[section_name] = section.write_output(parser.base_path, self.hide_unmodified,
+                                                              self.gcode_history)
+                re_emitted.append(section_name)
+
+        with open(self.output_filepath, 'w') as file:
+            for text in rendered.values():
+                file.write(text)
+
+        self.parser = parser
+        self.state = ClosureState(parser)
+        self.signatures = signatures
+        self.rendered = rendered
+        return list(self.token_cache.retokenized), re_emitted
+
+    def run(self, watcher, debounce=DEFAULT_DEBOUNCE):
+        """
+        Watches the include closure until interrupted, re-merging after each debounced burst of changes.
+        """
+
+        self.merge()
+        print(f"Watching {len(self.state.files)} files for changes. Press Ctrl+C to stop.")
+        while True:
+            watcher.watch(self.state.watched_directories())
+            watcher.wait(self.state)
+            detected_at = time.time()
+
+            # Debounce: wait until the burst of saves has settled before merging
+            stamp = self.state.probe()
+            while True:
+                time.sleep(debounce)
+                settled_stamp = self.state.probe()
+                if settled_stamp == stamp:
+                    break
+                stamp = settled_stamp
+
+            changed_files, change_time = self.state.changed_files()
+            names = ', '.join(os.path.relpath(path, self.base_path) for path in changed_files)
+            try:
+                retokenized, re_emitted = self.merge()
+            except (OSError, ValueError) as e:
+                # Keep the last good output and wait for the next change, which hopefully fixes the problem
+                print(f"[{time.strftime('%H:%M:%S')}] {names} changed: could not update the output: {str(e)}")
+                self.state.refresh()
+                continue
+            finished_at = time.time()
+            latency = finished_at - min(change_time or detected_at, detected_at)
+            print(f"[{time.strftime('%H:%M:%S')}] {names} changed: re-tokenized {len(retokenized)} file(s), "
+                  f"re-emitted {len(re_emitted)} of {len(self.rendered)} section(s), "
+                  f"output updated {latency * 1000:.1f} ms after the change.")